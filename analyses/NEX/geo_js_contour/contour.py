@@ -1,47 +1,43 @@
 import os
+import json
 import tempfile
 import shutil
+import numpy as np
 from netCDF4 import Dataset
 from bson import json_util
-from contextlib import contextmanager
 from girder_client import GirderClient
-import time
 
-def debug(s):
-    print s
+# Bump the version whenever a change alters the output, so that results
+# registered by earlier versions are not reused
+ANALYSIS_NAME = 'contour'
+ANALYSIS_VERSION = 1
 
-@contextmanager
-def timer(s):
-    t0 = time.time()
-    yield
-    debug("%s (%.2f)" % (s, time.time() - t0))
 
-def convert(data_path, variable, timestep):
+def convert(data_path, variable, timestep, bbox=None):
     data = Dataset(data_path)
     variable = data.variables[variable]
-    shape = variable[timestep].shape
 
-    lat_select_index = shape[0]
-    lon_select_index = shape[1]
+    lat_name, lon_name = grid_dimensions(data)
 
-    # Extract out the lat lon names
-    dimensions = map(lambda d : d, data.dimensions)
-    for d in dimensions:
-        if d.startswith('lat'):
-            lat_name = d
-        elif d.startswith('lon'):
-            lon_name = d
+    # Only read the hyperslab covering the bounding box
+    lat_slice, lon_slice = grid_subset(data, bbox)
+    values = variable[timestep, lat_slice, lon_slice]
+
+    # The spacing is that of the full grid, a subset may be a single cell
+    dx, dy = grid_spacing(data)
 
     contour_data = {
-        'gridWidth': lon_select_index,
-        'gridHeight': lat_select_index,
-        'x0': float(data.variables[lon_name][0]),
-        'y0': float(data.variables[lat_name][0]),
-        'dx': float(data.variables[lon_name][1] - data.variables[lon_name][0]),
-        'dy': float(data.variables[lat_name][1] - data.variables[lat_name][0]),
-        'values': variable[timestep][:lat_select_index, :lon_select_index].reshape(variable[timestep][:lat_select_index, :lon_select_index].size).tolist()
+        'gridWidth': values.shape[1],
+        'gridHeight': values.shape[0],
+        'x0': float(data.variables[lon_name][lon_slice.start]),
+        'y0': float(data.variables[lat_name][lat_slice.start]),
+        'dx': dx,
+        'dy': dy,
+        'values': values.reshape(values.size).tolist()
     }
 
+    data.close()
+
     return contour_data
 
 debug("Starting contour task")
@@ -61,45 +57,70 @@ parameters = {
     'type': 'file'
 }
 
+cache_dir = locals().get('cache_dir') or os.environ.get(
+    'MINERVA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'minerva_cache'))
+cache_size = locals().get('cache_size') or 20 * 1024 ** 3
+force = force if 'force' in locals() else False
+bbox = parse_bbox(bbox if 'bbox' in locals() else None)
+
 # Get the file resource so we can get the name
 input_file = client.get('resource/%s' % str(fileId), parameters=parameters)
 input_file_name = input_file['name']
 output_file_name = input_file_name.replace('.nc', '.json')
 
-try:
-    # Now download the dataset
-    
-    (fd, filepath) = tempfile.mkstemp()
-    os.close(fd)
-
-    with timer("Downloaded file %s" % filepath):
-        client.downloadFile(fileId, filepath)
-
-    # Create temp file and convert to GeoJs contour JSON format
-    with timer("Converted file %s" % filepath):
-        output_dir = tempfile.mkdtemp()
-        output_filepath = os.path.join(output_dir, output_file_name)
-        with open(output_filepath, 'w') as fp:
-            fp.write(json_util.dumps(convert(filepath, variable, timestep)))
-
-    # Create an item for this file
-    with timer("Created item for file"):
-        output_item = client.createItem(dataset_folder_id, output_file_name, output_file_name)
-
-    # Now upload the result
-    with timer("Uploaded file %s to %s" % (output_filepath, output_item['_id'])):
-        client.uploadFileToItem(output_item['_id'], output_filepath)
-
-    output_item_id = output_item['_id']
-
-    # Finally promote item to dataset
-    with timer("Promoted item %s to dataset" % output_item_id):
-        client.post('minerva_dataset/%s/dataset' % output_item_id)
-
-finally:
-    if filepath and os.path.exists(filepath):
-        os.remove(filepath)
-    if output_dir and os.path.exists(output_dir):
-        shutil.rmtree(output_dir)
-
-
+# Reuse the dataset from an earlier run with the same input and parameters
+# unless the caller asked to recompute it
+analysis_parameters = {
+    'variable': variable,
+    'timestep': int(timestep),
+    'bbox': bbox
+}
+result_parameters = {
+    'analysis': ANALYSIS_NAME,
+    'version': ANALYSIS_VERSION,
+    'fileId': fileId,
+    'params': json.dumps(analysis_parameters)
+}
+output_item_id = None
+if not force:
+    existing = client.get('minerva_analysis/result',
+                          parameters=result_parameters)['item']
+    if existing is not None:
+        output_item_id = existing['_id']
+        debug("Reusing dataset %s from an earlier run" % output_item_id)
+
+if output_item_id is None:
+    output_dir = None
+    try:
+        # The input is kept in a shared local cache, so repeated runs against
+        # the same file only download it once
+        with cached_file(client, input_file, cache_dir, cache_size) as filepath:
+
+            # Create temp file and convert to GeoJs contour JSON format
+            with timer("Converted file %s" % filepath):
+                output_dir = tempfile.mkdtemp()
+                output_filepath = os.path.join(output_dir, output_file_name)
+                with open(output_filepath, 'w') as fp:
+                    fp.write(json_util.dumps(convert(filepath, variable,
+                                                            timestep, bbox)))
+
+        # Create an item for this file
+        with timer("Created item for file"):
+            output_item = client.createItem(dataset_folder_id, output_file_name, output_file_name)
+
+        # Now upload the result
+        with timer("Uploaded file %s to %s" % (output_filepath, output_item['_id'])):
+            client.uploadFileToItem(output_item['_id'], output_filepath)
+
+        output_item_id = output_item['_id']
+
+        # Finally promote item to dataset
+        with timer("Promoted item %s to dataset" % output_item_id):
+            client.post('minerva_dataset/%s/dataset' % output_item_id)
+
+        # Register the dataset so repeated runs can reuse it
+        client.post('minerva_analysis/%s/result' % output_item_id, parameters=result_parameters)
+
+    finally:
+        if output_dir and os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
@@ -1,24 +1,16 @@
 import os
-import sys
+import json
 import tempfile
 import numpy as np
 from bson import json_util
-import time
-from contextlib import contextmanager
 from romanesco.utils import tmpdir
 from netCDF4 import Dataset
 from girder_client import GirderClient
 
-def debug(s):
-    # noop here to disable debugging
-    print s
-
-@contextmanager
-def timer(s):
-    t0 = time.time()
-    yield
-    debug("%s (%.2f)" % (s, time.time() - t0))
-
+# Bump the version whenever a change alters the output, so that results
+# registered by earlier versions are not reused
+ANALYSIS_NAME = 'mean contour'
+ANALYSIS_VERSION = 1
 
 def cache(data):
     import pickle
@@ -30,74 +22,83 @@ def uncache():
     return pickle.load(open("/tmp/tmp.pickle", "rb"))
 
 
-def convert(data, variable, timestep):
-    variable = data.variables[variable]
-    shape = variable[timestep].shape
+def convert(data, variable, timestep, spacing=None):
+    """Return a timestep of a variable as contour JSON.
 
-    # For now sub select ( take about 10% of the grid )
-    lat_select_index = shape[0]
-    lon_select_index = shape[1]
+    spacing is the (dx, dy) of the source grid, data may be a window of it
+    too small to tell.  It defaults to the spacing of data.
+    """
+    if spacing is None:
+        spacing = grid_spacing(data)
+    variable = data.variables[variable]
+    values = variable[timestep]
 
-    # Extract out the lat lon names
-    dimensions = map(lambda d : d, data.dimensions)
-    for d in dimensions:
-        if d.startswith('lat'):
-            lat_name = d
-        elif d.startswith('lon'):
-            lon_name = d
+    lat_name, lon_name = grid_dimensions(data)
 
     contour_data = {
-        'gridWidth': lon_select_index,
-        'gridHeight': lat_select_index,
+        'gridWidth': values.shape[1],
+        'gridHeight': values.shape[0],
         'x0': float(data.variables[lon_name][0]),
         'y0': float(data.variables[lat_name][0]),
-        'dx': float(data.variables[lon_name][1] - data.variables[lon_name][0]),
-        'dy': float(data.variables[lat_name][1] - data.variables[lat_name][0]),
-        'values': variable[timestep][:lat_select_index, :lon_select_index].reshape(variable[timestep][:lat_select_index, :lon_select_index].size).tolist()
+        'dx': spacing[0],
+        'dy': spacing[1],
+        'values': values.reshape(values.size).tolist()
     }
 
     return contour_data
 
 
-def toNetCDFDataset(source, variable, data):
+def createNetCDFDataset(source, filepath, variable, data_type,
+                        chunksizes=None, lat_slice=None, lon_slice=None,
+                        num_timesteps=None):
+    """Create an output dataset on the grid of source, or the lat_slice and
+    lon_slice window of it, with an empty, compressed variable that can be
+    filled in one chunk at a time."""
 
-    def _copy_variable(target_file, source_file, variable):
+    def _copy_variable(target_file, source_file, variable, index,
+                       block_size=4096):
         src_var = source_file.variables[variable]
         target_var = target_file.createVariable(variable, src_var.datatype, src_var.dimensions)
         target_var.setncatts({k: src_var.getncattr(k) for k in src_var.ncattrs()})
-        target_var[:] = src_var[:]
+        # Copy in blocks along the first axis to bound memory use
+        start, stop, _ = index.indices(len(src_var))
+        for i in xrange(start, stop, block_size):
+            end = min(i + block_size, stop)
+            target_var[i - start:end - start] = src_var[i:end]
 
-    (fd, filepath) = tempfile.mkstemp()
-    os.close(fd)
     output = Dataset(filepath, 'w')
 
-    # Extract out the lat lon names,  these are not
-    # consistent across the netCDF files
-    dimensions = map(lambda d : d, source.dimensions)
-    for d in dimensions:
-        if d.startswith('lat'):
-            lat_name = d
-        elif d.startswith('lon'):
-            lon_name = d
-
-    output.createDimension(lat_name, len(source.dimensions[lat_name])
-                           if not source.dimensions[lat_name].isunlimited()
-                           else None)
-    output.createDimension(lon_name, len(source.dimensions[lon_name])
-                           if not source.dimensions[lon_name].isunlimited()
-                           else None)
-    output.createDimension('time', len(source.dimensions['time'])
+    lat_name, lon_name = grid_dimensions(source)
+
+    if lat_slice is None:
+        lat_slice = slice(0, len(source.dimensions[lat_name]))
+    if lon_slice is None:
+        lon_slice = slice(0, len(source.dimensions[lon_name]))
+    if num_timesteps is None:
+        num_timesteps = len(source.dimensions['time'])
+
+    output.createDimension(lat_name, lat_slice.stop - lat_slice.start)
+    output.createDimension(lon_name, lon_slice.stop - lon_slice.start)
+    output.createDimension('time', num_timesteps
                            if not source.dimensions['time'].isunlimited()
                            else None)
-    _copy_variable(output, source, lat_name)
-    _copy_variable(output, source, lon_name)
+    _copy_variable(output, source, lat_name, lat_slice)
+    _copy_variable(output, source, lon_name, lon_slice)
+
+    output.createVariable(variable, data_type, ('time', lat_name, lon_name),
+                          zlib=True, shuffle=True, chunksizes=chunksizes)
 
+    return output
+
+
+def toNetCDFDataset(source, variable, data, filepath):
+    """Write in memory data to a new dataset on the grid of source."""
     if type(data) == list:
         data_type = data[0].dtype
     else:
         data_type = data.dtype
 
-    output.createVariable(variable, data_type, ('time', lat_name, lon_name))
+    output = createNetCDFDataset(source, filepath, variable, data_type)
 
     if type(data) == list:
         for i in xrange(len(data)):
@@ -108,12 +109,23 @@ def toNetCDFDataset(source, variable, data):
     return output
 
 
-def netcdf_mean(filepath, parameter, grid_chunk_size, partitions):
+def netcdf_mean(filepath, parameter, grid_chunk_size, partitions,
+                output_filepath, bbox=None, time_range=None):
     data = Dataset(filepath)
-    pr = data.variables[parameter]
+
+    # Means of floating point values keep their precision, means of
+    # integers are floating point
+    data_type = data.variables[parameter].dtype
+    if data_type.kind != 'f':
+        data_type = np.dtype(np.float64)
+
+    # Only the hyperslab covering the bounding box and time range is read
+    lat_slice, lon_slice = grid_subset(data, bbox)
+    (first_timestep, last_timestep) = timestep_range(
+        time_range, data.variables['time'].size)
 
     # Get the number of timesteps
-    num_timesteps = data.variables['time'].size
+    num_timesteps = last_timestep - first_timestep
 
     # For now don't break up timesteps,  just take mean across
     # Grid sections. If we set this to some other value it would
@@ -124,19 +136,18 @@ def netcdf_mean(filepath, parameter, grid_chunk_size, partitions):
     timesteps = num_timesteps
 
     # Get number of locations per timestep
-    shape = pr[0].shape
-    num_grid_points = pr[0].size
+    shape = (lat_slice.stop - lat_slice.start,
+             lon_slice.stop - lon_slice.start)
+    lat_offset = lat_slice.start
+    lon_offset = lon_slice.start
 
     # Break timesteps into n size chunks
     timestep_chunks = []
-
-    # Break timesteps into n size chunks
-    timestep_chunks = []
-    for x in xrange(0, num_timesteps, timesteps):
-        if x + timesteps < num_timesteps:
+    for x in xrange(first_timestep, last_timestep, timesteps):
+        if x + timesteps < last_timestep:
             timestep_chunks.append((x, x + timesteps))
         else:
-            timestep_chunks.append((x, num_timesteps))
+            timestep_chunks.append((x, last_timestep))
 
 
     # Break locations into chunks
@@ -155,42 +166,61 @@ def netcdf_mean(filepath, parameter, grid_chunk_size, partitions):
         pr = data.variables[parameter]
 
         (lat, lon) = grid_chunk
+        lat_end = min(lat + grid_chunk_size, shape[0])
+        lon_end = min(lon + grid_chunk_size, shape[1])
 
         values = []
         for timestep_range in timestep_chunks:
             (start_timesteps, end_timesteps) = timestep_range
 
             mean = np.mean(pr[start_timesteps:end_timesteps,
-                              lat:lat+grid_chunk_size,
-                              lon:lon+grid_chunk_size], axis=0)
-            values.append(mean)
+                              lat_offset+lat:lat_offset+lat_end,
+                              lon_offset+lon:lon_offset+lon_end], axis=0)
+            values.append(mean.astype(data_type))
+
+        data.close()
 
-        return values
+        return (grid_chunk, values)
 
     # parallelize the grid
     grid_chunks = sc.parallelize(grid_chunks, partitions)
 
-    # Now calculate means
-    means = grid_chunks.map(calculate_means)
-    means = means.collect()
+    # Now calculate means, all partitions at once.  The means are kept on
+    # the executors, toLocalIterator would otherwise only compute each
+    # partition once the driver asks for it, one after another.
+    means = grid_chunks.map(calculate_means).persist()
+    means.count()
+
+    # Stream the means into the output rather than collecting the whole
+    # grid on the driver, only one partition of chunks is held in memory at
+    # a time.  The output is chunked on the same grid as the computation so
+    # each write touches whole chunks.
+    output = createNetCDFDataset(data, output_filepath, parameter, data_type,
+                                 chunksizes=(1, min(grid_chunk_size, shape[0]),
+                                             min(grid_chunk_size, shape[1])),
+                                 lat_slice=lat_slice, lon_slice=lon_slice,
+                                 num_timesteps=len(timestep_chunks))
+    output_variable = output.variables[parameter]
+
+    for (lat, lon), values in means.toLocalIterator():
+        for j, chunk in enumerate(values):
+            output_variable[j, lat:lat+chunk.shape[0], lon:lon+chunk.shape[1]] = chunk
+
+    means.unpersist()
+    data.close()
 
-    timestep_means = [np.ma.empty(shape) for x in range(len(timestep_chunks))]
-
-    i = 0
-    for lat in xrange(0, shape[0], grid_chunk_size):
-        for lon in xrange(0, shape[1], grid_chunk_size):
-            for j in range(len(timestep_chunks)):
-                chunk = means[i][j]
-                timestep_means[j][lat:lat+chunk.shape[0], lon:lon+chunk.shape[1]] = chunk
-
-            i += 1
-
-    return toNetCDFDataset(data, parameter, timestep_means)
+    return output
 
 ## provide some defaults - these could be passed into the script from the
 ## interface but for demo purposes we'll keep it simple.
 grid_chunk_size = grid_chunk_size if 'grid_chunk_size' in locals() else 20
 partitions = partitions if 'partitions' in locals() else 8
+cache_dir = locals().get('cache_dir') or os.environ.get(
+    'MINERVA_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'minerva_cache'))
+cache_size = locals().get('cache_size') or 20 * 1024 ** 3
+force = force if 'force' in locals() else False
+bbox = parse_bbox(bbox if 'bbox' in locals() else None)
+timeRange = parse_time_range(timeRange if 'timeRange' in locals() else None)
 
 debug("Starting mean_contour task")
 client = GirderClient(host, port)
@@ -216,44 +246,69 @@ input_file = client.get('resource/%s' % str(fileId), parameters=parameters)
 input_file_name = input_file['name']
 output_file_name = input_file_name.replace('.nc', '.json')
 
-# Now download the dataset
-# probably better to make a tempfile,   but for now to avoid downloading
-# files over and over store in a known location and check before downloading
-# (fd, filepath) = tempfile.mkstemp()
-# os.close(fd)
-
-#output_dir = "/data"
-with tmpdir(cleanup=True) as output_dir:
-    output_filepath = os.path.join(output_dir, output_file_name)
-
-    if not os.path.exists(os.path.join(output_dir, input_file_name)):
-        with timer("Downloading %s to %s" % (fileId, os.path.join(output_dir, input_file_name))):
-            client.downloadFile(fileId, os.path.join(output_dir, input_file_name))
-
-    with timer("Finished running netcdf_mean"):
-        data = netcdf_mean(os.path.join(output_dir, input_file_name),
-                           variable,
-                           grid_chunk_size,
-                           partitions)
-
-    with timer("Finished converting to contour JSON"):
-        contour = convert(data, variable, 0)
-
-    with open(output_filepath, 'w') as fp:
-        fp.write(json_util.dumps(contour))
-
-    # Create an item for this file
-    with timer("Created item"):
-        output_item = client.createItem(dataset_folder_id,
-                                        output_file_name,
-                                        output_file_name)
-
-    # Now upload the result
-    with timer("Finished uploading item from %s" % (output_filepath)):
-        client.uploadFileToItem(output_item['_id'], output_filepath)
-
-    output_item_id = output_item['_id']
-
-    # Finally promote item to dataset
-    with timer("Promoted item %s to dataset" % output_item_id):
-        client.post('minerva_dataset/%s/dataset' % output_item_id)
+# Reuse the dataset from an earlier run with the same input and parameters
+# unless the caller asked to recompute it
+analysis_parameters = {
+    'variable': variable,
+    'bbox': bbox,
+    'timeRange': timeRange
+}
+result_parameters = {
+    'analysis': ANALYSIS_NAME,
+    'version': ANALYSIS_VERSION,
+    'fileId': fileId,
+    'params': json.dumps(analysis_parameters)
+}
+output_item_id = None
+if not force:
+    existing = client.get('minerva_analysis/result',
+                          parameters=result_parameters)['item']
+    if existing is not None:
+        output_item_id = existing['_id']
+        debug("Reusing dataset %s from an earlier run" % output_item_id)
+
+if output_item_id is None:
+    # The input is kept in a shared local cache, so repeated runs against
+    # the same file only download it once
+    with cached_file(client, input_file, cache_dir, cache_size) as input_filepath, \
+            tmpdir(cleanup=True) as output_dir:
+        output_filepath = os.path.join(output_dir, output_file_name)
+
+        with timer("Finished running netcdf_mean"):
+            data = netcdf_mean(input_filepath,
+                               variable,
+                               grid_chunk_size,
+                               partitions,
+                               os.path.join(output_dir, 'mean.nc'),
+                               bbox,
+                               timeRange)
+
+        with timer("Finished converting to contour JSON"):
+            # The mean only covers the subset, take the spacing of the source
+            source = Dataset(input_filepath)
+            spacing = grid_spacing(source)
+            source.close()
+            contour = convert(data, variable, 0, spacing)
+            data.close()
+
+        with open(output_filepath, 'w') as fp:
+            fp.write(json_util.dumps(contour))
+
+        # Create an item for this file
+        with timer("Created item"):
+            output_item = client.createItem(dataset_folder_id,
+                                            output_file_name,
+                                            output_file_name)
+
+        # Now upload the result
+        with timer("Finished uploading item from %s" % (output_filepath)):
+            client.uploadFileToItem(output_item['_id'], output_filepath)
+
+        output_item_id = output_item['_id']
+
+        # Finally promote item to dataset
+        with timer("Promoted item %s to dataset" % output_item_id):
+            client.post('minerva_dataset/%s/dataset' % output_item_id)
+
+    # Register the dataset so repeated runs can reuse it
+    client.post('minerva_analysis/%s/result' % output_item_id, parameters=result_parameters)
@@ -0,0 +1,255 @@
+"""Helpers shared by the NEX analysis scripts.
+
+Romanesco runs an analysis script from its source, so the scripts can't
+import this module.  Analyses list it in the "script_includes" of their
+analysis.json instead, and import_analyses prepends its source to theirs.
+"""
+import os
+import fcntl
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+#: Name of the lock taken while the cache is evicted
+CACHE_LOCK = 'cache.lock'
+
+
+def debug(s):
+    # noop here to disable debugging
+    print s
+
+
+@contextmanager
+def timer(s):
+    t0 = time.time()
+    yield
+    debug("%s (%.2f)" % (s, time.time() - t0))
+
+
+def _file_digest(file_resource):
+    """Return the content hash of a girder file, or its size if unknown."""
+    return file_resource.get('sha512') or 'size%d' % file_resource['size']
+
+
+def grid_dimensions(data):
+    """Return the names of the latitude and longitude dimensions of a grid,
+    these are not consistent across the netCDF files."""
+    lat_name = lon_name = None
+    for name in data.dimensions:
+        if name.startswith('lat'):
+            lat_name = name
+        elif name.startswith('lon'):
+            lon_name = name
+    return lat_name, lon_name
+
+
+def grid_spacing(data):
+    """Return the (dx, dy) spacing of the longitudes and latitudes of a grid.
+
+    Pass the full source grid, a window of it one cell wide or tall has no
+    spacing of its own.  An axis of a single cell has a spacing of 0.
+    """
+    def _spacing(name):
+        values = data.variables[name]
+        return float(values[1] - values[0]) if len(values) > 1 else 0.0
+
+    lat_name, lon_name = grid_dimensions(data)
+    return (_spacing(lon_name), _spacing(lat_name))
+
+
+def parse_bbox(bbox):
+    """Return (west, south, east, north) from a list or "w,s,e,n" string."""
+    if not bbox:
+        return None
+    if isinstance(bbox, basestring):
+        bbox = bbox.split(',')
+    west, south, east, north = map(float, bbox)
+    if south > north:
+        raise Exception('Invalid bounding box %s' % repr(bbox))
+    return (west, south, east, north)
+
+
+def grid_subset(data, bbox):
+    """Return the lat and lon index slices of the grid cells within bbox.
+
+    Longitudes in bbox are in [-180, 180] and are wrapped onto grids using
+    [0, 360].  A box crossing the seam of the grid can't be expressed as a
+    single hyperslab, so it falls back to the full longitude range.
+    """
+    lat_name, lon_name = grid_dimensions(data)
+    lats = data.variables[lat_name][:]
+    lons = data.variables[lon_name][:]
+    if bbox is None:
+        return slice(0, len(lats)), slice(0, len(lons))
+
+    west, south, east, north = bbox
+
+    def _indices(values, low, high):
+        # Include cells whose extent, not just center, overlaps the box
+        half = abs(float(values[1] - values[0])) / 2 if len(values) > 1 else 0
+        index = np.nonzero((values >= low - half) & (values <= high + half))[0]
+        if not len(index):
+            raise Exception('Bounding box %s does not overlap the grid' %
+                            repr(bbox))
+        return slice(int(index[0]), int(index[-1]) + 1)
+
+    lat_slice = _indices(lats, south, north)
+
+    if east - west >= 360:
+        lon_slice = slice(0, len(lons))
+    else:
+        if lons.max() > 180:
+            west, east = west % 360, east % 360
+        if west > east:
+            lon_slice = slice(0, len(lons))
+        else:
+            lon_slice = _indices(lons, west, east)
+
+    return lat_slice, lon_slice
+
+
+def parse_time_range(time_range):
+    """Return (start, end) timestep indices from a list or "start,end" string.
+
+    The end index is exclusive, either bound may be empty to leave that end
+    of the range open, and is None then.  Returns None for no range.
+    """
+    if not time_range:
+        return None
+    if isinstance(time_range, basestring):
+        time_range = time_range.split(',')
+    start, end = [int(t) if t not in (None, '') else None for t in time_range]
+    if start is not None and end is not None and start >= end:
+        raise Exception('Invalid time range %s' % repr(time_range))
+    return (start, end)
+
+
+def timestep_range(time_range, num_timesteps):
+    """Return the (start, end) timestep indices of a parsed time range
+    within num_timesteps."""
+    if time_range is None:
+        return (0, num_timesteps)
+    start, end = time_range
+    start = 0 if start is None else max(start, 0)
+    end = num_timesteps if end is None else min(end, num_timesteps)
+    if start >= end:
+        raise Exception('Time range %s is outside of the %d timesteps' %
+                        (repr(time_range), num_timesteps))
+    return (start, end)
+
+
+@contextmanager
+def _cache_lock(cache_dir, operation):
+    """Hold the lock of the whole cache, exclusive while evicting."""
+    with open(os.path.join(cache_dir, CACHE_LOCK), 'a') as lock:
+        fcntl.flock(lock, operation)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _lock_entry(lock_path, operation):
+    """Open and lock the lock file of a cache entry.
+
+    Eviction removes the lock file along with the entry, so a lock taken
+    on a file that was removed meanwhile is retried on the new one.
+    """
+    while True:
+        lock = open(lock_path, 'a')
+        fcntl.flock(lock, operation)
+        try:
+            if os.fstat(lock.fileno()).st_ino == os.stat(lock_path).st_ino:
+                return lock
+        except OSError:
+            pass
+        lock.close()
+
+
+def _remove_entry(path, lock_path):
+    """Remove an entry and its lock file unless it is in use."""
+    with open(lock_path, 'a') as lock:
+        # Entries in use by another task hold a shared lock, skip those
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            return False
+        try:
+            if os.path.exists(path):
+                os.remove(path)
+            os.remove(lock_path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+    return True
+
+
+def _evict_cache(cache_dir, cache_size, keep):
+    """Remove least recently used cache entries until under cache_size.
+
+    Lock files left by downloads that failed are removed as well.
+    """
+    with _cache_lock(cache_dir, fcntl.LOCK_EX):
+        entries = []
+        for name in os.listdir(cache_dir):
+            path = os.path.join(cache_dir, name)
+            if name == CACHE_LOCK or name.endswith('.part') or path == keep:
+                continue
+            if name.endswith('.lock'):
+                if not os.path.exists(path[:-len('.lock')]):
+                    _remove_entry(path[:-len('.lock')], path)
+                continue
+            stat = os.stat(path)
+            entries.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(e[1] for e in entries) + os.path.getsize(keep)
+        for mtime, size, path in sorted(entries):
+            if total <= cache_size:
+                break
+            if _remove_entry(path, path + '.lock'):
+                total -= size
+                debug("Cache evicted %s" % path)
+
+
+@contextmanager
+def cached_file(client, file_resource, cache_dir, cache_size):
+    """Yield a local path for a girder file, downloading it at most once.
+
+    Entries are keyed by the girder file id and its sha512 (or size when
+    the assetstore does not provide a checksum).  The entry is locked
+    exclusively while it is being downloaded and shared while it is in use,
+    so concurrent tasks never download the same file twice or evict a file
+    out from under each other.
+    """
+    if not os.path.isdir(cache_dir):
+        try:
+            os.makedirs(cache_dir)
+        except OSError:
+            if not os.path.isdir(cache_dir):
+                raise
+
+    file_id = str(file_resource['_id'])
+    path = os.path.join(cache_dir, '%s_%s%s' % (
+        file_id, _file_digest(file_resource)[:32],
+        os.path.splitext(file_resource['name'])[1]))
+
+    lock = _lock_entry(path + '.lock', fcntl.LOCK_EX)
+    try:
+        if os.path.exists(path):
+            debug("Cache hit for %s (%s)" % (file_id, path))
+            # Touch the entry so eviction is least recently used
+            os.utime(path, None)
+        else:
+            debug("Cache miss for %s" % file_id)
+            with timer("Downloading %s to %s" % (file_id, path)):
+                client.downloadFile(file_id, path + '.part')
+            os.rename(path + '.part', path)
+        # flock releases the lock for a moment to downgrade it, hold off
+        # eviction meanwhile
+        with _cache_lock(cache_dir, fcntl.LOCK_SH):
+            fcntl.flock(lock, fcntl.LOCK_SH)
+        _evict_cache(cache_dir, cache_size, path)
+        yield path
+    finally:
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        lock.close()
@@ -18,9 +18,13 @@ add_python_test(dataset PLUGIN minerva)
 add_python_test(session PLUGIN minerva)
 add_python_test(analysis PLUGIN minerva)
 add_python_test(geonames PLUGIN minerva)
+add_python_test(twitter PLUGIN minerva)
 add_python_test(s3_dataset PLUGIN minerva)
 add_python_test(import_analyses PLUGIN minerva)
 add_python_test(contour_analysis PLUGIN minerva)
+add_python_test(nex_utility PLUGIN minerva)
+add_python_test(mean_contour_kernel PLUGIN minerva)
+add_python_test(schedule PLUGIN minerva)
 
 
 set(SPARK_TEST_MASTER_URL  "" CACHE STRING "Spark master URL")
@@ -131,12 +131,19 @@ class AnalysisTestCase(base.TestCase):
         response = self.request(path=path, method='POST', params=params, user=self._user)
         self.assertStatusOk(response)
 
-        # mock the calls to bsve search
+        # mock the calls to bsve search, the first check finding the
+        # search still in progress
+        resultRequests = []
+
         @urlmatch(netloc=r'(.*\.)?beta-search.bsvecosystem.net(.*)$')
         def bsve_mock(url, request):
             if url.path.split('/')[-1] == 'request':
                 return httmock.response(200, '12345')
+            elif not resultRequests:
+                resultRequests.append(url)
+                return httmock.response(200, {'status': 0})
             else:
+                resultRequests.append(url)
                 pluginTestDir = os.path.dirname(os.path.realpath(__file__))
                 filepath = os.path.join(pluginTestDir, 'data', 'bsve_search.json')
                 with open(filepath) as bsve_search_file:
@@ -150,6 +157,13 @@ class AnalysisTestCase(base.TestCase):
                     }
                     return httmock.response(200, content, headers, request=request)
 
+        # check the search without waiting through the real backoff
+        from girder.plugins.minerva.jobs import bsve_search_worker
+        initialDelay = bsve_search_worker.INITIAL_DELAY
+        bsve_search_worker.INITIAL_DELAY = 0.1
+        self.addCleanup(setattr, bsve_search_worker, 'INITIAL_DELAY',
+                        initialDelay)
+
         with HTTMock(bsve_mock):
             response = self.request(
                 path='/minerva_analysis/bsve_search',
@@ -164,7 +178,7 @@ class AnalysisTestCase(base.TestCase):
             # wait for the async job to complete
             searchResultsFinished = False
             count = 0
-            while not searchResultsFinished and count < 5:
+            while not searchResultsFinished and count < 100:
                 # get the dataset and check if it has been updated
                 path = '/minerva_dataset/%s/dataset' % str(response.json['dataset_id'])
                 response = self.request(
@@ -176,11 +190,17 @@ class AnalysisTestCase(base.TestCase):
                 if 'json_row' in dataset:
                     searchResultsFinished = True
                 else:
-                    time.sleep(2)
+                    time.sleep(0.2)
                     count += 1
 
             # ensure the first row of results was added to the dataset
             self.assertTrue('json_row' in dataset, 'json_row expected in dataset')
+
+            # the job checked the search again after it was in progress
+            self.assertEquals(len(resultRequests), 2, 'Expected two checks of the search')
+            job = self.model('job', 'jobs').findOne({'type': 'bsve.search'})
+            self.assertEquals(job['kwargs']['bsve']['requestId'], '12345')
+            self.assertEquals(job['kwargs']['bsve']['checks'], 1)
             self.assertTrue('data' in dataset['json_row'], 'data should be in json_row')
             self.assertTrue('Longitude' in dataset['json_row']['data'], 'data.Longitude should be in json_row')
 
@@ -212,3 +232,171 @@ class AnalysisTestCase(base.TestCase):
                 user=self._user,
             )
             self.assertHasKeys(response.json, ['geojson_file'])
+
+    def testBsveSearchResume(self):
+        """ Test resuming and retrying the checks of bsve search jobs. """
+        from girder.plugins.jobs.constants import JobStatus
+        from girder.plugins.minerva.jobs import bsve_search_worker
+
+        # record the checks instead of running them
+        calls = []
+        callLater = bsve_search_worker.callLater
+        bsve_search_worker.callLater = lambda *args: calls.append(args)
+        self.addCleanup(setattr, bsve_search_worker, 'callLater', callLater)
+
+        jobModel = self.model('job', 'jobs')
+
+        def createJob(kwargs, status):
+            job = jobModel.createLocalJob(
+                title='bsve search', user=self._user, type='bsve.search',
+                kwargs=kwargs,
+                module='girder.plugins.minerva.jobs.bsve_search_worker')
+            jobModel.updateJob(job, status=status)
+            return job
+
+        submitted = createJob({'bsve': {'requestId': '12345'}},
+                              JobStatus.RUNNING)
+        interrupted = createJob({}, JobStatus.RUNNING)
+        finished = createJob({'bsve': {'requestId': '67890'}},
+                             JobStatus.SUCCESS)
+
+        # a restarted server checks the searches that were submitted again
+        # and fails the jobs stopped before that
+        bsve_search_worker.resumeSearches()
+        self.assertEquals(calls, [(bsve_search_worker.INITIAL_DELAY,
+                                   bsve_search_worker.checkSearch,
+                                   submitted['_id'])])
+        self.assertEquals(jobModel.load(interrupted['_id'], force=True)[
+            'status'], JobStatus.ERROR)
+        self.assertEquals(jobModel.load(finished['_id'], force=True)[
+            'status'], JobStatus.SUCCESS)
+
+        # a check failing to load the job is retried, then fails
+        del calls[:]
+        bsve_search_worker.checkSearch('not an id')
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(calls[0][1:], (bsve_search_worker.checkSearch,
+                                         'not an id', 1))
+        self.assertRaises(Exception, bsve_search_worker.checkSearch,
+                          'not an id', bsve_search_worker.MAX_CHECK_RETRIES)
+        self.assertEquals(len(calls), 1)
+
+    def testAnalysisResultRegistry(self):
+        """ Test registering and finding memoized analysis results. """
+
+        path = '/minerva_dataset/folder'
+        params = {
+            'userId': self._user['_id'],
+        }
+        response = self.request(path=path, method='POST', params=params, user=self._user)
+        self.assertStatusOk(response)
+        datasetFolder = response.json['folder']
+
+        # upload the input file of the analysis
+        inputItem = self.model('item').createItem('input', self._user, datasetFolder)
+        response = self.request(path='/file', method='POST', user=self._user, params={
+            'parentType': 'item',
+            'parentId': inputItem['_id'],
+            'name': 'input.nc',
+            'size': 10,
+            'mimeType': 'application/octet-stream'
+        })
+        self.assertStatusOk(response)
+        response = self.multipartRequest(
+            path='/file/chunk', user=self._user,
+            fields=[('offset', 0), ('uploadId', response.json['_id'])],
+            files=[('chunk', 'input.nc', 'x' * 10)])
+        self.assertStatusOk(response)
+        fileId = response.json['_id']
+
+        run = {
+            'analysis': 'contour',
+            'version': 1,
+            'fileId': fileId,
+            'params': json.dumps({'variable': 'pr', 'timestep': 0})
+        }
+
+        # nothing has been registered yet
+        path = '/minerva_analysis/result'
+        response = self.request(path=path, method='GET', params=run, user=self._user)
+        self.assertStatusOk(response)
+        self.assertEquals(response.json['item'], None, 'No result should exist')
+
+        # only minerva datasets can be registered as results
+        item = self.model('item').createItem('contour result', self._user, datasetFolder)
+        path = '/minerva_analysis/{}/result'.format(item['_id'])
+        response = self.request(path=path, method='POST', params=run, user=self._user)
+        self.assertStatus(response, 400)
+
+        self.model('item').setMetadata(item, {'minerva': {'dataset_id': item['_id']}})
+        response = self.request(path=path, method='POST', params=run, user=self._user)
+        self.assertStatusOk(response)
+        self.assertEquals(response.json['analysis_result']['params'],
+                          {'variable': 'pr', 'timestep': 0})
+
+        # registering again doesn't duplicate the registration
+        response = self.request(path=path, method='POST', params=run, user=self._user)
+        self.assertStatusOk(response)
+        resultModel = self.model('analysis_result', 'minerva')
+        self.assertEquals(resultModel.find({'itemId': item['_id']}).count(), 1)
+
+        # a repeat run finds the registered dataset
+        path = '/minerva_analysis/result'
+        response = self.request(path=path, method='GET', params=run, user=self._user)
+        self.assertStatusOk(response)
+        self.assertEquals(response.json['item']['_id'], str(item['_id']))
+
+        # the key is computed from the inputs, other parameters don't match
+        other = dict(run, params=json.dumps({'variable': 'tas', 'timestep': 0}))
+        response = self.request(path=path, method='GET', params=other, user=self._user)
+        self.assertStatusOk(response)
+        self.assertEquals(response.json['item'], None, 'No result should exist')
+
+        response = self.request(path=path, method='GET', params=dict(run, version=2),
+                                user=self._user)
+        self.assertStatusOk(response)
+        self.assertEquals(response.json['item'], None, 'No result should exist')
+
+        # other users can't look up runs of files they can't read
+        otherUser = self.model('user').createUser(
+            'otheruser', 'password', 'other', 'user',
+            'otheruser@example.com')
+        response = self.request(path=path, method='GET', params=run, user=otherUser)
+        self.assertStatus(response, 403)
+
+        # nor receive the results of other users, which could be anything
+        folder = self.model('folder').load(datasetFolder['_id'], force=True)
+        self.model('folder').setPublic(folder, True, save=True)
+        response = self.request(path=path, method='GET', params=run, user=otherUser)
+        self.assertStatusOk(response)
+        self.assertEquals(response.json['item'], None, 'Result should not be trusted')
+
+        # a result planted by another user isn't returned to the first one
+        otherFolder = self.model('folder').createFolder(
+            otherUser, 'planted', parentType='user', creator=otherUser)
+        planted = self.model('item').createItem('planted', otherUser, otherFolder)
+        self.model('item').setMetadata(planted, {'minerva': {'dataset_id': planted['_id']}})
+        response = self.request(path='/minerva_analysis/{}/result'.format(planted['_id']),
+                                method='POST', params=run, user=otherUser)
+        self.assertStatusOk(response)
+        response = self.request(path=path, method='GET', params=run, user=otherUser)
+        self.assertEquals(response.json['item']['_id'], str(planted['_id']))
+        response = self.request(path=path, method='GET', params=run, user=self._user)
+        self.assertEquals(response.json['item']['_id'], str(item['_id']))
+
+        # results registered by an administrator are shared with every user
+        # who can read them
+        admin = self.model('user').createUser(
+            'adminuser', 'password', 'admin', 'user',
+            'adminuser@example.com', admin=True)
+        shared = self.model('item').createItem('shared', admin, folder)
+        self.model('item').setMetadata(shared, {'minerva': {'dataset_id': shared['_id']}})
+        response = self.request(path='/minerva_analysis/{}/result'.format(shared['_id']),
+                                method='POST', params=run, user=admin)
+        self.assertStatusOk(response)
+        response = self.request(path=path, method='GET', params=run, user=self._user)
+        self.assertEquals(response.json['item']['_id'], str(shared['_id']))
+
+        # the lookup is indexed
+        indexes = resultModel.collection.index_information()
+        self.assertIn('key_1_created_-1', indexes)
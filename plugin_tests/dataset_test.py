@@ -429,7 +429,8 @@ class DatasetTestCase(base.TestCase):
         contents = json.loads(jsonContents)
         self.assertEquals(len(contents), 1, 'geocoded json should have one element')
         self.assertHasKeys(contents[0], ['location'])
-        self.assertHasKeys(contents[0]['location'], ['latitude','longitude'])
+        self.assertHasKeys(contents[0]['location'], ['type', 'coordinates', 'id', 'admin'])
+        self.assertEquals(contents[0]['location']['type'], 'Point')
 
 
 
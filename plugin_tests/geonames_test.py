@@ -17,9 +17,16 @@
 #  limitations under the License.
 ###############################################################################
 
+import BaseHTTPServer
+import contextlib
+import hashlib
+import json
 import os
-import urllib
-import mock
+import shutil
+import tempfile
+import threading
+import time
+import zipfile
 from tests import base
 
 
@@ -37,15 +44,68 @@ def tearDownModule():  # noqa
     base.stopServer()
 
 
-def download_data(url, dest, *a, **kw):
-    """Send the test dataset."""
-    pth = os.path.join(
-        os.path.dirname(__file__),
-        'data',
-        'allCountries.zip'
-    )
+_data_path = os.path.join(
+    os.path.dirname(__file__),
+    'data',
+    'allCountries.zip'
+)
 
-    open(dest, 'w').write(open(pth).read())
+
+class DataHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    """Serve the test dataset with support for range requests."""
+
+    #: Close the connection after this many bytes of the file
+    limit = None
+
+    #: The range headers of the requests received
+    ranges = []
+
+    def do_GET(self):  # noqa
+        data = open(_data_path, 'rb').read()
+        header = self.headers.getheader('Range')
+        DataHandler.ranges.append(header)
+
+        start = 0
+        if header:
+            start = int(header.split('=')[1].split('-')[0])
+            if start >= len(data):
+                self.send_response(416)
+                self.send_header(
+                    'Content-Range', 'bytes */%d' % len(data))
+                self.end_headers()
+                return
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (
+                start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+
+        end = len(data)
+        if self.limit is not None:
+            end = min(end, self.limit)
+        self.wfile.write(data[start:end])
+
+    def log_message(self, *args):
+        pass
+
+
+@contextlib.contextmanager
+def serve_data(limit=None):
+    """Serve the test dataset over http, yielding its url."""
+    DataHandler.limit = limit
+    DataHandler.ranges = []
+    server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), DataHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:%d/allCountries.zip' % server.server_port
+    finally:
+        server.shutdown()
+        server.server_close()
 
 
 class GeonamesTestCase(base.TestCase):
@@ -80,24 +140,68 @@ class GeonamesTestCase(base.TestCase):
         self.assertStatusOk(response)
         user_folder = response.json[0]
 
-        with mock.patch.object(urllib, 'urlretrieve', download_data):
+        with serve_data() as url:
             # attempt to import as a regular user
             response = self.request(
                 path='/geonames/setup',
                 method='POST',
                 params={
-                    'folder': user_folder['_id']
+                    'folder': user_folder['_id'],
+                    'url': url
                 },
                 user=self._user
             )
             self.assertStatus(response, 403)
 
+            # the pipeline needs at least one writer
+            for params in ({'workers': 'two'}, {'workers': -1},
+                           {'writers': 0}):
+                params.update(folder=user_folder['_id'], url=url)
+                response = self.request(
+                    path='/geonames/setup',
+                    method='POST',
+                    params=params,
+                    user=self._admin
+                )
+                self.assertStatus(response, 400)
+
+            # a streamed file failing its checksum discards its items and
+            # flags the import
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url,
+                    'checksum': '0' * 64,
+                    'stream': True
+                },
+                user=self._admin
+            )
+            self.assertStatus(response, 500)
+            marker = self.model('item').findOne({
+                'folderId': user_folder['_id'],
+                'name': 'geonames_import'
+            })
+            self.assertIn('Checksum mismatch', marker['meta']['error'])
+            self.assertEqual(marker['meta']['removed'], 1000)
+            self.assertNotIn('checkpoint', marker['meta'])
+            self.assertEqual(self.model('item').find({
+                'folderId': user_folder['_id'],
+                'meta.geonameid': {'$exists': True}
+            }).count(), 0)
+            self.assertIsNone(self.model('item').findOne({
+                'folderId': user_folder['_id'],
+                'name': 'geonames_done'
+            }))
+
             # import the database
             response = self.request(
                 path='/geonames/setup',
                 method='POST',
                 params={
-                    'folder': user_folder['_id']
+                    'folder': user_folder['_id'],
+                    'url': url
                 },
                 user=self._admin
             )
@@ -134,3 +238,893 @@ class GeonamesTestCase(base.TestCase):
             response.json['features'][0]['id'],
             5428978  # geonameid
         )
+
+    def test_resume(self):
+        """Test resuming a geonames import from its checkpoint."""
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+
+        items = self.model('item').find({'folderId': user_folder['_id']})
+        count = items.count()
+
+        # the checkpoint covers every row of the test dataset
+        marker = self.model('item').findOne({
+            'folderId': user_folder['_id'],
+            'name': 'geonames_import'
+        })
+        self.assertEqual(marker['meta']['checkpoint']['offset'], 1000)
+        self.assertEqual(marker['meta'].get('quarantined', 0), 0)
+
+        # the completion marker reports the parse throughput
+        done = self.model('item').findOne({
+            'folderId': user_folder['_id'],
+            'name': 'geonames_done'
+        })
+        self.assertEqual(done['meta']['rows'], 1000)
+        self.assertGreater(done['meta']['parse_rows_per_second'], 0)
+
+        # resuming a finished import doesn't insert anything but a new
+        # completion marker
+        response = self.request(
+            path='/geonames/setup',
+            method='POST',
+            params={
+                'folder': user_folder['_id'],
+                'resume': True
+            },
+            user=self._admin
+        )
+        self.assertStatusOk(response)
+
+        items = self.model('item').find({'folderId': user_folder['_id']})
+        self.assertEqual(items.count(), count + 1)
+
+        # rows after the checkpoint that were written before the import
+        # stopped aren't written twice
+        with zipfile.ZipFile(_data_path) as z:
+            lines = [line for line in
+                     z.read('allCountries.txt').splitlines() if line]
+        marker = self.model('item').findOne({
+            'folderId': user_folder['_id'],
+            'name': 'geonames_import'
+        }, sort=[('created', -1)])
+        self.model('item').update({'_id': marker['_id']}, {'$set': {
+            'meta.checkpoint.offset': 500,
+            'meta.checkpoint.geonameid': int(lines[499].split('\t')[0])
+        }})
+        response = self.request(
+            path='/geonames/setup',
+            method='POST',
+            params={
+                'folder': user_folder['_id'],
+                'resume': True
+            },
+            user=self._admin
+        )
+        self.assertStatusOk(response)
+
+        items = self.model('item').find({'folderId': user_folder['_id']})
+        self.assertEqual(items.count(), count + 2)
+        marker = self.model('item').findOne({'_id': marker['_id']})
+        self.assertEqual(marker['meta']['checkpoint']['offset'], 1000)
+        self.assertEqual(marker['meta']['checkpoint']['geonameid'],
+                         int(lines[999].split('\t')[0]))
+
+        # a checkpoint that doesn't match the file fails the resume
+        self.model('item').update({'_id': marker['_id']}, {'$set': {
+            'meta.checkpoint.offset': 500,
+            'meta.checkpoint.geonameid': int(lines[500].split('\t')[0])
+        }})
+        response = self.request(
+            path='/geonames/setup',
+            method='POST',
+            params={
+                'folder': user_folder['_id'],
+                'resume': True
+            },
+            user=self._admin
+        )
+        self.assertStatus(response, 500)
+        self.assertIn('the file changed', response.json['message'])
+        items = self.model('item').find({'folderId': user_folder['_id']})
+        self.assertEqual(items.count(), count + 2)
+
+        # importing again into the populated folder replaces its places
+        # instead of rejecting each one as a duplicate
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+        items = self.model('item').find({'folderId': user_folder['_id']})
+        self.assertEqual(items.count(), count + 4)
+        marker = self.model('item').findOne({
+            'folderId': user_folder['_id'],
+            'name': 'geonames_import'
+        }, sort=[('created', -1)])
+        self.assertEqual(marker['meta'].get('quarantined', 0), 0)
+
+    def test_update(self):
+        """Test applying geonames modification and delete files."""
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+
+        def geonames(geonameid):
+            return list(self.model('item').find({
+                'folderId': user_folder['_id'],
+                'meta.geonameid': geonameid
+            }))
+
+        original = geonames(4231329)
+        self.assertEqual(len(original), 1)
+        count = self.model('item').find({
+            'folderId': user_folder['_id']
+        }).count()
+
+        tmpdir = tempfile.mkdtemp()
+        try:
+            # rename one place, add a new one and delete another
+            modifications = os.path.join(
+                tmpdir, 'modifications-2016-01-01.txt')
+            with open(modifications, 'w') as f:
+                f.write(
+                    '4231329\tWillow Creek\tWillow Creek\t\t32.49098\t'
+                    '-83.64574\tP\tPPL\tUS\t\tGA\t153\t\t\t0\t100\t'
+                    '106\tAmerica/New_York\t2016-01-01\n'
+                    '99999999\tNew Place\tNew Place\t\t10.5\t20.5\tP\t'
+                    'PPL\tUS\t\tGA\t153\t\t\t100\t\t10\t'
+                    'America/New_York\t2016-01-01\n'
+                )
+            deletes = os.path.join(tmpdir, 'deletes-2016-01-01.txt')
+            with open(deletes, 'w') as f:
+                f.write('2062319\tRocky Dump Well\tduplicate\n')
+
+            # missing files are rejected
+            response = self.request(
+                path='/geonames/update',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'deletes': os.path.join(tmpdir, 'missing.txt')
+                },
+                user=self._admin
+            )
+            self.assertStatus(response, 400)
+
+            response = self.request(
+                path='/geonames/update',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'modifications': modifications,
+                    'deletes': deletes
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+            self.assertEqual(response.json['deleted'], 1)
+        finally:
+            shutil.rmtree(tmpdir)
+
+        updated = geonames(4231329)
+        self.assertEqual(len(updated), 1)
+        self.assertEqual(updated[0]['_id'], original[0]['_id'])
+        self.assertEqual(updated[0]['name'], 'Willow Creek')
+        self.assertEqual(updated[0]['created'], original[0]['created'])
+
+        added = geonames(99999999)
+        self.assertEqual(len(added), 1)
+        self.assertEqual(added[0]['geo']['geometry']['coordinates'],
+                         [20.5, 10.5])
+        self.assertEqual(geonames(2062319), [])
+
+        # one added, one deleted and the update marker item
+        self.assertEqual(self.model('item').find({
+            'folderId': user_folder['_id']
+        }).count(), count + 1)
+
+    def test_index(self):
+        """Test building and reporting the geonames indexes."""
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+
+        response = self.request(
+            path='/geonames/index',
+            method='POST',
+            params={
+                'folder': user_folder['_id']
+            },
+            user=self._user
+        )
+        self.assertStatus(response, 403)
+
+        response = self.request(
+            path='/geonames/index',
+            method='POST',
+            params={
+                'folder': user_folder['_id']
+            },
+            user=self._admin
+        )
+        self.assertStatusOk(response)
+
+        existing = self.model('item').collection.index_information()
+        names = [report['name'] for report in response.json]
+        for name in ('geonames_geonameid', 'geonames_geo',
+                     'geonames_asciiname', 'geonames_alternatenames',
+                     'geonames_names'):
+            matching = [n for n in names if n.startswith(name)]
+            self.assertEqual(len(matching), 1)
+            self.assertIn(matching[0], existing)
+
+        # the geonameid index of a folder is unique where it can be
+        for report in response.json:
+            if report['name'].startswith('geonames_geonameid'):
+                self.assertEqual(
+                    existing[report['name']].get('unique', False),
+                    report['partial'])
+
+        # girder's text index is reported but not replaced
+        text = [report for report in response.json
+                if report['seconds'] is None]
+        self.assertEqual(len(text), 1)
+        for report in response.json:
+            self.assertIn('size', report)
+
+    def test_collection_storage(self):
+        """Test migrating geonames items to the geonames collection."""
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+
+        query = {
+            'folderId': user_folder['_id'],
+            'meta.geonameid': {'$exists': True}
+        }
+        count = self.model('item').find(query).count()
+
+        response = self.request(
+            path='/geonames/migrate',
+            method='POST',
+            params={
+                'folder': user_folder['_id'],
+                'remove': True
+            },
+            user=self._admin
+        )
+        self.assertStatusOk(response)
+        self.assertEqual(response.json['migrated'], count)
+        self.assertEqual(response.json['failed'], [])
+        self.assertEqual(self.model('item').find(query).count(), 0)
+        self.assertEqual(
+            self.model('geonames', 'minerva').find().count(), count)
+
+        # only known storage layouts are accepted
+        response = self.request(
+            path='/system/setting',
+            method='PUT',
+            params={
+                'key': 'minerva.geonames_storage',
+                'value': 'files'
+            },
+            user=self._admin
+        )
+        self.assertStatus(response, 400)
+
+        response = self.request(
+            path='/system/setting',
+            method='PUT',
+            params={
+                'key': 'minerva.geonames_storage',
+                'value': 'collection'
+            },
+            user=self._admin
+        )
+        self.assertStatusOk(response)
+
+        response = self.request(
+            path='/geonames/geocode',
+            params={
+                'name': '"Little Sheep Mountain"'
+            },
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        self.assertEqual(len(response.json['features']), 1)
+        self.assertEqual(response.json['features'][0]['id'], 5428978)
+        self.assertEqual(
+            response.json['features'][0]['properties']['names'],
+            ['little sheep mountain']
+        )
+
+    def test_gazetteer(self):
+        """Test geocoding from the in memory gazetteer."""
+        from girder.plugins.minerva.geonames import gazetteer
+
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+
+        self.model('setting').set(
+            'minerva.geonames_folder', user_folder['_id'])
+        self.model('setting').set('minerva.geonames_index', True)
+
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+
+        # wait for the background rebuild
+        count = 0
+        while (gazetteer.current() is None or
+               gazetteer.building()) and count < 10:
+            time.sleep(1)
+            count += 1
+        self.assertEqual(len(gazetteer.current()), 1000)
+
+        # prefixes match, ranked by population and feature code
+        response = self.request(
+            path='/geonames/geocode',
+            params={
+                'name': 'little sheep',
+                'limit': 5
+            },
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        self.assertEqual(
+            response.json['features'][0]['id'],
+            5428978  # geonameid
+        )
+        scores = [feature['properties']['score']
+                  for feature in response.json['features']]
+        self.assertEqual(scores, sorted(scores, reverse=True))
+
+        index = gazetteer.Gazetteer([{
+            'geonameid': 1,
+            'name': u'Springfield',
+            'names': [u'springfield'],
+            'longitude': 0.0,
+            'latitude': 0.0,
+            'population': 100,
+            'feature_class': 'P',
+            'feature_code': 'PPL',
+            'country_code': 'US'
+        }, {
+            'geonameid': 2,
+            'name': u'Springfield',
+            'names': [u'springfield', u'capital'],
+            'longitude': 1.0,
+            'latitude': 1.0,
+            'population': 100000,
+            'feature_class': 'P',
+            'feature_code': 'PPLA',
+            'country_code': 'US'
+        }])
+        self.assertEqual(
+            [f['id'] for f in index.geocode('Spring')], [2, 1])
+        self.assertEqual([f['id'] for f in index.geocode('cap')], [2])
+        self.assertEqual(index.geocode('nowhere'), [])
+
+        # short prefixes are cached once whatever the limit
+        self.assertEqual(index.search('s', limit=1), [1])
+        self.assertEqual(index.search('s', limit=5), [1, 0])
+        self.assertEqual(index._cache.keys(), [('s', False, None)])
+
+        # and the least recently used are dropped first
+        cached_searches = gazetteer._cached_searches
+        gazetteer._cached_searches = 2
+        try:
+            index.search('c')
+            index.search('s')
+            index.search('x')
+        finally:
+            gazetteer._cached_searches = cached_searches
+        self.assertEqual(index._cache.keys(),
+                         [('s', False, None), ('x', False, None)])
+
+        self.assertRaises(ValueError, index.search, 's', limit=0)
+        for limit in (0, -1, 'many'):
+            response = self.request(
+                path='/geonames/geocode',
+                params={
+                    'name': 'little sheep',
+                    'limit': limit
+                },
+                user=self._user
+            )
+            self.assertStatus(response, 400)
+
+    def test_dump(self):
+        """Test writing and loading sharded columnar geonames dumps."""
+        from girder.plugins.minerva.geonames import (
+            dump_data, gazetteer, import_data
+        )
+
+        pth = os.path.join(
+            os.path.dirname(__file__),
+            'data',
+            'allCountries.zip'
+        )
+        expected = []
+        for chunk in import_data.read_table(pth, 300):
+            expected.extend(import_data.clean_chunk(chunk))
+
+        tmp = tempfile.mkdtemp()
+        try:
+            manifest = dump_data.dump_geonames(
+                chunksize=300, path=tmp, format='npz', file_name=pth,
+                compress=True)
+            self.assertEqual(manifest['rows'], 1000)
+            self.assertEqual(
+                [shard['rows'] for shard in manifest['shards']],
+                [300, 300, 300, 100])
+            self.assertEqual(dump_data.read_manifest(tmp), manifest)
+            self.assertEqual(
+                [os.path.basename(f) for f in dump_data.dump_files(tmp)],
+                ['geonames_%05i.npz.gz' % i for i in xrange(4)])
+
+            for workers in (0, 2):
+                features = []
+                for chunk in dump_data.load_geonames(
+                        tmp, verify=True, workers=workers):
+                    features.extend(chunk)
+                self.assertEqual(features, expected)
+
+            dumped = gazetteer.Gazetteer(gazetteer.places_from_dump(tmp))
+            self.assertEqual(len(dumped), 1000)
+            self.assertEqual(dumped.geocode('little sheep')[0]['id'],
+                             5428978)
+
+            # a corrupted shard fails verification
+            with open(dump_data.dump_files(tmp)[1], 'ab') as f:
+                f.write('x')
+            with self.assertRaises(ValueError):
+                list(dump_data.load_geonames(tmp, verify=True))
+
+            with self.assertRaises(ValueError):
+                dump_data.dump_geonames(path=tmp, format='csv')
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_pipeline(self):
+        """Test the import pipeline with worker processes and writers."""
+        from girder.plugins.minerva.geonames import import_data
+
+        with zipfile.ZipFile(_data_path) as z:
+            lines = [line for line in
+                     z.read('allCountries.txt').splitlines() if line]
+
+        # later chunks are exported first, but still committed in order
+        exported = []
+        checkpoints = []
+
+        def handler(features, folder, user):
+            time.sleep(0.01 * (10 - len(exported) % 10))
+            exported.extend(f['properties']['geonameid'] for f in features)
+
+        rows, rate = import_data.read_geonames(
+            file_name=_data_path, chunksize=100, handler=handler,
+            checkpoint=lambda rows, geonameid: checkpoints.append(
+                (rows, geonameid)),
+            progress=lambda *a: None, done=lambda: None,
+            workers=2, writers=3, depth=2)
+
+        self.assertEqual(rows, 1000)
+        self.assertGreater(rate, 0)
+        self.assertEqual(checkpoints, [
+            (offset, int(lines[offset - 1].split('\t')[0]))
+            for offset in xrange(100, 1001, 100)])
+        self.assertEqual(len(set(exported)), len(exported))
+
+        # a chunk is committed once it and every chunk before it were
+        # exported, and the offset skips part of the first chunk
+        exportedChunks = set()
+        commits = []
+
+        def export(features):
+            time.sleep(0.01 * (10 - len(exportedChunks) % 10))
+            exportedChunks.add(features[0]['properties']['geonameid'])
+
+        def commit(rows, count, features, seconds):
+            self.assertIn(features[0]['properties']['geonameid'],
+                          exportedChunks)
+            commits.append((rows, count))
+
+        import_data.pipeline(
+            import_data._skip_rows(
+                import_data.read_table(_data_path, 100), 250),
+            export, commit, workers=2, writers=3, depth=2)
+        self.assertEqual(commits, [(300, 50)] + [
+            (offset, 100) for offset in xrange(400, 1001, 100)])
+
+    def test_download(self):
+        """Test resuming, verifying and streaming the geonames download."""
+        from girder.plugins.minerva.geonames import import_data
+
+        data = open(_data_path, 'rb').read()
+        checksum = hashlib.sha256(data).hexdigest()
+        half = len(data) // 2
+        quiet = {'progress': lambda *a: None, 'done': lambda: None}
+        tmp = tempfile.mkdtemp()
+        dest = os.path.join(tmp, 'allCountries.zip')
+        try:
+            # an interrupted download leaves a partial file
+            with serve_data(limit=half) as url:
+                with self.assertRaises(IOError):
+                    import_data.download_all_countries(dest, url, **quiet)
+            self.assertEqual(os.path.getsize(dest + '.part'), half)
+
+            # which is resumed with a range request
+            with serve_data() as url:
+                import_data.download_all_countries(
+                    dest, url, checksum=checksum, **quiet)
+                self.assertEqual(DataHandler.ranges, ['bytes=%d-' % half])
+            self.assertEqual(open(dest, 'rb').read(), data)
+            self.assertFalse(os.path.exists(dest + '.part'))
+
+            # a bad checksum discards the download
+            with serve_data() as url:
+                with self.assertRaises(ValueError):
+                    import_data.download_all_countries(
+                        dest, url, checksum='0' * 64, **quiet)
+            self.assertFalse(os.path.exists(dest + '.part'))
+
+            # rows are parsed while the file downloads
+            expected = []
+            for chunk in import_data.read_table(_data_path, 300):
+                expected.extend(import_data.clean_chunk(chunk))
+
+            os.remove(dest)
+            with serve_data() as url:
+                stream = import_data.stream_all_countries(
+                    dest, url=url, checksum=checksum, **quiet)
+                features = []
+                try:
+                    for chunk in import_data.read_table(stream, 300):
+                        features.extend(import_data.clean_chunk(chunk))
+                finally:
+                    stream.close()
+            self.assertEqual(features, expected)
+            self.assertEqual(open(dest, 'rb').read(), data)
+
+            # a streamed file is only verified once its rows were read
+            os.remove(dest)
+            with serve_data() as url:
+                stream = import_data.stream_all_countries(
+                    dest, url=url, checksum='0' * 64, **quiet)
+                self.assertEqual(
+                    len(list(import_data.read_table(stream, 300))), 4)
+                with self.assertRaises(import_data.ChecksumError):
+                    stream.close()
+            self.assertFalse(os.path.exists(dest))
+            self.assertFalse(os.path.exists(dest + '.part'))
+        finally:
+            shutil.rmtree(tmp)
+
+    def test_reverse(self):
+        """Test reverse geocoding from mongo and from the gazetteer."""
+        from girder.plugins.minerva.geonames import gazetteer
+
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+        self.model('setting').set(
+            'minerva.geonames_folder', user_folder['_id'])
+
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+
+        # little sheep mountain and a point in the ocean
+        points = [[-105.21111, 37.72056], [-30.0, 0.0]]
+
+        response = self.request(
+            path='/geonames/reverse',
+            params={
+                'lon': points[0][0],
+                'lat': points[0][1],
+                'limit': 3
+            }
+        )
+        self.assertStatusOk(response)
+        nearest = response.json['results'][0]
+        self.assertEqual(len(nearest), 3)
+        self.assertEqual(nearest[0]['id'], 5428978)
+        self.assertLess(nearest[0]['distance'], 1)
+        distances = [place['distance'] for place in nearest]
+        self.assertEqual(distances, sorted(distances))
+
+        response = self.request(
+            path='/geonames/reverse',
+            method='POST',
+            params={
+                'featureClass': 'P',
+                'limit': 2
+            },
+            body=json.dumps({'points': points}),
+            type='application/json'
+        )
+        self.assertStatusOk(response)
+        from_mongo = response.json['results']
+        self.assertEqual(len(from_mongo), 2)
+        for nearest in from_mongo:
+            self.assertEqual(len(nearest), 2)
+            for place in nearest:
+                self.assertEqual(place['feature class'], 'P')
+
+        response = self.request(
+            path='/geonames/reverse',
+            method='POST',
+            body=json.dumps({'points': [[1, 2, 3]]}),
+            type='application/json'
+        )
+        self.assertStatus(response, 400)
+
+        for minPopulation in ('many', -1):
+            response = self.request(
+                path='/geonames/reverse',
+                params={
+                    'lon': points[0][0],
+                    'lat': points[0][1],
+                    'minPopulation': minPopulation
+                }
+            )
+            self.assertStatus(response, 400)
+            self.assertIn('minPopulation', response.json['message'])
+
+        # without the gazetteer each point takes a query, so fewer are taken
+        response = self.request(
+            path='/geonames/reverse',
+            method='POST',
+            body=json.dumps({'points': points * 51}),
+            type='application/json'
+        )
+        self.assertStatus(response, 400)
+        self.assertIn('without the gazetteer', response.json['message'])
+
+        # the gazetteer returns the same places
+        self.model('setting').set('minerva.geonames_index', True)
+        gazetteer.rebuild(
+            lambda: gazetteer.places_from_items(
+                self.model('item').collection, user_folder['_id']),
+            background=False
+        )
+        response = self.request(
+            path='/geonames/reverse',
+            method='POST',
+            params={
+                'featureClass': 'P',
+                'limit': 2
+            },
+            body=json.dumps({'points': points}),
+            type='application/json'
+        )
+        self.assertStatusOk(response)
+        results = response.json['results']
+        self.assertEqual(
+            [[place['id'] for place in nearest] for nearest in results],
+            [[place['id'] for place in nearest] for nearest in from_mongo]
+        )
+
+    def test_batch_geocode(self):
+        """Test geocoding a list of names."""
+        from girder.plugins.minerva.geonames import gazetteer
+
+        params = {
+            'parentType': 'user',
+            'parentId': self._user['_id'],
+            'text': 'public'
+        }
+        response = self.request(
+            path='/folder',
+            method='GET',
+            params=params,
+            user=self._user
+        )
+        self.assertStatusOk(response)
+        user_folder = response.json[0]
+        self.model('setting').set(
+            'minerva.geonames_folder', user_folder['_id'])
+
+        with serve_data() as url:
+            response = self.request(
+                path='/geonames/setup',
+                method='POST',
+                params={
+                    'folder': user_folder['_id'],
+                    'url': url
+                },
+                user=self._admin
+            )
+            self.assertStatusOk(response)
+
+        # items imported before the normalized names were stored get them
+        # when migrated
+        query = {
+            'folderId': user_folder['_id'],
+            'meta.geonameid': 5126430
+        }
+        self.model('item').update(query, {'$unset': {'meta.names': ''}})
+        response = self.request(
+            path='/geonames/migrate',
+            method='POST',
+            params={'folder': user_folder['_id']},
+            user=self._admin
+        )
+        self.assertStatusOk(response)
+        self.assertEqual(self.model('item').findOne(query)['meta']['names'],
+                         ['mcmiller corners'])
+
+        # names match whatever their case, punctuation or accents
+        body = json.dumps({
+            'names': ['Little Sheep Mountain', 'little sheep mountain',
+                      'Nowhere', 'Willow Run', 'MCMILLER CORNERS',
+                      u'Sh\u014dnai-Oguni gawa',
+                      "austin's flat indian reserve 3"],
+            'countries': [None, 'us', None, 'CA', None, 'JP', None]
+        })
+
+        def geocode():
+            response = self.request(
+                path='/geonames/geocode',
+                method='POST',
+                params={'limit': 1},
+                body=body,
+                type='application/json',
+                isJson=False
+            )
+            self.assertStatusOk(response)
+            return json.loads(self.getBody(response))['results']
+
+        def ids(results):
+            return [
+                [feature['id'] for feature in result['features']]
+                for result in results
+            ]
+
+        expected = [[5428978], [5428978], [], [], [5126430], [1854610],
+                    [5888430]]
+        from_mongo = geocode()
+        self.assertEqual(ids(from_mongo), expected)
+        properties = from_mongo[0]['features'][0]['properties']
+        self.assertEqual(properties['names'], ['little sheep mountain'])
+        self.assertEqual(properties['country code'], 'US')
+        self.assertIsInstance(properties['population'], int)
+
+        # the gazetteer returns the same features, properties included
+        self.model('setting').set('minerva.geonames_index', True)
+        gazetteer.rebuild(
+            lambda: gazetteer.places_from_items(
+                self.model('item').collection, user_folder['_id']),
+            background=False
+        )
+        self.assertEqual(geocode(), from_mongo)
+
+        response = self.request(
+            path='/geonames/geocode',
+            method='POST',
+            body=json.dumps({'names': ['a'], 'countries': []}),
+            type='application/json'
+        )
+        self.assertStatus(response, 400)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy as np
+from netCDF4 import Dataset
+
+from tests import base
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                             '../utility')))
+import benchmark_nex  # noqa
+
+
+def setUpModule():  # noqa
+    """Enable the minerva plugin and start the server."""
+    base.enabledPlugins.append('minerva')
+    base.startServer()
+
+
+def tearDownModule():  # noqa
+    """Stop the server."""
+    base.stopServer()
+
+
+class StreamedRDD(benchmark_nex.SerialRDD):
+
+    """A serial RDD that can only be read back one item at a time."""
+
+    def map(self, func):
+        return StreamedRDD([func(item) for item in self._items])
+
+    def collect(self):
+        raise AssertionError('The results should be streamed to the driver')
+
+
+class StreamedContext(benchmark_nex.SerialContext):
+
+    def parallelize(self, items, partitions=None):
+        return StreamedRDD(list(items))
+
+
+def makeCube(path, values, dtype):
+    """Write a (time, lat, lon) cube of values on a 1 degree grid."""
+    timesteps, lats, lons = values.shape
+    data = Dataset(path, 'w')
+    data.createDimension('time', None)
+    data.createDimension('lat', lats)
+    data.createDimension('lon', lons)
+    data.createVariable('time', 'f8', ('time',))[:] = np.arange(timesteps)
+    data.createVariable('lat', 'f8', ('lat',))[:] = np.arange(lats) + 0.5
+    data.createVariable('lon', 'f8', ('lon',))[:] = np.arange(lons) + 0.5
+    data.createVariable('pr', dtype, ('time', 'lat', 'lon'))[:] = values
+    data.close()
+
+
+class MeanContourKernelTestCase(base.TestCase):
+
+    """Tests of the mean contour kernel run with a serial spark stand-in."""
+
+    def setUp(self):
+        super(MeanContourKernelTestCase, self).setUp()
+        self.tmp = tempfile.mkdtemp()
+        self.kernels = benchmark_nex.load_kernels(benchmark_nex._mean_contour,
+                                                  StreamedContext())
+        random = np.random.RandomState(0)
+        self.values = random.rand(6, 12, 15) * 100
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+        super(MeanContourKernelTestCase, self).tearDown()
+
+    def mean(self, dtype, **kwargs):
+        source = os.path.join(self.tmp, 'source.nc')
+        makeCube(source, self.values.astype(dtype), dtype)
+        output = self.kernels['netcdf_mean'](
+            source, 'pr', 4, 3, os.path.join(self.tmp, 'mean.nc'), **kwargs)
+        output.close()
+        return Dataset(os.path.join(self.tmp, 'mean.nc'))
+
+    def testMean(self):
+        """Test the means written chunk by chunk and their compression."""
+        output = self.mean('f4')
+        variable = output.variables['pr']
+        self.assertEqual(variable.dtype, np.dtype('f4'))
+        self.assertEqual(variable.shape, (1, 12, 15))
+        self.assertTrue(np.allclose(
+            variable[0], self.values.astype('f4').mean(axis=0), atol=1e-4))
+        # chunked on the grid of the computation, compressed and shuffled
+        self.assertEqual(variable.chunking(), [1, 4, 4])
+        filters = variable.filters()
+        self.assertTrue(filters['zlib'])
+        self.assertTrue(filters['shuffle'])
+        # the coordinates of the grid are copied
+        self.assertTrue(np.array_equal(output.variables['lon'][:],
+                                       np.arange(15) + 0.5))
+        output.close()
+
+    def testMeanSubset(self):
+        """Test the means of a bounding box and time range."""
+        output = self.mean('f8', bbox=(2.2, 3.2, 6.8, 5.8), time_range=(1, 4))
+        variable = output.variables['pr']
+        self.assertEqual(variable.shape, (1, 3, 5))
+        self.assertTrue(np.allclose(
+            variable[0], self.values[1:4, 3:6, 2:7].mean(axis=0)))
+        self.assertEqual(output.variables['lat'][0], 3.5)
+        self.assertEqual(output.variables['lon'][0], 2.5)
+        self.assertEqual(variable.chunking(), [1, 3, 4])
+        output.close()
+
+    def testMeanOfIntegers(self):
+        """Test the means of integers are floating point."""
+        output = self.mean('i2')
+        variable = output.variables['pr']
+        self.assertEqual(variable.dtype, np.dtype('f8'))
+        self.assertTrue(np.allclose(
+            variable[0], self.values.astype('i2').mean(axis=0)))
+        output.close()
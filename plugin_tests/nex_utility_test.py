@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import fcntl
+import imp
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from tests import base
+
+# the analysis scripts can't import the module, load it from its path
+nex_utility = imp.load_source('nex_utility', os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'analyses', 'NEX', 'nex_utility.py'))
+
+
+def setUpModule():  # noqa
+    """Enable the minerva plugin and start the server."""
+    base.enabledPlugins.append('minerva')
+    base.startServer()
+
+
+def tearDownModule():  # noqa
+    """Stop the server."""
+    base.stopServer()
+
+
+class Client(object):
+
+    """A girder client downloading files of a given size, logging each."""
+
+    def __init__(self, log):
+        self.log = log
+
+    def downloadFile(self, file_id, path):
+        with open(self.log, 'a') as log:
+            log.write('%s\n' % file_id)
+        with open(path, 'w') as f:
+            f.write('x' * 100)
+
+
+class Grid(object):
+
+    """The dimensions and coordinate variables of a netCDF grid."""
+
+    def __init__(self, lats, lons, lat_name='lat', lon_name='lon'):
+        self.dimensions = ['time', lat_name, lon_name]
+        self.variables = {lat_name: np.array(lats), lon_name: np.array(lons)}
+
+
+def fileResource(file_id):
+    return {'_id': file_id, 'name': '%s.nc' % file_id, 'size': 100}
+
+
+def useCachedFile(args):
+    """Open a cached file from another process, returning its content."""
+    cache_dir, log, file_id = args
+    with nex_utility.cached_file(Client(log), fileResource(file_id),
+                                 cache_dir, 1000) as path:
+        with open(path) as f:
+            return f.read()
+
+
+class NexUtilityTestCase(base.TestCase):
+
+    """Tests of the helpers shared by the NEX analyses."""
+
+    def setUp(self):
+        super(NexUtilityTestCase, self).setUp()
+        self.cache_dir = tempfile.mkdtemp()
+        self.log = os.path.join(tempfile.mkdtemp(), 'downloads')
+        self.client = Client(self.log)
+
+    def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        shutil.rmtree(os.path.dirname(self.log))
+        super(NexUtilityTestCase, self).tearDown()
+
+    def downloads(self):
+        if not os.path.exists(self.log):
+            return []
+        with open(self.log) as log:
+            return log.read().split()
+
+    def testCachedFile(self):
+        """Test downloads are cached and evicted least recently used."""
+        with nex_utility.cached_file(self.client, fileResource('a'),
+                                     self.cache_dir, 250) as path:
+            self.assertEqual(os.path.getsize(path), 100)
+        with nex_utility.cached_file(self.client, fileResource('a'),
+                                     self.cache_dir, 250) as path:
+            pass
+        self.assertEqual(self.downloads(), ['a'])
+
+        # an entry in use isn't evicted, the least recently used one is
+        with nex_utility.cached_file(self.client, fileResource('b'),
+                                     self.cache_dir, 250) as b:
+            os.utime(b, (0, 0))
+            with nex_utility.cached_file(self.client, fileResource('c'),
+                                         self.cache_dir, 250):
+                pass
+            with nex_utility.cached_file(self.client, fileResource('d'),
+                                         self.cache_dir, 250):
+                pass
+            self.assertTrue(os.path.exists(b))
+        self.assertFalse(os.path.exists(path))
+        # the lock files of evicted entries are removed with them
+        self.assertFalse(os.path.exists(path + '.lock'))
+
+        # the lock file of a failed download is removed on eviction
+        orphan = os.path.join(self.cache_dir, 'e_size100.nc.lock')
+        open(orphan, 'w').close()
+        with nex_utility.cached_file(self.client, fileResource('a'),
+                                     self.cache_dir, 250):
+            pass
+        self.assertFalse(os.path.exists(orphan))
+        self.assertEqual(sorted(name for name in os.listdir(self.cache_dir)
+                                if not name.endswith('.lock')),
+                         ['a_size100.nc', 'd_size100.nc'])
+
+        # a lock file removed while waiting for it is locked again
+        lock_path = os.path.join(self.cache_dir, 'f.lock')
+        held = open(lock_path, 'a')
+        fcntl.flock(held, fcntl.LOCK_EX)
+        locked = []
+        waiter = threading.Thread(target=lambda: locked.append(
+            nex_utility._lock_entry(lock_path, fcntl.LOCK_EX)))
+        waiter.start()
+        time.sleep(0.5)
+        os.remove(lock_path)
+        fcntl.flock(held, fcntl.LOCK_UN)
+        waiter.join()
+        self.assertNotEqual(os.fstat(locked[0].fileno()).st_ino,
+                            os.fstat(held.fileno()).st_ino)
+        self.assertEqual(os.fstat(locked[0].fileno()).st_ino,
+                         os.stat(lock_path).st_ino)
+        locked[0].close()
+        held.close()
+
+    def testConcurrentCachedFile(self):
+        """Test concurrent tasks download each file once."""
+        pool = multiprocessing.Pool(4)
+        try:
+            tasks = [(self.cache_dir, self.log, file_id)
+                     for file_id in 'abcdefgh' * 4]
+            contents = pool.map(useCachedFile, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+        self.assertEqual(contents, ['x' * 100] * len(tasks))
+        # every file fits in the cache, so each is downloaded once
+        self.assertEqual(sorted(self.downloads()), list('abcdefgh'))
+        self.assertLessEqual(
+            sum(os.path.getsize(os.path.join(self.cache_dir, name))
+                for name in os.listdir(self.cache_dir)
+                if name.endswith('.nc')), 1000)
+
+    def testGridSpacing(self):
+        """Test the spacing of a grid, with axes of a single cell."""
+        self.assertEqual(nex_utility.grid_spacing(
+            Grid([-89.5, -88.5, -87.5], [0.25, 0.5])), (0.25, 1.0))
+        self.assertEqual(nex_utility.grid_spacing(
+            Grid([10.0], [0.25, 0.5])), (0.25, 0.0))
+        self.assertEqual(nex_utility.grid_dimensions(
+            Grid([0], [0], 'latitude', 'longitude')),
+            ('latitude', 'longitude'))
+
+    def testParseBbox(self):
+        """Test parsing bounding boxes from strings and lists."""
+        self.assertIsNone(nex_utility.parse_bbox(None))
+        self.assertIsNone(nex_utility.parse_bbox(''))
+        self.assertEqual(nex_utility.parse_bbox('-10,20,30.5,40'),
+                         (-10.0, 20.0, 30.5, 40.0))
+        self.assertEqual(nex_utility.parse_bbox([1, 2, 3, 4]),
+                         (1.0, 2.0, 3.0, 4.0))
+        # south of north, too few values and values that aren't numbers
+        for bbox in ('0,40,10,20', '0,10,20', '0,a,10,20'):
+            self.assertRaises(Exception, nex_utility.parse_bbox, bbox)
+
+    def testGridSubset(self):
+        """Test the slices of the grid cells within a bounding box."""
+        # a 1 degree grid of cell centers, longitudes in [0, 360)
+        grid = Grid(np.arange(-89.5, 90), np.arange(0.5, 360))
+
+        self.assertEqual(nex_utility.grid_subset(grid, None),
+                         (slice(0, 180), slice(0, 360)))
+
+        # cells overlapping the box, with its longitudes wrapped
+        lat_slice, lon_slice = nex_utility.grid_subset(
+            grid, (-100, 10, -90, 20))
+        self.assertEqual((lat_slice, lon_slice),
+                         (slice(99, 111), slice(259, 271)))
+        self.assertEqual(grid.variables['lon'][lon_slice.start], 259.5)
+        self.assertEqual(grid.variables['lat'][lat_slice.start], 9.5)
+
+        # a point selects the single cell it falls in
+        lat_slice, lon_slice = nex_utility.grid_subset(
+            grid, (10.2, 45.2, 10.2, 45.2))
+        self.assertEqual((lat_slice, lon_slice),
+                         (slice(135, 136), slice(10, 11)))
+        self.assertEqual(grid.variables['lon'][lon_slice.start], 10.5)
+        self.assertEqual(grid.variables['lat'][lat_slice.start], 45.5)
+
+        # a box across the seam of the grid falls back to every longitude
+        self.assertEqual(nex_utility.grid_subset(grid, (-10, 0, 10, 1))[1],
+                         slice(0, 360))
+
+        # a box off the grid
+        small = Grid([10.5, 11.5], [20.5, 21.5])
+        self.assertRaises(Exception, nex_utility.grid_subset, small,
+                          (0, 50, 1, 60))
+
+    def testTimeRange(self):
+        """Test parsing time ranges and clamping them to the timesteps."""
+        self.assertIsNone(nex_utility.parse_time_range(None))
+        self.assertEqual(nex_utility.parse_time_range('2,5'), (2, 5))
+        self.assertEqual(nex_utility.parse_time_range(',5'), (None, 5))
+        self.assertEqual(nex_utility.parse_time_range([3, '']), (3, None))
+        for time_range in ('5,2', '3,3', '1,2,3', 'a,2'):
+            self.assertRaises(Exception, nex_utility.parse_time_range,
+                              time_range)
+
+        self.assertEqual(nex_utility.timestep_range(None, 10), (0, 10))
+        self.assertEqual(nex_utility.timestep_range((None, 20), 10), (0, 10))
+        self.assertEqual(nex_utility.timestep_range((-2, 4), 10), (0, 4))
+        self.assertRaises(Exception, nex_utility.timestep_range, (10, None),
+                          10)
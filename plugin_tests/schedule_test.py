@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import threading
+import time
+
+from tests import base
+
+
+def setUpModule():  # noqa
+    """Enable the minerva plugin and start the server."""
+    base.enabledPlugins.append('jobs')
+    base.enabledPlugins.append('romanesco')
+    base.enabledPlugins.append('gravatar')
+    base.enabledPlugins.append('minerva')
+    base.startServer()
+
+
+def tearDownModule():  # noqa
+    """Stop the server."""
+    base.stopServer()
+
+
+class DelayedCallsTestCase(base.TestCase):
+
+    """Tests of the calls delayed on a single timer thread."""
+
+    def testDelayedCalls(self):
+        """Test calls run in order of their delay on one thread."""
+        from girder.plugins.minerva.utility.schedule_utility import \
+            DelayedCalls
+
+        delayedCalls = DelayedCalls()
+        calls = []
+        done = threading.Event()
+
+        def call(name):
+            calls.append((name, threading.current_thread().name))
+            if len(calls) == 3:
+                done.set()
+
+        def fail():
+            raise Exception('failed on purpose')
+
+        start = time.time()
+        delayedCalls.callLater(0.4, call, 'last')
+        delayedCalls.callLater(0.1, fail)
+        delayedCalls.callLater(0.2, call, 'second')
+        delayedCalls.callLater(0.0, call, 'first')
+        self.assertTrue(done.wait(5))
+
+        # the failed call is logged and doesn't stop the others
+        self.assertEqual([name for name, _ in calls],
+                         ['first', 'second', 'last'])
+        self.assertGreaterEqual(time.time() - start, 0.4)
+        self.assertEqual(set(thread for _, thread in calls),
+                         {'minerva-delayed-calls'})
+        self.assertEqual(delayedCalls.pending(), 0)
+
+        # calls waiting for their delay are pending
+        delayedCalls.callLater(60, call, 'later')
+        self.assertEqual(delayedCalls.pending(), 1)
+        self.assertEqual(len(calls), 3)
@@ -0,0 +1,405 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+from datetime import datetime
+import StringIO
+import json
+import os
+import sys
+import threading
+import time
+
+from tests import base
+
+# the twitter scripts import their modules relative to the server directory
+sys.path.insert(0, os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'server'))
+
+
+def setUpModule():  # noqa
+    """Enable the minerva plugin and start the server."""
+    base.enabledPlugins.append('minerva')
+    base.startServer()
+
+
+def tearDownModule():  # noqa
+    """Stop the server."""
+    base.stopServer()
+
+
+class Status(object):
+
+    """A search result with the attributes of a tweepy status."""
+
+    def __init__(self, id, location):
+        self.id = id
+        self.id_str = str(id)
+        self.text = 'tweet %d' % id
+        self.created_at = datetime(2016, 1, 1)
+        self._json = {
+            'id': id,
+            'place': None,
+            'coordinates': None,
+            'user': {'location': location}
+        }
+
+
+class SearchApi(object):
+
+    """A stand-in for the tweepy API, returning pages of statuses."""
+
+    def __init__(self, ids):
+        self.statuses = [
+            Status(i, 'Paris' if i % 2 else '') for i in sorted(ids)
+        ]
+        self.calls = []
+
+    def search(self, q, count, max_id=None):
+        self.calls.append(max_id)
+        statuses = [
+            s for s in reversed(self.statuses)
+            if max_id is None or s.id <= max_id
+        ]
+        return statuses[:count]
+
+
+class Location(object):
+
+    """A resolved location."""
+
+    def __init__(self, name):
+        self.id = 7
+        self.country = 'France'
+        self.state = None
+        self.county = None
+        self.city = name
+        self.latitude = 48.85
+        self.longitude = 2.35
+        self.aliases = [name.lower()]
+        self.resolution_method = 'profile'
+
+
+class Resolver(object):
+
+    """A resolver locating tweets by their profile location."""
+
+    def __init__(self):
+        self.calls = 0
+
+    def resolve_tweet(self, tweet):
+        self.calls += 1
+        location = tweet['user']['location']
+        if location:
+            return False, Location(location)
+
+
+class Collection(object):
+
+    """A collection recording the batches inserted into it.
+
+    ``errors`` holds the exceptions raised by the next inserts, and while
+    ``blocked`` is cleared inserts wait for it.
+    """
+
+    def __init__(self):
+        self.name = 'tweets_test'
+        self.batches = []
+        self.errors = []
+        self.inserting = threading.Event()
+        self.blocked = threading.Event()
+        self.blocked.set()
+
+    def insert_many(self, documents, ordered=True):
+        self.inserting.set()
+        self.blocked.wait()
+        if self.errors:
+            raise self.errors.pop(0)
+        self.batches.append(list(documents))
+
+
+class Writer(object):
+
+    """A writer keeping the records passed to it."""
+
+    def __init__(self):
+        self.records = []
+
+    def write(self, record):
+        self.records.append(record)
+
+
+def wait_for(condition, timeout=5):
+    """Wait until condition() is true, returning it."""
+    deadline = time.time() + timeout
+    while not condition() and time.time() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def mark_filter():
+    """Return a filter marking tweets as geocoded, loaded in the workers."""
+    def mark(tweet):
+        tweet['geocoded'] = True
+        return tweet
+    return mark
+
+
+def tweet_record(tweet):
+    """Return the record of a geocoded tweet, skipping tweet 5."""
+    if tweet['id'] == 5:
+        return None
+    return {'id': tweet['id'], 'geocoded': tweet['geocoded']}
+
+
+class TwitterTestCase(base.TestCase):
+
+    """Tests of the twitter search ingestion."""
+
+    def test_search(self):
+        """Test paged search ingestion with a stubbed api."""
+        from misc.twitter import tweets
+
+        collection = self.model('item').collection.database['tweets_test']
+        collection.drop()
+
+        api = SearchApi(xrange(1, 251))
+        resolver = Resolver()
+        stats = tweets.search('paris', 5, api=api, collection=collection,
+                              resolver=resolver)
+
+        # three pages, the last one partial
+        self.assertEqual(api.calls[:3], [None, 150, 50])
+        self.assertEqual(stats, {'tweets': 250, 'saved': 125,
+                                 'inserted': 125})
+        self.assertEqual(collection.count(), 125)
+        # each page resolves each distinct profile location once
+        self.assertEqual(resolver.calls, 6)
+
+        doc = collection.find_one({'id': '249'})
+        self.assertEqual(doc['location'], {
+            'type': 'Point', 'coordinates': [2.35, 48.85], 'id': 7,
+            'admin': ['France', '', '', 'Paris']})
+        self.assertEqual(doc['created_at'], 1451606400)
+        self.assertEqual(doc['created_date'], datetime(2016, 1, 1))
+
+        # searching again doesn't duplicate tweets
+        api = SearchApi(xrange(1, 301))
+        stats = tweets.search('paris', 5, api=api, collection=collection,
+                              resolver=resolver, prefetch_pages=False)
+        self.assertEqual(stats['saved'], 150)
+        self.assertEqual(stats['inserted'], 25)
+        self.assertEqual(collection.count(), 150)
+
+    def test_indexes(self):
+        """Test the indexes and retention of tweet collections."""
+        from misc.twitter import indexes
+
+        collection = self.model('item').collection.database['tweets_test']
+        collection.drop()
+
+        # older duplicates are removed before the unique index is built,
+        # and older locations converted to compact points
+        collection.insert_many([{'id': '1'}, {'id': '1'}, {
+            'id': '2',
+            'location': {'id': '3', 'city': 'Paris', 'country': 'France',
+                         'latitude': 48.85, 'longitude': 2.35,
+                         'aliases': ['paris'], 'known': True},
+            'geo': {'type': 'Point', 'coordinates': [2.35, 48.85]}
+        }])
+        indexes.ensure_indexes(collection, ttl=3600)
+        self.assertEqual(collection.count(), 2)
+        doc = collection.find_one({'id': '2'})
+        self.assertNotIn('geo', doc)
+        self.assertEqual(doc['location'], {
+            'type': 'Point', 'coordinates': [2.35, 48.85], 'id': 3,
+            'admin': ['France', '', '', 'Paris']})
+        with self.assertRaises(Exception):
+            collection.insert_one({'id': '2'})
+
+        info = collection.index_information()
+        self.assertIn('created_at_1', info)
+        self.assertIn('location_2dsphere', info)
+        self.assertEqual(
+            info[indexes.TTL_INDEX]['expireAfterSeconds'], 3600)
+
+        with self.assertRaises(ValueError):
+            indexes.query_collection('tweets_test', ttl=60, max_bytes=1024)
+
+    def test_locations(self):
+        """Test compact locations and their lookup by id."""
+        from misc.twitter import locations
+
+        self.assertIsNone(locations.compact_location(None))
+        self.assertIsNone(locations.compact_location_dict({'city': 'X'}))
+
+        compact = locations.compact_location(Location('Paris'))
+        self.assertEqual(locations.compact_location_dict(compact), compact)
+
+        details = locations.location_details(0)
+        self.assertEqual(details['city'], 'Depok')
+        self.assertIn('aliases', details)
+        self.assertIsNone(locations.location_details(-1))
+
+    def test_replay(self):
+        """Test replaying recorded tweets through the stream ingestion."""
+        from misc.twitter import locations, replay
+
+        path = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                            'data', 'tweets100.json.zip')
+        tweets = list(replay.read_recorded(path))
+        self.assertEqual(len(tweets), 100)
+
+        raw_tweets = replay.expand(tweets, 250)
+        self.assertEqual(len(raw_tweets), 250)
+
+        def geocoder():
+            def geocode(tweet):
+                if tweet.get('coordinates'):
+                    tweet['location'] = locations.compact_location(
+                        Location('Here'))
+                return tweet
+            return geocode
+
+        located = sum(1 for tweet in tweets if tweet.get('coordinates'))
+        collection = replay.MemoryCollection()
+        report = replay.replay(
+            raw_tweets, collection, workers=0, batch_size=100,
+            interval=0.1, filter_factories=[geocoder], stream=sys.stdout)
+        self.assertEqual(report['tweets'], 250)
+        self.assertEqual(report['failed'], 0)
+        self.assertEqual(report['written'], collection.inserted)
+        # the recording repeats two and a half times
+        self.assertEqual(collection.inserted, located * 2 + sum(
+            1 for tweet in tweets[:50] if tweet.get('coordinates')))
+        self.assertEqual(set(report['latency']),
+                         {'p50', 'p90', 'p99', 'max'})
+        self.assertLessEqual(report['latency']['p50'],
+                             report['latency']['max'])
+        self.assertIn('tweets/s', replay.format_report(report))
+
+    def test_bulk_writer(self):
+        """Test batching, flushing and failures of the bulk writer."""
+        from pymongo.errors import AutoReconnect, BulkWriteError
+        from misc.twitter.writer import BulkWriter
+
+        # full batches are written as soon as they are buffered
+        collection = Collection()
+        writer = BulkWriter(collection, batch_size=3, interval=60,
+                            report_interval=0, stream=StringIO.StringIO())
+        for i in xrange(7):
+            writer.write({'id': i})
+        self.assertTrue(wait_for(lambda: len(collection.batches) == 2))
+        self.assertEqual(collection.batches, [
+            [{'id': 0}, {'id': 1}, {'id': 2}],
+            [{'id': 3}, {'id': 4}, {'id': 5}]])
+
+        # closing writes the rest and stops the thread
+        writer.close()
+        self.assertEqual(collection.batches[2:], [[{'id': 6}]])
+        self.assertEqual(writer.written, 7)
+        self.assertFalse(writer._thread.is_alive())
+        self.assertRaises(ValueError, writer.write, {'id': 7})
+
+        # partial batches are written after the interval, or on flush
+        collection = Collection()
+        writer = BulkWriter(collection, batch_size=100, interval=0.1,
+                            report_interval=0, stream=StringIO.StringIO())
+        writer.write({'id': 1})
+        writer.write({'id': 2})
+        self.assertTrue(wait_for(lambda: len(collection.batches) == 1))
+        self.assertEqual(collection.batches, [[{'id': 1}, {'id': 2}]])
+        writer.interval = 60
+        time.sleep(0.2)
+        writer.write({'id': 3})
+        writer.flush()
+        self.assertEqual(collection.batches[1:], [[{'id': 3}]])
+
+        # failed documents are counted, and the writer keeps going
+        collection.errors = [
+            BulkWriteError({'writeErrors': [{'index': 0}], 'nInserted': 2}),
+            Exception('invalid document'),
+            AutoReconnect()
+        ]
+        writer.retries = 0
+        for batch in ([4, 5, 6], [7], [8], [9]):
+            for i in batch:
+                writer.write({'id': i})
+            writer.flush()
+        writer.close()
+        self.assertEqual(writer.written, 6)
+        self.assertEqual(writer.failed, 3)
+        self.assertEqual(writer.batches, 6)
+        self.assertEqual(collection.batches[2:], [[{'id': 9}]])
+
+        # flushing a closed writer returns at once
+        flushed = threading.Thread(target=writer.flush)
+        flushed.start()
+        flushed.join(5)
+        self.assertFalse(flushed.is_alive())
+
+        # writes block while the buffer is full
+        collection = Collection()
+        collection.blocked.clear()
+        writer = BulkWriter(collection, batch_size=1, interval=60,
+                            max_pending=2, report_interval=0,
+                            stream=StringIO.StringIO())
+        writer.write({'id': 1})
+        self.assertTrue(collection.inserting.wait(5))
+        writer.write({'id': 2})
+        writer.write({'id': 3})
+        blocked = threading.Thread(target=writer.write, args=({'id': 4},))
+        blocked.start()
+        blocked.join(0.2)
+        self.assertTrue(blocked.is_alive())
+        self.assertEqual(writer.pending(), 2)
+
+        collection.blocked.set()
+        blocked.join(5)
+        self.assertFalse(blocked.is_alive())
+        writer.close()
+        self.assertEqual([batch[0]['id'] for batch in collection.batches],
+                         [1, 2, 3, 4])
+
+    def test_pipeline(self):
+        """Test geocoding tweets in a worker process."""
+        from misc.twitter.pipeline import GeocodingPipeline
+
+        writer = Writer()
+        pipeline = GeocodingPipeline(
+            writer, [mark_filter], tweet_record, workers=1, batch_size=3,
+            interval=0.05, report_interval=0, stream=StringIO.StringIO())
+        for i in xrange(10):
+            pipeline.put('not json' if i == 7 else json.dumps({'id': i}))
+
+        # closing drains the queued tweets in the order they were put
+        pipeline.close()
+        self.assertEqual(writer.records, [
+            {'id': i, 'geocoded': True} for i in (0, 1, 2, 3, 4, 6, 8, 9)])
+        self.assertEqual(pipeline.processed, 10)
+        self.assertEqual(pipeline.records, 8)
+        self.assertEqual(pipeline.errors, 1)
+        self.assertEqual(pipeline.depths(),
+                         {'raw': 0, 'batches': 0, 'writer': 0})
+
+        # and stops the threads and the workers
+        for thread in pipeline._threads:
+            self.assertFalse(thread.is_alive())
+        for process in pipeline._pool._pool:
+            self.assertFalse(process.is_alive())
+        self.assertRaises(ValueError, pipeline.put, '{}')
@@ -1,42 +1,372 @@
-"""This modules extends importing to allow dumping raw json."""
+"""This modules extends importing to allow dumping raw json.
 
+Besides json, the geonames table can be dumped in columnar formats that are
+much faster to write and to read back.  ``npz`` writes a compressed NumPy
+archive per chunk holding an array per column, with each text column
+stored as a single null separated utf-8 buffer, and ``parquet`` writes a
+Parquet file per chunk when pyarrow is installed.
+
+Each chunk is written as a shard, optionally gzip compressed, by a pool of
+worker processes, and a manifest lists the shards with their row counts and
+checksums.  :func:`load_geonames` reads the shards of any of the formats
+back in parallel as the same geojson features the import produces, so a
+snapshot can be loaded into mongo or the gazetteer without parsing
+``allCountries.txt`` again.
+"""
+import collections
+import glob
+import gzip
+import hashlib
 import os
+from cStringIO import StringIO
+
+import numpy as np
+from bson.json_util import dumps as dump_bson, loads as load_bson
+from json import dumps as dump_json, loads as load_json
+
+from .import_data import (
+    read_table, clean_chunk, export_chunk, export_to_girder, Ready,
+    close_pool, _allZip, _columns, _integer_columns
+)
+
+#: File extension of each dump format
+_extensions = {
+    'json': '.json',
+    'npz': '.npz',
+    'parquet': '.parquet'
+}
+
+#: Columns stored as numbers in the columnar formats, missing integers are
+#: stored as NaN
+_numeric_columns = ('geonameid', 'latitude', 'longitude') + tuple(
+    sorted(_integer_columns))
+
+_date_column = 'modification date'
+
+
+def dump_geonames(chunksize=100000, path='.', basename='geonames', bson=True,
+                  format='json', file_name=_allZip, workers=0,
+                  compress=False, depth=4):
+    """Dump the geonames database as shards in json or a columnar format.
+
+    The table is read in the calling process and each chunk is converted
+    and written as a shard by a pool of ``workers`` processes, with at most
+    ``depth`` chunks waiting for a worker.  Shards are gzip compressed when
+    ``compress`` is true.  A manifest listing every shard with its row
+    count, size and sha256 checksum is written last, see
+    :func:`read_manifest`.
+
+    Returns the manifest.
+    """
+    if format not in _extensions:
+        raise ValueError('Unknown dump format: %s' % format)
+
+    import multiprocessing
+
+    path = os.path.abspath(path)
+    pool = None
+    if workers:
+        pool = multiprocessing.Pool(workers)
+
+    shards = []
+    pending = collections.deque()
+    try:
+        for i, chunk in enumerate(read_table(file_name, chunksize)):
+            name = basename + '_%05i' % i + _extensions[format]
+            if compress:
+                name += '.gz'
+            args = (chunk, os.path.join(path, name), format, compress, bson)
+            if pool is not None:
+                pending.append(pool.apply_async(write_shard, args))
+            else:
+                pending.append(Ready(write_shard(*args)))
+
+            if len(pending) > depth:
+                shards.append(pending.popleft().get())
+
+        while pending:
+            shards.append(pending.popleft().get())
+    finally:
+        if pool is not None:
+            close_pool(pool, pending)
+
+    manifest = {
+        'format': format,
+        'compressed': compress,
+        'rows': sum(shard['rows'] for shard in shards),
+        'shards': shards
+    }
+    with open(manifest_name(path, basename), 'w') as f:
+        f.write(dump_json(manifest, indent=2, sort_keys=True))
+    return manifest
 
-from bson.json_util import dumps as dump_bson
-from json import dumps as dump_json
-from .import_data import read_geonames
 
+def manifest_name(path='.', basename='geonames'):
+    """Return the file name of the manifest of a dump."""
+    return os.path.join(os.path.abspath(path), basename + '_manifest.json')
 
-def dump_geonames(chunksize=100000, path='.', basename='geonames',
-                  bson=True):
-    """Dump the geonames database as json."""
-    global ifile
-    ifile = 0
-    base = os.path.join(os.path.abspath(path), basename)
-    if bson:
-        dumps = dump_bson
+
+def read_manifest(path='.', basename='geonames'):
+    """Return the manifest of a dump, or None if it has none.
+
+    The manifest has the ``format`` of the dump, whether its shards are
+    ``compressed``, the total number of ``rows`` and a list of ``shards`` in
+    order, each with its file ``name``, ``rows``, ``bytes`` and ``sha256``.
+    Columnar shards count the rows of the table, json shards the features.
+    """
+    try:
+        with open(manifest_name(path, basename)) as f:
+            return load_json(f.read())
+    except IOError:
+        return None
+
+
+def write_shard(chunk, file_name, format='npz', compress=False, bson=True):
+    """Write a chunk of the geonames table as a dump shard.
+
+    Returns the shard's manifest entry.
+    """
+    if format == 'json':
+        features = clean_chunk(chunk)
+        rows = len(features)
+        if bson:
+            dumps = dump_bson
+        else:
+            dumps = dump_json
+        geojson = {'type': 'FeatureCollection', 'features': features}
+        data = dumps(geojson, default=str)
     else:
-        dumps = dump_json
+        rows = len(chunk)
+        data = encode_chunk(chunk, format)
+
+    if compress:
+        buf = StringIO()
+        with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as f:
+            f.write(data)
+        data = buf.getvalue()
+
+    with open(file_name, 'wb') as f:
+        f.write(data)
+
+    return {
+        'name': os.path.basename(file_name),
+        'rows': rows,
+        'bytes': len(data),
+        'sha256': hashlib.sha256(data).hexdigest()
+    }
+
+
+def chunk_columns(chunk):
+    """Return the columns of a geonames table chunk as typed arrays.
+
+    Text columns are returned as object arrays with None for missing
+    values, the integer columns as floats with NaN for missing values and
+    the modification date as datetime64 days.
+    """
+    import pandas
+
+    columns = {}
+    for column in _columns:
+        values = chunk[column]
+        if column in _numeric_columns:
+            values = pandas.to_numeric(values, errors='coerce').values
+            if column != 'geonameid':
+                values = values.astype(np.float64)
+        elif column == _date_column:
+            values = pandas.to_datetime(
+                values, errors='coerce').values.astype('M8[D]')
+        else:
+            values = values.where(values.notnull(), None).values
+        columns[column] = values
+    return columns
+
+
+def encode_strings(values):
+    """Return a utf-8 buffer of an array of strings separated by nulls.
+
+    Missing values are stored as empty strings.
+    """
+    text = u'\0'.join(
+        v if isinstance(v, unicode) else (v or '').decode('utf-8')
+        for v in values
+    )
+    return np.frombuffer(text.encode('utf-8'), dtype=np.uint8)
+
 
-    def save_chunk(data, *arg, **kw):
-        """Save a chunk of data as a file."""
-        global ifile
+def decode_strings(data, size):
+    """Return an array of strings from a buffer of null separated strings."""
+    values = np.empty(size, dtype=object)
+    if size:
+        values[:] = data.tostring().decode('utf-8').split(u'\0')
+        values[values == u''] = None
+    return values
 
-        fname = base + '_%05i.json' % ifile
-        geojson = {
-            'type': 'FeatureCollection',
-            'features': data
+
+def encode_chunk(chunk, format='npz'):
+    """Return a chunk of the geonames table encoded in a columnar format."""
+    columns = chunk_columns(chunk)
+
+    if format == 'parquet':
+        import pandas
+        import pyarrow
+        import pyarrow.parquet
+
+        frame = pandas.DataFrame(columns, columns=_columns)
+        stream = pyarrow.BufferOutputStream()
+        pyarrow.parquet.write_table(
+            pyarrow.Table.from_pandas(frame, preserve_index=False), stream)
+        return stream.getvalue().to_pybytes()
+
+    arrays = {}
+    for column, values in columns.iteritems():
+        if values.dtype == object:
+            arrays[column] = encode_strings(values)
+        else:
+            arrays[column] = values
+
+    buf = StringIO()
+    np.savez_compressed(buf, **arrays)
+    return buf.getvalue()
+
+
+def decode_chunk(data, format='npz'):
+    """Return a chunk of the geonames table from columnar encoded data."""
+    import pandas
+
+    if format == 'parquet':
+        import pyarrow.parquet
+
+        return pyarrow.parquet.read_table(
+            pyarrow.BufferReader(data)).to_pandas()
+
+    columns = {}
+    with np.load(StringIO(data)) as arrays:
+        size = len(arrays['geonameid'])
+        for column in _columns:
+            values = arrays[column]
+            if values.dtype == np.uint8:
+                values = decode_strings(values, size)
+            columns[column] = values
+    return pandas.DataFrame(columns, columns=_columns)
+
+
+def dump_files(path='.', basename='geonames'):
+    """Return the shards of a dump in order, whatever their format.
+
+    The shards are listed from the manifest when the dump has one.
+    """
+    manifest = read_manifest(path, basename)
+    path = os.path.abspath(path)
+    if manifest is not None:
+        return [
+            os.path.join(path, shard['name'])
+            for shard in manifest['shards']
+        ]
+
+    base = os.path.join(path, basename)
+    files = []
+    for extension in _extensions.itervalues():
+        files.extend(glob.glob(base + '_[0-9]*' + extension))
+        files.extend(glob.glob(base + '_[0-9]*' + extension + '.gz'))
+    return sorted(files)
+
+
+def load_shard(file_name, sha256=None):
+    """Return the geojson features of a dump shard.
+
+    Raises a ValueError if ``sha256`` is given and the shard doesn't match
+    it.
+    """
+    with open(file_name, 'rb') as f:
+        data = f.read()
+
+    if sha256 is not None and hashlib.sha256(data).hexdigest() != sha256:
+        raise ValueError('Checksum mismatch in %s' % file_name)
+
+    name = file_name
+    if name.endswith('.gz'):
+        with gzip.GzipFile(fileobj=StringIO(data)) as f:
+            data = f.read()
+        name = name[:-3]
+
+    if name.endswith(_extensions['json']):
+        return load_bson(data)['features']
+    if name.endswith(_extensions['parquet']):
+        return clean_chunk(decode_chunk(data, 'parquet'))
+    return clean_chunk(decode_chunk(data, 'npz'))
+
+
+def _load_shard(shard):
+    """Load a ``(file_name, sha256)`` pair in a pool worker."""
+    return load_shard(*shard)
+
+
+def load_geonames(path='.', basename='geonames', verify=False, workers=0,
+                  depth=4):
+    """Yield the geojson features of a dump a shard at a time.
+
+    With ``workers`` the shards are loaded by a pool of processes, at most
+    ``depth`` ahead of the consumer, and still yielded in order.  When
+    ``verify`` is true the shards are checked against the checksums of the
+    manifest.
+    """
+    manifest = read_manifest(path, basename)
+    checksums = {}
+    if manifest is not None:
+        checksums = {
+            shard['name']: shard['sha256'] for shard in manifest['shards']
         }
 
-        open(fname, 'w').write(dumps(geojson, default=str))
-        ifile += 1
+    shards = []
+    for file_name in dump_files(path, basename):
+        sha256 = None
+        if verify:
+            sha256 = checksums.get(os.path.basename(file_name))
+            if sha256 is None:
+                raise ValueError('No checksum for %s' % file_name)
+        shards.append((file_name, sha256))
+
+    if not workers:
+        for shard in shards:
+            yield load_shard(*shard)
+        return
+
+    import multiprocessing
+
+    pool = multiprocessing.Pool(workers)
+    pending = collections.deque()
+    try:
+        for shard in shards:
+            pending.append(pool.apply_async(_load_shard, (shard,)))
+            if len(pending) > depth:
+                yield pending.popleft().get()
+
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        close_pool(pool, pending)
+
+
+def import_dump(folder=None, user=None, path='.', basename='geonames',
+                handler=export_to_girder, quarantine=None, verify=False,
+                workers=0):
+    """Export a dump through handler as :func:`read_geonames` would.
 
-    read_geonames(chunksize=chunksize, handler=save_chunk)
+    Returns the number of features exported.
+    """
+    rows = 0
+    for features in load_geonames(path, basename, verify, workers):
+        export_chunk(features, folder, user, handler, quarantine)
+        rows += len(features)
+    return rows
 
 
 if __name__ == '__main__':
     import sys
     dest = '.'
+    format = 'json'
     if len(sys.argv) > 1:
         dest = sys.argv[1]
-    dump_geonames(path=dest)
+    if len(sys.argv) > 2:
+        format = sys.argv[2]
+    dump_geonames(path=dest, format=format)
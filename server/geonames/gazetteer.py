@@ -0,0 +1,401 @@
+"""An in memory prefix index over the geonames names.
+
+Every normalized name of every place is stored once in a sorted, fixed
+width NumPy byte array, so a prefix query is two binary searches followed
+by a ranking of the matching slice.  The places themselves are kept as
+NumPy columns, and their display and normalized names as utf-8 buffers
+with offsets, which keeps the whole index to a few compact arrays instead
+of millions of python objects.
+
+Names are truncated to ``key_width`` bytes in the index, so prefixes
+longer than that match every name sharing the truncated prefix.
+
+Reverse lookups use KD-trees over the places' unit vectors on the sphere,
+built on first use for each feature class and population filter when
+scipy is available.
+"""
+
+import collections
+import threading
+
+import numpy as np
+
+from girder.plugins.minerva.models.geonames import (
+    normalize, normalized_names, place_feature, rank
+)
+
+#: Ranking bonus for names equal to the query rather than prefixed by it
+_exact_rank = 2.0
+
+#: Mean radius of the earth in meters
+EARTH_RADIUS = 6371008.8
+
+#: Prefixes of up to this many bytes match large slices of the index, so
+#: their results are cached
+_cached_prefix = 2
+
+#: Number of cached searches, the least recently used are dropped first
+_cached_searches = 1024
+
+#: Number of places ranked for a cached search, larger limits are ranked
+#: anew
+_cached_results = 100
+
+#: Number of filtered KD-trees kept per gazetteer
+_cached_trees = 4
+
+_lock = threading.Lock()
+_current = None
+_thread = None
+
+
+def unit_vectors(coordinates):
+    """Return the 3d unit vectors of longitude, latitude pairs."""
+    lon = np.radians(coordinates[:, 0])
+    lat = np.radians(coordinates[:, 1])
+    cos_lat = np.cos(lat)
+    return np.column_stack((
+        cos_lat * np.cos(lon),
+        cos_lat * np.sin(lon),
+        np.sin(lat)
+    ))
+
+
+def chord_to_meters(chord):
+    """Return the great circle distance of chords between unit vectors."""
+    return 2 * np.arcsin(np.minimum(chord / 2.0, 1.0)) * EARTH_RADIUS
+
+
+def distances(origin, coordinates):
+    """Return the distances in meters from origin to each coordinate pair."""
+    origin = unit_vectors(np.asarray(origin, dtype=np.float64).reshape(1, 2))
+    coordinates = unit_vectors(
+        np.asarray(coordinates, dtype=np.float64).reshape(-1, 2))
+    return chord_to_meters(np.linalg.norm(coordinates - origin, axis=1))
+
+
+class Gazetteer(object):
+
+    """A read only prefix index of geonames places."""
+
+    def __init__(self, places, key_width=24):
+        """Build the index from an iterable of place dictionaries.
+
+        Each place has a ``geonameid``, ``name``, a list of normalized
+        ``names``, ``longitude``, ``latitude``, ``population``,
+        ``feature_class``, ``feature_code`` and ``country_code``.
+        """
+        self.key_width = key_width
+
+        ids = []
+        coordinates = []
+        population = []
+        scores = []
+        codes = []
+        display = []
+        offsets = [0]
+        place_names = []
+        name_offsets = [0]
+        keys = []
+        key_places = []
+
+        for place in places:
+            i = len(ids)
+            ids.append(place['geonameid'])
+            coordinates.append((place['longitude'], place['latitude']))
+            population.append(place.get('population') or 0)
+            scores.append(rank(place.get('population'),
+                               place.get('feature_class'),
+                               place.get('feature_code')))
+            codes.append((place.get('feature_class') or '',
+                          place.get('feature_code') or '',
+                          place.get('country_code') or ''))
+
+            name = place['name']
+            if isinstance(name, unicode):
+                name = name.encode('utf-8')
+            display.append(name)
+            offsets.append(offsets[-1] + len(name))
+
+            names = u'\n'.join(place['names']).encode('utf-8')
+            place_names.append(names)
+            name_offsets.append(name_offsets[-1] + len(names))
+
+            for key in place['names']:
+                keys.append(key.encode('utf-8')[:key_width])
+                key_places.append(i)
+
+        self.ids = np.array(ids, dtype=np.uint32)
+        self.coordinates = np.array(coordinates, dtype=np.float64).reshape(
+            (len(ids), 2))
+        self.population = np.array(population, dtype=np.uint64)
+        self.scores = np.array(scores, dtype=np.float32)
+        self.codes = np.array(codes, dtype='S10').reshape((len(ids), 3))
+        self.names = ''.join(display)
+        self.offsets = np.array(offsets, dtype=np.int64)
+        self.place_names = ''.join(place_names)
+        self.name_offsets = np.array(name_offsets, dtype=np.int64)
+
+        keys = np.array(keys, dtype='S%d' % key_width)
+        order = np.argsort(keys, kind='mergesort')
+        self.keys = keys[order]
+        self.key_places = np.array(key_places, dtype=np.uint32)[order]
+
+        self._cache = collections.OrderedDict()
+        self._cache_lock = threading.Lock()
+        self._trees = collections.OrderedDict()
+        self._tree_lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.ids)
+
+    def name(self, i):
+        """Return the display name of the place at index i."""
+        return self.names[self.offsets[i]:self.offsets[i + 1]].decode('utf-8')
+
+    def normalized_names(self, i):
+        """Return the normalized names of the place at index i."""
+        names = self.place_names[self.name_offsets[i]:self.name_offsets[i + 1]]
+        return names.decode('utf-8').split(u'\n') if names else []
+
+    def search(self, text, limit=10, exact=False, country=None):
+        """Return the indices of the best places prefixed by text.
+
+        Only names equal to text are matched when ``exact`` is true, and
+        only places in the given country when ``country`` is set.
+        """
+        if limit < 1:
+            raise ValueError('The limit must be at least 1')
+        prefix = normalize(text).encode('utf-8')[:self.key_width]
+        if not prefix:
+            return []
+
+        if len(prefix) > _cached_prefix:
+            return self._rank(prefix, limit, exact, country)
+
+        # the ranking doesn't depend on the limit, so one cached search
+        # serves every limit up to the number of places it ranked
+        key = (prefix, exact, country)
+        with self._cache_lock:
+            cached = self._cache.pop(key, None)
+            if cached is not None:
+                self._cache[key] = cached
+                places, complete = cached
+                if complete or limit <= len(places):
+                    return places[:limit]
+
+        count = max(limit, _cached_results)
+        places = self._rank(prefix, count, exact, country)
+        with self._cache_lock:
+            self._cache.pop(key, None)
+            self._cache[key] = (places, len(places) < count)
+            while len(self._cache) > _cached_searches:
+                self._cache.popitem(last=False)
+        return places[:limit]
+
+    def _rank(self, prefix, limit, exact, country):
+        """Return the indices of the best limit places matching prefix."""
+        lo = self.keys.searchsorted(prefix, 'left')
+        if exact:
+            hi = self.keys.searchsorted(prefix, 'right')
+        else:
+            hi = self.keys.searchsorted(prefix + '\xff', 'left')
+        places = self.key_places[lo:hi]
+        scores = self.scores[places] + _exact_rank * (
+            self.keys[lo:hi] == prefix)
+        if country:
+            in_country = self.codes[places, 2] == country.encode('ascii')
+            places = places[in_country]
+            scores = scores[in_country]
+
+        # a place matches once per name, so rank a few extra candidates
+        # to fill the limit with distinct places
+        candidates = min(len(places), limit * 8)
+        if candidates < len(places):
+            best = np.argpartition(-scores, candidates - 1)[:candidates]
+        else:
+            best = np.arange(len(places))
+        best = best[np.argsort(-scores[best], kind='mergesort')]
+
+        result = []
+        seen = set()
+        for i in places[best]:
+            if i not in seen:
+                seen.add(i)
+                result.append(int(i))
+                if len(result) >= limit:
+                    break
+        return result
+
+    def feature(self, i):
+        """Return a geojson feature for the place at index i."""
+        feature_class, feature_code, country_code = self.codes[i]
+        return place_feature(
+            self.ids[i], self.coordinates[i], self.name(i),
+            self.normalized_names(i), self.population[i], feature_class,
+            feature_code, country_code)
+
+    def geocode(self, text, limit=10, exact=False, country=None):
+        """Return geojson features for the best matches of text."""
+        return [
+            self.feature(i)
+            for i in self.search(text, limit, exact=exact, country=country)
+        ]
+
+    def tree(self, feature_classes=None, min_population=None):
+        """Return a KD-tree over the places passing the filter.
+
+        Returns the tree, or None when no place passes, and the indices of
+        the places in it.  Trees are cached per filter and building one
+        raises ImportError when scipy isn't available.
+        """
+        key = (tuple(sorted(feature_classes or ())), int(min_population or 0))
+        with self._tree_lock:
+            if key not in self._trees:
+                from scipy.spatial import cKDTree
+
+                allowed = np.ones(len(self), dtype=bool)
+                if feature_classes:
+                    allowed &= np.in1d(self.codes[:, 0], list(feature_classes))
+                if min_population:
+                    allowed &= self.population >= min_population
+                subset = np.flatnonzero(allowed)
+
+                tree = None
+                if len(subset):
+                    tree = cKDTree(unit_vectors(self.coordinates[subset]))
+                if len(self._trees) >= _cached_trees:
+                    self._trees.popitem(last=False)
+                self._trees[key] = (tree, subset)
+            return self._trees[key]
+
+    def nearest(self, points, limit=1, feature_classes=None,
+                min_population=None):
+        """Return the nearest places to an array of longitude, latitude pairs.
+
+        Returns the place indices and the distances in meters as two arrays
+        with a row per point, nearest first.  Places are filtered by feature
+        class and population, and when fewer than ``limit`` places pass the
+        filter the rows are padded with -1 and infinity.
+        """
+        points = np.asarray(points, dtype=np.float64).reshape((-1, 2))
+        indices = np.full((len(points), limit), -1, dtype=np.int64)
+        distances = np.full((len(points), limit), np.inf)
+
+        tree, subset = self.tree(feature_classes, min_population)
+        found = min(limit, len(subset))
+        if not found or not len(points):
+            return indices, distances
+
+        chord, near = tree.query(unit_vectors(points), k=found)
+        indices[:, :found] = subset[near.reshape((len(points), found))]
+        distances[:, :found] = chord_to_meters(
+            chord.reshape((len(points), found)))
+        return indices, distances
+
+    def place(self, i):
+        """Return a summary of the place at index i."""
+        feature_class, feature_code, country_code = self.codes[i]
+        return {
+            'id': int(self.ids[i]),
+            'name': self.name(i),
+            'coordinates': self.coordinates[i].tolist(),
+            'population': int(self.population[i]),
+            'feature class': feature_class or None,
+            'feature code': feature_code or None,
+            'country code': country_code or None
+        }
+
+
+def places_from_items(collection, folder_id):
+    """Yield the places stored as girder items in a folder."""
+    cursor = collection.find({
+        'folderId': folder_id,
+        'meta.geonameid': {'$exists': True}
+    }, projection=['meta', 'geo.geometry.coordinates'])
+
+    for doc in cursor:
+        meta = doc['meta']
+        longitude, latitude = doc['geo']['geometry']['coordinates']
+        yield {
+            'geonameid': meta['geonameid'],
+            'name': meta.get('name', ''),
+            'names': normalized_names(meta),
+            'longitude': longitude,
+            'latitude': latitude,
+            'population': meta.get('population'),
+            'feature_class': meta.get('feature class'),
+            'feature_code': meta.get('feature code'),
+            'country_code': meta.get('country code')
+        }
+
+
+def places_from_collection(collection):
+    """Yield the places stored in the geonames collection."""
+    for doc in collection.find():
+        longitude, latitude = doc['geometry']['coordinates']
+        yield {
+            'geonameid': doc['_id'],
+            'name': doc.get('name', ''),
+            'names': doc.get('names', []),
+            'longitude': longitude,
+            'latitude': latitude,
+            'population': doc.get('population'),
+            'feature_class': doc.get('feature_class'),
+            'feature_code': doc.get('feature_code'),
+            'country_code': doc.get('country_code')
+        }
+
+
+def places_from_dump(path, basename='geonames'):
+    """Yield the places of a geonames dump written by ``dump_geonames``."""
+    from .dump_data import load_geonames
+
+    for features in load_geonames(path, basename):
+        for feature in features:
+            properties = feature['properties']
+            longitude, latitude = feature['geometry']['coordinates']
+            yield {
+                'geonameid': properties['geonameid'],
+                'name': properties.get('name', ''),
+                'names': normalized_names(properties),
+                'longitude': longitude,
+                'latitude': latitude,
+                'population': properties.get('population'),
+                'feature_class': properties.get('feature class'),
+                'feature_code': properties.get('feature code'),
+                'country_code': properties.get('country code')
+            }
+
+
+def current():
+    """Return the current gazetteer, or None if it hasn't been built."""
+    return _current
+
+
+def building():
+    """Return true while a background rebuild is running."""
+    return _thread is not None and _thread.is_alive()
+
+
+def rebuild(places, background=True):
+    """Build a new gazetteer from places and make it current.
+
+    ``places`` is a callable returning the iterable of places.  Queries
+    keep using the previous gazetteer until the new one is complete, and
+    concurrent rebuilds run one after the other.
+    """
+    def build():
+        global _current
+        with _lock:
+            _current = Gazetteer(places())
+
+    global _thread
+    if not background:
+        build()
+        return None
+
+    _thread = threading.Thread(target=build, name='gazetteer-rebuild')
+    _thread.daemon = True
+    _thread.start()
+    return _thread
@@ -1,16 +1,24 @@
 """This modules defines geocoding endpoints using the geonames database."""
 
 import sys
-import shutil
 import os
-import urllib
+import urllib2
 import time
-import tempfile
+import threading
+import hashlib
+import struct
+import zlib
 import zipfile
 import json
+import datetime
+import collections
+import Queue
 
 import numpy as np
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 from girder.utility.model_importer import ModelImporter
+from girder.plugins.minerva.models.geonames import normalized_names
 
 #:  Get from geospatial plugin
 GEOSPATIAL_FIELD = 'geo'
@@ -46,16 +54,15 @@ _columns = [
 ]
 
 
-# Actual types, but need NaN
-
-#: Data types for the columns to optimize import
+#: Data types for the columns to optimize import, the nullable integer
+#: columns are read as strings and converted a chunk at a time
 _types = {
     'geonameid': np.uint32,
     'latitude': np.float64,
     'longitude': np.float64,
-    'population': np.object_,
-    'elevation': np.object_,
-    'dem': np.object_,
+    'population': np.str_,
+    'elevation': np.str_,
+    'dem': np.str_,
     'name': np.str_,
     'asciiname': np.str_,
     'alternatenames': np.str_,  # ascii comma seperated list
@@ -69,36 +76,19 @@ _types = {
     'admin4 code': np.str_
 }
 
+#: Nullable integer columns, and whether non-positive values are invalid
+_integer_columns = {
+    'population': True,
+    'elevation': False,
+    'dem': True
+}
 
-def _type_or_default(default, typeclass):
-    """Return a converter with the given default value."""
-    def conv(val):
-        try:
-            val = float(val)
-            if val < np.infty:
-                return typeclass(val)
-        except Exception:
-            return default
-    return conv
-
-
-def _make_tuple(v):
-    """Make a tuple out of CSV."""
-    v = v.strip()
-    if v:
-        return tuple(v.split(','))
-    else:
-        return ()
-
+#: Comma separated list columns
+_list_columns = ('alternatenames', 'cc2')
 
-#: conversion methods for dealing with nullable ints
-_converters = {
-    'population': _type_or_default(None, np.uint64),
-    'elevation': _type_or_default(None, np.int32),
-    'dem': _type_or_default(None, np.int32),
-    'alternatenames': _make_tuple,
-    'cc2': _make_tuple
-}
+#: The number of rows parsed and exported at a time, a benchmark of the
+#: parse and cleanup stage levels off at a few thousand rows per chunk
+_chunksize = 5000
 
 # Set up default paths
 #: Current directory
@@ -110,6 +100,9 @@ _allZip = os.path.join(_mypath, 'allCountries.zip')
 #: URL of allCountries.zip
 _allUrl = 'http://download.geonames.org/export/dump/allCountries.zip'
 
+#: Size of the blocks read from the network and from downloaded files
+_block_size = 1 << 16
+
 _tick = None
 
 
@@ -164,9 +157,39 @@ def done_report(stream=sys.stderr):
         stream.write('\n')
 
 
-def download_all_countries(dest=_allZip, url=None,
-                           progress=None, done=None):
-    """Download the geonames data file to the given destination."""
+def _total_size(response, offset):
+    """Return the full size of a download from the response headers."""
+    content_range = response.info().getheader('Content-Range')
+    if content_range and '/' in content_range:
+        total = content_range.rsplit('/', 1)[1]
+        if total.isdigit():
+            return int(total)
+    length = response.info().getheader('Content-Length')
+    if length and length.isdigit():
+        return offset + int(length)
+    return -1
+
+
+class ChecksumError(ValueError):
+
+    """The downloaded data file doesn't match the expected checksum."""
+
+
+def download_all_countries(dest=_allZip, url=None, progress=None, done=None,
+                           checksum=None, hash_name='sha256', resume=True,
+                           written=None):
+    """Download the geonames data file to the given destination.
+
+    The file is written to ``dest + '.part'`` and renamed to ``dest`` once
+    complete, so it is never copied across file systems.  When ``resume``
+    is true an earlier partial download is continued with an HTTP range
+    request, or restarted if the server doesn't support them.
+
+    If ``checksum`` is given the hex digest of the file with ``hash_name``
+    must match it, otherwise the partial file is removed and a
+    :class:`ChecksumError` raised.  ``written`` is called with the size of
+    the partial file after every block is written to it.
+    """
     if progress is None:
         progress = progress_report
     if done is None:
@@ -175,27 +198,300 @@ def download_all_countries(dest=_allZip, url=None,
         url = _allUrl
 
     message = 'Downloading allCountries.zip'
-    tmp = os.path.join(tempfile.gettempdir(), 'allCountries.zip')
+    part = dest + '.part'
+    digest = hashlib.new(hash_name)
+
+    offset = 0
+    if resume and os.path.exists(part):
+        with open(part, 'rb') as f:
+            for block in iter(lambda: f.read(_block_size), ''):
+                digest.update(block)
+                offset += len(block)
+
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header('Range', 'bytes=%d-' % offset)
 
     try:
-        urllib.urlretrieve(
-            url,
-            tmp,
-            lambda nb, bs, fs, url=url: progress(
-                nb * bs, fs, message, 'b'
-            )
-        )
+        response = urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code != 416:
+            raise
+        response = None
+        if _total_size(e, offset) != offset:
+            # the partial file doesn't match the remote file, start over
+            response = urllib2.urlopen(url)
+
+    total = offset
+    if response is not None:
+        if response.getcode() != 206:
+            # the server sent the whole file
+            digest = hashlib.new(hash_name)
+            offset = 0
+        total = _total_size(response, offset)
+
+        with open(part, 'ab' if offset else 'wb') as f:
+            for block in iter(lambda: response.read(_block_size), ''):
+                f.write(block)
+                f.flush()
+                digest.update(block)
+                offset += len(block)
+                progress(offset, total, message, 'b')
+                if written is not None:
+                    written(offset)
         done()
-        shutil.move(tmp, dest)
-    finally:
-        if os.path.exists(tmp):
-            os.remove(tmp)
+
+    if total >= 0 and offset != total:
+        raise IOError('Incomplete download of %s: %d of %d bytes' % (
+            url, offset, total))
+
+    if checksum is not None and digest.hexdigest() != checksum.lower():
+        os.remove(part)
+        raise ChecksumError('Checksum mismatch for %s' % url)
+
+    os.rename(part, dest)
     return dest
 
 
+class DownloadStream(object):
+
+    """A file like object reading a download while it is written.
+
+    The file is downloaded by :func:`download_all_countries` in a thread,
+    and reads block until enough of it is written.  Errors raised by the
+    download, such as a checksum mismatch, are raised by the read that
+    reaches the end of the data written so far.
+    """
+
+    def __init__(self, dest=_allZip, **kwargs):
+        self._condition = threading.Condition()
+        self._size = 0
+        self._finished = False
+        self._error = None
+        self._file = None
+        self._part = dest + '.part'
+        self._dest = dest
+
+        kwargs['written'] = self._written
+        self._thread = threading.Thread(
+            target=self._download, args=(dest, kwargs),
+            name='geonames-download')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _download(self, dest, kwargs):
+        try:
+            download_all_countries(dest, **kwargs)
+        except Exception:
+            self._error = sys.exc_info()
+        finally:
+            with self._condition:
+                self._finished = True
+                self._condition.notify_all()
+
+    def _written(self, size):
+        with self._condition:
+            self._size = size
+            self._condition.notify_all()
+
+    def _open(self):
+        """Open the partial file, or the complete one if already renamed."""
+        for name in (self._part, self._dest):
+            try:
+                return open(name, 'rb')
+            except IOError:
+                pass
+        return None
+
+    def read(self, size=-1):
+        """Read up to size bytes, waiting for the download if needed."""
+        with self._condition:
+            while True:
+                if self._file is None and (self._size or self._finished):
+                    self._file = self._open()
+                position = 0
+                if self._file is not None:
+                    position = self._file.tell()
+                if position < self._size or self._finished:
+                    break
+                self._condition.wait()
+
+            if self._error is not None and (
+                    self._file is None or position >= self._size):
+                error = self._error
+                raise error[0], error[1], error[2]
+
+            if not self._finished:
+                available = self._size - position
+                if size < 0 or size > available:
+                    size = available
+            return self._file.read(size)
+
+    def close(self):
+        """Wait for the download to finish and close the file.
+
+        Raises the error of the download, if any, as the data read may
+        not reach the end of the file where reads raise it.
+        """
+        self._thread.join()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error[0], error[1], error[2]
+
+
+class ZipMemberStream(object):
+
+    """A file like object inflating the first member of a zip stream.
+
+    The local header of the member is parsed directly from the stream and
+    its data inflated as it is read, so nothing needs to be seekable.
+    Only stored and deflated members are supported.
+    """
+
+    def __init__(self, stream, name=None):
+        self._stream = stream
+        header = self._read_exact(30)
+        (signature, _, flags, method, _, _, crc, size, _, name_length,
+         extra_length) = struct.unpack('<IHHHHHIIIHH', header)
+        if signature != 0x04034b50:
+            raise IOError('Not a zip file')
+        member = self._read_exact(name_length)
+        self._read_exact(extra_length)
+        if name is not None and member != name:
+            raise IOError('Unexpected zip member %s' % member)
+        if method not in (0, 8) or (method == 0 and flags & 8):
+            raise IOError('Unsupported zip compression %d' % method)
+
+        self.name = member
+        self._flags = flags
+        self._crc = crc
+        self._remaining = size if method == 0 else None
+        self._inflate = None
+        if method == 8:
+            self._inflate = zlib.decompressobj(-zlib.MAX_WBITS)
+        self._buffer = collections.deque()
+        self._buffered = 0
+        self._computed_crc = 0
+        self._eof = False
+
+    def _read_exact(self, size):
+        data = ''
+        while len(data) < size:
+            block = self._stream.read(size - len(data))
+            if not block:
+                raise IOError('Truncated zip file')
+            data += block
+        return data
+
+    def _fill(self, size):
+        """Inflate blocks until size bytes are buffered or the data ends."""
+        while not self._eof and (size < 0 or self._buffered < size):
+            if self._inflate is None:
+                data = self._stream.read(min(_block_size, self._remaining))
+                self._remaining -= len(data)
+                if not self._remaining:
+                    self._eof = True
+                elif not data:
+                    raise IOError('Truncated zip file')
+            else:
+                block = self._stream.read(_block_size)
+                if not block:
+                    raise IOError('Truncated zip file')
+                data = self._inflate.decompress(block)
+                if self._inflate.unused_data:
+                    data += self._inflate.flush()
+                    self._eof = True
+
+            if data:
+                self._computed_crc = zlib.crc32(data, self._computed_crc)
+                self._buffer.append(data)
+                self._buffered += len(data)
+
+            if self._eof:
+                self._check_crc()
+
+    def _check_crc(self):
+        crc = self._crc
+        if self._flags & 8:
+            # the crc follows the data in a descriptor
+            tail = self._inflate.unused_data
+            while len(tail) < 8:
+                block = self._stream.read(8 - len(tail))
+                if not block:
+                    raise IOError('Truncated zip file')
+                tail += block
+            if tail[:4] == 'PK\x07\x08':
+                tail = tail[4:]
+                if len(tail) < 4:
+                    tail += self._read_exact(4 - len(tail))
+            crc = struct.unpack('<I', tail[:4])[0]
+        if self._computed_crc & 0xffffffff != crc:
+            raise IOError('CRC mismatch in zip member %s' % self.name)
+
+    def _take(self, size):
+        """Return up to size bytes of the buffer."""
+        data = ''.join(self._buffer)
+        self._buffer.clear()
+        if size >= 0 and len(data) > size:
+            self._buffer.append(data[size:])
+            data = data[:size]
+        self._buffered -= len(data)
+        return data
+
+    def read(self, size=-1):
+        """Read up to size bytes of the inflated member."""
+        self._fill(size)
+        return self._take(size)
+
+    def readline(self):
+        """Read a line of the inflated member."""
+        while True:
+            data = ''.join(self._buffer)
+            self._buffer.clear()
+            self._buffer.append(data)
+            end = data.find('\n')
+            if end >= 0:
+                return self._take(end + 1)
+            if self._eof:
+                return self._take(-1)
+            self._fill(self._buffered + 1)
+
+    def __iter__(self):
+        return iter(self.readline, '')
+
+    def close(self):
+        """Close the underlying stream."""
+        close = getattr(self._stream, 'close', None)
+        if close is not None:
+            close()
+
+
+def stream_all_countries(dest=_allZip, **kwargs):
+    """Return a file like object over allCountries.txt as it downloads.
+
+    The zip file is downloaded to ``dest`` as by
+    :func:`download_all_countries`, which takes the same keyword
+    arguments, and inflated while it is read so parsing the rows overlaps
+    the download.  Close it to wait for the download to finish.
+
+    The checksum can only be verified once the whole file is downloaded,
+    so the :class:`ChecksumError` of a mismatch is raised when the stream
+    is closed, after the rows were parsed.  The caller must discard what it
+    imported from them.
+    """
+    return ZipMemberStream(DownloadStream(dest, **kwargs), 'allCountries.txt')
+
+
 def export_to_girder(data, folder, user):
-    """Export the geonames data to a girder folder."""
+    """Export the geonames data to a girder folder.
+
+    Returns a list of ``(feature, error)`` tuples for the rows that failed.
+    """
     item = ModelImporter.model('item')
+    failed = []
     for d in data:
         name = d['properties']['name']
         desc = ', '.join(d['properties']['alternatenames'])
@@ -206,13 +502,15 @@ def export_to_girder(data, folder, user):
                 folder=folder,
                 description=desc
             )
-        except Exception:
+        except Exception as e:
             sys.stderr.write('Failed to insert item "{}"\n'.format(repr(name)))
-            return
+            failed.append((d, e))
+            continue
 
         try:
-            item.setMetadata(i, d['properties'])
-        except Exception:
+            item.setMetadata(i, _item_metadata(d['properties']))
+        except Exception as e:
+            failed.append((d, e))
             sys.stderr.write('Failed to write metadata:\n')
             sys.stderr.write(json.dumps(
                 d,
@@ -225,7 +523,8 @@ def export_to_girder(data, folder, user):
                 'geometry': d['geometry']
             }
             i = item.updateItem(i)
-        except Exception:
+        except Exception as e:
+            failed.append((d, e))
             sys.stderr.write('Failed to write geospatial data:\n')
             sys.stderr.write(json.dumps(
                 i[GEOSPATIAL_FIELD],
@@ -233,25 +532,173 @@ def export_to_girder(data, folder, user):
                 indent=4
             ) + '\n')
 
+    return failed
+
+
+def _native(value):
+    """Convert numpy scalars to python types that bson can encode."""
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _item_metadata(properties):
+    """Return the item metadata of a geonames feature's properties.
+
+    The normalized names are stored along with the properties so names can
+    be looked up with an index instead of guessing their spellings.
+    """
+    meta = {k: _native(v) for k, v in properties.iteritems()}
+    meta['names'] = normalized_names(meta)
+    return meta
+
+
+def _item_document(feature, folder, user, now):
+    """Return the item document for a geonames feature."""
+    properties = _item_metadata(feature['properties'])
+    return {
+        'name': properties['name'],
+        'description': ', '.join(properties.get('alternatenames', ())),
+        'folderId': folder['_id'],
+        'creatorId': user['_id'],
+        'baseParentType': folder['baseParentType'],
+        'baseParentId': folder['baseParentId'],
+        'created': now,
+        'updated': now,
+        'size': 0,
+        'meta': properties,
+        GEOSPATIAL_FIELD: {
+            'geometry': feature['geometry']
+        }
+    }
+
 
-def read_geonames(folder=None, user=None, file_name=_allZip, chunksize=100,
-                  progress=None, done=None, handler=export_to_girder):
-    """Read a geonames dump and return a pandas Dataframe."""
-    import pandas
+def _bulk_failures(error, data, docs):
+    """Return the failed features of an unordered bulk write."""
+    failed = []
+    for e in error.details.get('writeErrors', []):
+        sys.stderr.write('Failed to write item "{}": {}\n'.format(
+            repr(docs[e['index']]['name']), e.get('errmsg')
+        ))
+        failed.append((data[e['index']], e.get('errmsg')))
+    return failed
 
-    if progress is None:
-        progress = progress_report
 
-    if done is None:
-        done = done_report
+def bulk_export_to_girder(data, folder, user):
+    """Export the geonames data to a girder folder using bulk writes.
+
+    Complete item documents are built in memory and written with a single
+    unordered ``insert_many`` per chunk instead of three round trips per
+    item.  This bypasses ``Item.createItem`` and with it the per item name
+    deduplication query and the ``model.item.save`` events.  Duplicate
+    place names are expected in the gazetteer, and geonames items carry no
+    files, so nothing else depends on those hooks.
+
+    Returns a list of ``(feature, error)`` tuples for the rows that failed.
+    """
+    if not data:
+        return []
 
+    now = datetime.datetime.utcnow()
+    docs = [_item_document(d, folder, user, now) for d in data]
+
+    collection = ModelImporter.model('item').collection
+    try:
+        collection.insert_many(docs, ordered=False)
+    except BulkWriteError as e:
+        # unordered inserts still write every valid document
+        return _bulk_failures(e, data, docs)
+    return []
+
+
+def bulk_upsert_to_girder(data, folder, user):
+    """Upsert the geonames data into a girder folder keyed by geonameid.
+
+    Existing items keep their ``_id``, creator and creation date, so the
+    geospatial and text indexes are only touched for the changed rows.
+
+    Returns a list of ``(feature, error)`` tuples for the rows that failed.
+    """
+    if not data:
+        return []
+
+    now = datetime.datetime.utcnow()
+    docs = []
+    requests = []
+    for d in data:
+        doc = _item_document(d, folder, user, now)
+        docs.append(doc)
+        insert_only = {
+            k: doc.pop(k) for k in (
+                'creatorId', 'baseParentType', 'baseParentId', 'created',
+                'size'
+            )
+        }
+        doc.pop('folderId')
+        requests.append(UpdateOne(
+            {'folderId': folder['_id'],
+             'meta.geonameid': doc['meta']['geonameid']},
+            {'$set': doc, '$setOnInsert': insert_only},
+            upsert=True
+        ))
+
+    collection = ModelImporter.model('item').collection
     try:
-        z = zipfile.ZipFile(file_name)
-        f = z.open('allCountries.txt')
-    except Exception:  # also try to open as a text file
-        f = open(file_name)
+        collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        return _bulk_failures(e, data, docs)
+    return []
+
+
+def delete_from_girder(geonameids, folder):
+    """Delete the items with the given geonameids from a girder folder.
+
+    Returns the number of items deleted.
+    """
+    if not geonameids:
+        return 0
+
+    collection = ModelImporter.model('item').collection
+    result = collection.delete_many({
+        'folderId': folder['_id'],
+        'meta.geonameid': {'$in': geonameids}
+    })
+    return result.deleted_count
+
 
-    reader = pandas.read_csv(
+def export_to_collection(data, folder=None, user=None):
+    """Export the geonames data to the compact geonames collection.
+
+    Places are upserted by geonameid, so the same handler serves the
+    initial import, resumed imports and daily modifications.  Returns a
+    list of ``(feature, error)`` tuples for the rows that failed.
+    """
+    return ModelImporter.model('geonames', 'minerva').upsertFeatures(data)
+
+
+def delete_from_collection(geonameids, folder=None):
+    """Delete the given geonameids from the geonames collection."""
+    return ModelImporter.model('geonames', 'minerva').removeIds(geonameids)
+
+
+def read_table(file_name=_allZip, chunksize=_chunksize):
+    """Return an iterator over chunks of a geonames table as data frames.
+
+    The file is either the zipped dump, the uncompressed text file or a file
+    like object over the text, such as :func:`stream_all_countries`.
+    """
+    import pandas
+
+    if hasattr(file_name, 'read'):
+        f = file_name
+    else:
+        try:
+            z = zipfile.ZipFile(file_name)
+            f = z.open('allCountries.txt')
+        except Exception:  # also try to open as a text file
+            f = open(file_name)
+
+    return pandas.read_csv(
         f,
         sep='\t',
         error_bad_lines=False,
@@ -263,70 +710,450 @@ def read_geonames(folder=None, user=None, file_name=_allZip, chunksize=100,
         chunksize=chunksize,
         dtype=_types,
         engine='c',
-        converters=_converters,
         quoting=3
     )
 
-    # alldata = pandas.DataFrame()
+
+def read_geonames(folder=None, user=None, file_name=_allZip,
+                  chunksize=_chunksize, progress=None, done=None,
+                  handler=export_to_girder, offset=0, checkpoint=None,
+                  quarantine=None, workers=0, writers=0, depth=4,
+                  last_geonameid=None):
+    """Read a geonames dump and export it in chunks through handler.
+
+    The first ``offset`` rows are skipped so that an interrupted import can
+    be resumed.  After each chunk is exported ``checkpoint`` is called with
+    the number of rows consumed and the geonameid of the last of them, and
+    rows the handler fails to export are passed to ``quarantine``.  When
+    resuming, ``last_geonameid`` is the geonameid of the checkpoint and a
+    ``ValueError`` is raised if the row before ``offset`` has another one,
+    as the file changed since.
+
+    Chunks after the checkpoint may have been exported before the import
+    was interrupted, so resumed imports should use a handler that upserts.
+
+    With ``workers`` or ``writers`` set the import is pipelined, see
+    :func:`pipeline`.  Checkpoints and progress are still reported in file
+    order.
+
+    Returns the number of rows read and the parse and cleanup throughput in
+    rows per second.
+    """
+    if progress is None:
+        progress = progress_report
+
+    if done is None:
+        done = done_report
+
+    reader = read_table(file_name, chunksize)
+
     n = 10200000
-    for i, chunk in enumerate(reader):
+    stats = {'rows': offset, 'parsed': 0, 'seconds': 0.0}
+
+    # the geonameid of the last row of each chunk by rows consumed, rows
+    # without coordinates are not among the features
+    last_ids = {}
 
-        i = i * chunksize
+    def chunks():
+        for rows, chunk in _skip_rows(reader, offset, last_geonameid):
+            last_ids[rows] = int(chunk['geonameid'].iloc[-1])
+            yield rows, chunk
 
-        records = chunk.to_dict(orient='records')
+    def export(features):
+        export_chunk(features, folder, user, handler, quarantine)
 
-        export_chunk(records, folder, user, handler)
+    def commit(rows, count, features, seconds):
+        stats['rows'] = rows
+        stats['parsed'] += count
+        stats['seconds'] += seconds
+        geonameid = last_ids.pop(rows)
+        if checkpoint is not None:
+            checkpoint(rows, geonameid)
+
+        if not features:
+            return
 
         # there are about 10.1 million rows now
         progress(
-            i, max(i, n),
-            u'Importing item #{}: {}'.format(i, records[0]['name']),
+            rows, max(rows, n),
+            u'Importing item #{}: {} (parsing {:.0f} rows/s)'.format(
+                rows, features[0]['properties']['name'],
+                stats['parsed'] / max(stats['seconds'], 1e-9)),
             'lines'
         )
 
+    pipeline(chunks(), export, commit,
+             workers=workers, writers=writers, depth=depth)
+
     done()
+    return stats['rows'], stats['parsed'] / max(stats['seconds'], 1e-9)
+
+
+def _skip_rows(reader, offset, last_geonameid=None):
+    """Yield the chunks of reader past offset and the rows consumed.
+
+    With ``last_geonameid`` the row before offset must have that geonameid,
+    otherwise the file isn't the one the offset was counted in and a
+    ``ValueError`` is raised.
+    """
+    rows = 0
+    for chunk in reader:
+        start = rows
+        rows += len(chunk)
+        if last_geonameid is not None and start < offset <= rows:
+            geonameid = int(chunk['geonameid'].iloc[offset - start - 1])
+            if geonameid != last_geonameid:
+                raise ValueError(
+                    'Row %d has geonameid %d instead of %d, the file changed '
+                    'since the checkpoint' % (offset, geonameid,
+                                              last_geonameid))
+            last_geonameid = None
+        if rows <= offset:
+            continue
+        if start < offset:
+            chunk = chunk.iloc[offset - start:]
+        yield rows, chunk
+
+    if last_geonameid is not None and offset:
+        raise ValueError('The file has %d rows, fewer than the %d of the '
+                         'checkpoint' % (rows, offset))
+
+
+def _timed_clean(chunk):
+    """Clean a chunk, returning the features and the time it took."""
+    tick = time.time()
+    features = clean_chunk(chunk)
+    return features, time.time() - tick
+
 
+class Ready(object):
 
-def export_chunk(records, folder, user,
-                 handler=export_to_girder):
-    """Export the geonames data to mongo."""
-    def is_nan(x):
-        """Return true if the value is NaN."""
-        if not isinstance(x, float):
-            return False
-        return not (x <= 0 or x >= 0)
+    """A result computed in process, with the interface of AsyncResult."""
+
+    def __init__(self, value):
+        self.value = value
+
+    def get(self):
+        return self.value
+
+
+def close_pool(pool, results):
+    """Close a process pool once the given results are done.
+
+    Python 2 pools can hang when terminated with tasks in flight, so this
+    waits for the results that are left instead, ignoring their errors.
+    """
+    for result in results:
+        try:
+            result.get()
+        except Exception:
+            pass
+    pool.close()
+    pool.join()
+
+
+def pipeline(chunks, export, commit, workers=0, writers=0, depth=4):
+    """Parse, clean and export geonames chunks in overlapping stages.
+
+    ``chunks`` yields ``(rows, chunk)`` pairs and is read in the calling
+    thread.  Each chunk is cleaned in a pool of ``workers`` processes and
+    its features passed to ``export`` by one of ``writers`` threads.  At
+    most ``depth`` chunks wait at each stage, so a slow stage holds back
+    the ones before it instead of buffering the whole file.
+
+    ``commit(rows, count, features, seconds)`` is called in file order once
+    a chunk and every chunk before it is exported, with the number of rows
+    parsed and the time spent parsing and cleaning the chunk.  Without
+    workers or writers every stage runs in turn in the calling thread.
+    """
+    iterator = iter(chunks)
+
+    def parse():
+        tick = time.time()
+        try:
+            rows, chunk = next(iterator)
+        except StopIteration:
+            return None
+        return rows, chunk, time.time() - tick
+
+    if not workers and not writers:
+        while True:
+            parsed = parse()
+            if parsed is None:
+                return
+            rows, chunk, seconds = parsed
+            features, clean_seconds = _timed_clean(chunk)
+            export(features)
+            commit(rows, len(chunk), features, seconds + clean_seconds)
+
+    import multiprocessing
+
+    queue = Queue.Queue(maxsize=depth)
+    lock = threading.Lock()
+    exported = {}
+    state = {'next': 0, 'error': None}
+
+    def write():
+        while True:
+            item = queue.get()
+            if item is None:
+                return
+            index = item[0]
+            try:
+                if state['error'] is None:
+                    export(item[3])
+                with lock:
+                    exported[index] = item[1:]
+                    while state['next'] in exported:
+                        commit(*exported.pop(state['next']))
+                        state['next'] += 1
+            except Exception:
+                state['error'] = sys.exc_info()
+
+    # the workers are forked from a process that already holds mongo
+    # clients and threads, such as the server's, so they only clean chunks
+    # and never use the database or a lock they inherited
+    pool = None
+    if workers:
+        pool = multiprocessing.Pool(workers)
+
+    threads = []
+    for _ in xrange(max(writers, 1)):
+        thread = threading.Thread(target=write, name='geonames-writer')
+        thread.daemon = True
+        thread.start()
+        threads.append(thread)
+
+    pending = collections.deque()
+
+    def finish():
+        """Hand the oldest cleaned chunk to the writers."""
+        index, rows, count, seconds, result = pending.popleft()
+        features, clean_seconds = result.get()
+        queue.put((index, rows, count, features, seconds + clean_seconds))
+
+    try:
+        index = 0
+        while state['error'] is None:
+            parsed = parse()
+            if parsed is None:
+                break
+            rows, chunk, seconds = parsed
+            if pool is not None:
+                result = pool.apply_async(_timed_clean, (chunk,))
+            else:
+                result = Ready(_timed_clean(chunk))
+            pending.append((index, rows, len(chunk), seconds, result))
+            index += 1
+
+            if len(pending) > depth:
+                finish()
+
+        while pending and state['error'] is None:
+            finish()
+    finally:
+        for thread in threads:
+            queue.put(None)
+        for thread in threads:
+            thread.join()
+        if pool is not None:
+            close_pool(pool, [item[-1] for item in pending])
+
+    if state['error'] is not None:
+        raise state['error'][0], state['error'][1], state['error'][2]
+
+
+def clean_chunk(chunk):
+    """Return geojson point features from a chunk of the geonames table.
+
+    Empty and invalid values are masked with vectorized operations on the
+    whole chunk, so each row is only touched by python once to build its
+    properties.  Rows without coordinates are dropped.
+    """
+    import pandas
+
+    valid = chunk['longitude'].notnull() & chunk['latitude'].notnull()
+    if not valid.all():
+        for row in chunk[~valid].itertuples(index=False):
+            print('Invalid geometry: ' + repr(tuple(row)))
+        chunk = chunk[valid]
+
+    columns = []
+    for column in _columns:
+        if column in ('longitude', 'latitude'):
+            continue
+
+        values = chunk[column]
+        if column in _integer_columns:
+            values = pandas.to_numeric(values, errors='coerce')
+            mask = values.notnull()
+            if _integer_columns[column]:
+                mask &= values > 0
+            values = values.fillna(0).astype(np.int64)
+        elif column in _list_columns:
+            # empty lists are kept
+            mask = pandas.Series(True, index=values.index)
+            values = [
+                v if isinstance(v, list) else []
+                for v in values.str.split(',')
+            ]
+        elif column == 'modification date':
+            mask = values.notnull()
+            if values.dtype.kind == 'M':
+                values = values.dt.to_pydatetime()
+        else:
+            mask = values.notnull()
+
+        if mask.any():
+            columns.append((column, list(values), mask.tolist()))
+
+    coordinates = np.column_stack((
+        chunk['longitude'].values, chunk['latitude'].values
+    )).tolist()
 
     features = []
-    for d in records:
-        # create a geojson point feature for girder's geospatial plugin
-        feature = {
+    for i, point in enumerate(coordinates):
+        features.append({
             'type': 'Feature',
             'geometry': {
                 'type': 'Point',
+                'coordinates': point
             },
-            'properties': d
-
-        }
+            'properties': {
+                column: values[i]
+                for column, values, mask in columns if mask[i]
+            }
+        })
+    return features
 
-        # remove empty/invalid fields
-        for k in _columns:
-            val = d.get(k)
-            if is_nan(val) or val is None:
-                d.pop(k)
-            elif k in ('population', 'dem') and val <= 0:
-                d.pop(k)
 
-        if 'longitude' not in d or 'latitude' not in d:
-            print('Invalid geometry: ' + repr(d))
-            continue
+def export_chunk(features, folder, user,
+                 handler=export_to_girder, quarantine=None):
+    """Export geonames features to mongo.
 
-        feature['geometry']['coordinates'] = [
-            d.pop('longitude'),
-            d.pop('latitude')
-        ]
-        features.append(feature)
+    If the handler fails on the whole chunk it is retried one row at a
+    time, so a bad row is quarantined rather than losing the rest of the
+    chunk.  Returns the list of ``(feature, error)`` tuples that failed.
+    """
+    try:
+        failed = handler(features, folder, user) or []
+    except Exception:
+        failed = []
+        for feature in features:
+            try:
+                failed.extend(handler([feature], folder, user) or [])
+            except Exception as e:
+                failed.append((feature, e))
+
+    if failed and quarantine is not None:
+        quarantine(failed)
+
+    return failed
+
+
+def read_deletes(folder=None, file_name=None, chunksize=1000,
+                 delete=delete_from_girder):
+    """Delete the rows listed in a geonames ``deletes-*.txt`` file.
+
+    Each line holds the geonameid, name and a comment separated by tabs.
+    Returns the number of items deleted.
+    """
+    deleted = 0
+    geonameids = []
+    with open(file_name) as f:
+        for line in f:
+            geonameid = line.split('\t', 1)[0].strip()
+            if not geonameid.isdigit():
+                continue
+            geonameids.append(int(geonameid))
+
+            if len(geonameids) >= chunksize:
+                deleted += delete(geonameids, folder)
+                geonameids = []
+
+    deleted += delete(geonameids, folder)
+    return deleted
+
+
+def update_geonames(folder=None, user=None, modifications=(), deletes=(),
+                    progress=None, done=None, quarantine=None,
+                    handler=bulk_upsert_to_girder, delete=delete_from_girder):
+    """Apply geonames daily modification and delete files to a folder.
+
+    The ``modifications-*.txt`` files have the same layout as
+    ``allCountries.txt`` and are upserted keyed by geonameid, then the
+    rows listed in the ``deletes-*.txt`` files are removed.  Returns the
+    number of items deleted.
+    """
+    for file_name in modifications:
+        read_geonames(
+            folder, user, file_name=file_name, progress=progress, done=done,
+            handler=handler, quarantine=quarantine
+        )
 
-    handler(features, folder, user)
+    deleted = 0
+    for file_name in deletes:
+        deleted += read_deletes(folder, file_name, delete=delete)
+    return deleted
+
+
+def migrate_items(folder, chunksize=1000, remove=False, progress=None):
+    """Copy the geonames items of a folder to the geonames collection.
+
+    The items are removed once copied when ``remove`` is true, the ones
+    kept get the normalized names items are looked up by since they were
+    imported by earlier versions.  Returns the number of places copied and
+    a list of ``(feature, error)`` tuples for the ones that failed.
+    """
+    items = ModelImporter.model('item').collection
+    query = {
+        'folderId': folder['_id'],
+        'meta.geonameid': {'$exists': True}
+    }
+    total = items.count(query)
+
+    def migrate(docs):
+        features = [{
+            'type': 'Feature',
+            'geometry': doc[GEOSPATIAL_FIELD]['geometry'],
+            'properties': doc['meta']
+        } for doc in docs]
+        failed = export_to_collection(features)
+        if remove:
+            failed_ids = {f['properties']['geonameid'] for f, _ in failed}
+            items.delete_many({'_id': {'$in': [
+                doc['_id'] for doc in docs
+                if doc['meta']['geonameid'] not in failed_ids
+            ]}})
+        else:
+            updates = [
+                UpdateOne({'_id': doc['_id']}, {'$set': {
+                    'meta.names': normalized_names(doc['meta'])
+                }})
+                for doc in docs if 'names' not in doc['meta']
+            ]
+            if updates:
+                items.bulk_write(updates, ordered=False)
+        return failed
+
+    count = 0
+    failed = []
+    docs = []
+    cursor = items.find(query, projection=['meta', GEOSPATIAL_FIELD])
+    for doc in cursor:
+        docs.append(doc)
+        if len(docs) >= chunksize:
+            failed.extend(migrate(docs))
+            count += len(docs)
+            docs = []
+            if progress is not None:
+                progress(count, total, 'Migrating geonames items', 'items')
+
+    if docs:
+        failed.extend(migrate(docs))
+        count += len(docs)
+
+    return count - len(failed), failed
 
 
 # move to settings
@@ -0,0 +1,163 @@
+"""Manage the indexes used by the geonames gazetteer.
+
+The geonames items live in the shared girder item collection, so every
+index is compound on ``folderId`` and, when the server supports partial
+indexes, only covers the items of the geonames folder.  Queries must
+include the ``folderId`` of the folder to use them.
+
+Girder already maintains a text index on the item name and description,
+which is what the geocode endpoint searches.  Mongo allows a single text
+index per collection, so it is reported here but not replaced: a text
+index prefixed with ``folderId`` would have to replace girder's, and a
+text search without a folder, such as girder's own item search, can't
+use such an index.
+"""
+
+import time
+
+from pymongo import ASCENDING, GEOSPHERE
+
+#: Indexes needed while writing, upserts and deletes are keyed on geonameid
+#: and a resumed import must not write a row twice
+PRE_IMPORT = [
+    ('geonames_geonameid', [
+        ('folderId', ASCENDING),
+        ('meta.geonameid', ASCENDING)
+    ])
+]
+
+#: Indexes used by queries, built once the bulk load is done because
+#: maintaining them during the insert is much slower than a single build
+POST_IMPORT = [
+    ('geonames_geo', [
+        ('folderId', ASCENDING),
+        ('geo.geometry.coordinates', GEOSPHERE)
+    ]),
+    ('geonames_asciiname', [
+        ('folderId', ASCENDING),
+        ('meta.asciiname', ASCENDING)
+    ]),
+    ('geonames_alternatenames', [
+        ('folderId', ASCENDING),
+        ('meta.alternatenames', ASCENDING)
+    ]),
+    ('geonames_names', [
+        ('folderId', ASCENDING),
+        ('meta.names', ASCENDING)
+    ])
+]
+
+#: Indexes enforcing one item per key.  Only partial indexes can be unique,
+#: the other items of the collection have no geonameid.
+UNIQUE = ('geonames_geonameid',)
+
+#: Collection wide indexes created by earlier versions of the import
+LEGACY = (
+    'geo.geometry.coordinates_2dsphere',
+    'meta.asciiname_1',
+    'meta.alternatenames_1',
+    'folderId_1_meta.geonameid_1'
+)
+
+
+def supports_partial(collection):
+    """Return true if the mongo server supports partial indexes."""
+    version = collection.database.client.server_info()['versionArray']
+    return version[:2] >= [3, 2]
+
+
+def index_name(name, folder, partial):
+    """Return the name of an index, partial indexes are per folder."""
+    if partial:
+        return '%s_%s' % (name, folder['_id'])
+    return name
+
+
+def index_sizes(collection):
+    """Return the size in bytes of each index of the collection."""
+    stats = collection.database.command('collStats', collection.name)
+    return stats.get('indexSizes', {})
+
+
+def text_index(collection):
+    """Return the name and keys of the collection's text index."""
+    for name, info in collection.index_information().iteritems():
+        if any(key == '_fts' for key, _ in info['key']):
+            return name, info['key']
+    return None, None
+
+
+def drop_legacy_indexes(collection):
+    """Drop the collection wide geonames indexes of earlier imports."""
+    existing = collection.index_information()
+    dropped = []
+    for name in LEGACY:
+        if name in existing:
+            collection.drop_index(name)
+            dropped.append(name)
+    return dropped
+
+
+def build_indexes(collection, folder, indexes=PRE_IMPORT + POST_IMPORT,
+                  background=True, partial=None, progress=None):
+    """Build the given indexes for a geonames folder.
+
+    Returns a report listing the name, key, build time in seconds and size
+    in bytes of every index.  Building a unique index fails if the folder
+    already holds duplicates.  Indexes that already exist are left as they
+    are, so their build time only measures the round trip.
+    """
+    if partial is None:
+        partial = supports_partial(collection)
+
+    existing = collection.index_information()
+    report = []
+    for i, (name, keys) in enumerate(indexes):
+        options = {
+            'name': index_name(name, folder, partial),
+            'background': background
+        }
+        if partial:
+            options['partialFilterExpression'] = {'folderId': folder['_id']}
+            if name in UNIQUE:
+                # the import markers of the folder have no geonameid
+                options['partialFilterExpression']['meta.geonameid'] = {
+                    '$exists': True
+                }
+                options['unique'] = True
+
+        # an index built by an earlier version with other options can't be
+        # replaced in place
+        info = existing.get(options['name'])
+        if info is not None and \
+                bool(info.get('unique')) != options.get('unique', False):
+            collection.drop_index(options['name'])
+
+        if progress is not None:
+            progress(i, len(indexes), u'Building index {}'.format(
+                options['name']), 'indexes')
+
+        tick = time.time()
+        collection.create_index(keys, **options)
+        report.append({
+            'name': options['name'],
+            'key': keys,
+            'partial': partial,
+            'seconds': time.time() - tick
+        })
+
+    sizes = index_sizes(collection)
+    for index in report:
+        index['size'] = sizes.get(index['name'], 0)
+
+    name, keys = text_index(collection)
+    if name is not None:
+        report.append({
+            'name': name,
+            'key': keys,
+            'partial': False,
+            'seconds': None,
+            'size': sizes.get(name, 0)
+        })
+
+    return report
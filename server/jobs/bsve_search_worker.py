@@ -3,8 +3,10 @@ import os
 import shutil
 import sys
 import tempfile
+import time
 import traceback
 
+from girder import logger
 from girder.constants import AccessType
 from girder.utility import config
 from girder.utility.model_importer import ModelImporter
@@ -12,92 +14,179 @@ from girder.plugins.jobs.constants import JobStatus
 from girder.plugins.minerva.utility.bsve.bsve_utility import BsveUtility
 from girder.plugins.minerva.utility.dataset_utility import \
     jsonArrayHead
+from girder.plugins.minerva.utility.schedule_utility import callLater
 
 
 import girder_client
 
 
+# Seconds before the first check of a search, doubled after each check
+# up to MAX_DELAY
+INITIAL_DELAY = 2
+MAX_DELAY = 60
+# Seconds a search may take before the job fails
+TIMEOUT = 3600
+# Times a check that fails to load or schedule the job is retried
+MAX_CHECK_RETRIES = 5
+
+
 def run(job):
+    """
+    Run a step of a bsve search job.  The first step submits the search and
+    saves its request id on the job, later steps check the search once.
+    Each step reschedules the job to check again, with an exponential
+    backoff, until the results are ready, so no thread waits on the search.
+    """
     job_model = ModelImporter.model('job', 'jobs')
-    job_model.updateJob(job, status=JobStatus.RUNNING)
 
     try:
         kwargs = job['kwargs']
-        bsveSearchParams = kwargs['params']['bsveSearchParams']
-        datasetId = str(kwargs['dataset']['_id'])
-        # TODO better to create a job token rather than a user token?
-        token = kwargs['token']
-
+        state = kwargs.get('bsve')
         bsveUtility = BsveUtility()
 
-        # TODO sleeping in async thread, probably starving other tasks
-        # would be better to split this into two or more parts, creating
-        # additional jobs as needed
-        searchResult = bsveUtility.searchUntilResult(bsveSearchParams)
-
-        # write the output to a json file
-        tmpdir = tempfile.mkdtemp()
-        outFilepath = tempfile.mkstemp(suffix='.json', dir=tmpdir)[1]
-        writer = open(outFilepath, 'w')
-        writer.write(json.dumps(searchResult))
-        writer.close()
-
-        # rename the file so it will have the right name when uploaded
-        # could probably be done post upload
-        outFilename = 'search.json'
-        humanFilepath = os.path.join(tmpdir, outFilename)
-        shutil.move(outFilepath, humanFilepath)
-
-        # connect to girder and upload the file
-        # TODO will probably have to change this from local to romanesco
-        # so that can work on worker machine
-        # at least need host connection info
-        girderPort = config.getConfig()['server.socket_port']
-        client = girder_client.GirderClient(port=girderPort)
-        client.token = token['_id']
-
-        client.uploadFileToItem(datasetId, humanFilepath)
-
-        # TODO some stuff here using models will only work on a local job
-        # will have to be rewritten using girder client to work in romanesco
-        # non-locally
-
-        user_model = ModelImporter.model('user')
-        user = user_model.load(job['userId'], force=True)
-        item_model = ModelImporter.model('item')
-        # TODO only works locally
-        dataset = item_model.load(datasetId, level=AccessType.WRITE, user=user)
-        metadata = dataset['meta']
-        minerva_metadata = metadata['minerva']
-
-        # TODO only works locally
-        file_model = ModelImporter.model('file')
-        existing = file_model.findOne({
-            'itemId': dataset['_id'],
-            'name': outFilename
-        })
-        if existing:
-            minerva_metadata['original_files'] = [{
-                '_id': existing['_id'],
-                'name': outFilename
-            }]
+        if state is None:
+            job_model.updateJob(job, status=JobStatus.RUNNING)
+            bsveSearchParams = kwargs['params']['bsveSearchParams']
+            state = {
+                'requestId': bsveUtility.searchRequest(bsveSearchParams),
+                'submitted': time.time(),
+                'checks': 0,
+                'delay': INITIAL_DELAY
+            }
         else:
-            raise (Exception('Cannot find file %s in dataset %s' %
-                   (outFilename, datasetId)))
-
-        jsonRow = jsonArrayHead(humanFilepath, limit=1)[0]
-        minerva_metadata['json_row'] = jsonRow
-
-        shutil.rmtree(tmpdir)
-
-        metadata['minerva'] = minerva_metadata
-        # TODO only works locally
-        item_model.setMetadata(dataset, metadata)
-        # TODO only works locally
-        job_model.updateJob(job, status=JobStatus.SUCCESS)
+            search = bsveUtility.searchStatus(state['requestId'])
+            if search['status'] == 1:
+                saveResults(job, search['results'])
+                # TODO only works locally
+                job_model.updateJob(job, status=JobStatus.SUCCESS)
+                return
+            elif search['status'] == -1:
+                raise (Exception('bsve search %s failed: %s' %
+                       (state['requestId'], json.dumps(search))))
+            elif time.time() - state['submitted'] > TIMEOUT:
+                raise (Exception('bsve search %s timed out after %d s' %
+                       (state['requestId'], TIMEOUT)))
+            state['checks'] += 1
+            state['delay'] = min(state['delay'] * 2, MAX_DELAY)
+
+        kwargs['bsve'] = state
+        job_model.save(job)
+        callLater(state['delay'], checkSearch, job['_id'])
     except Exception:
         t, val, tb = sys.exc_info()
         log = '%s: %s\n%s' % (t.__name__, repr(val), traceback.extract_tb(tb))
         # TODO only works locally
         job_model.updateJob(job, status=JobStatus.ERROR, log=log)
         raise
+
+
+def checkSearch(jobId, retries=0):
+    """
+    Schedule the next step of a bsve search job still running.  A check
+    that fails, e.g. while the database is unavailable, is retried with a
+    backoff, then fails the job.
+    """
+    job_model = ModelImporter.model('job', 'jobs')
+    try:
+        job = job_model.load(jobId, force=True)
+        if job is not None and job['status'] == JobStatus.RUNNING:
+            job_model.scheduleJob(job)
+    except Exception:
+        if retries < MAX_CHECK_RETRIES:
+            logger.exception('Check of bsve search job %s failed, retrying' %
+                             jobId)
+            callLater(min(INITIAL_DELAY * 2 ** retries, MAX_DELAY),
+                      checkSearch, jobId, retries + 1)
+            return
+        t, val, tb = sys.exc_info()
+        log = '%s: %s\n%s' % (t.__name__, repr(val), traceback.extract_tb(tb))
+        job_model.updateJob(job_model.load(jobId, force=True),
+                            status=JobStatus.ERROR, log=log)
+        raise
+
+
+def resumeSearches():
+    """
+    Reschedule the checks of the bsve search jobs left running by an
+    earlier server process, as the pending checks are only kept in memory.
+    Jobs that stopped before their search was submitted are failed.
+    """
+    job_model = ModelImporter.model('job', 'jobs')
+    jobs = job_model.find({
+        'type': 'bsve.search',
+        'status': JobStatus.RUNNING
+    })
+    for job in jobs:
+        if 'bsve' in job['kwargs']:
+            callLater(INITIAL_DELAY, checkSearch, job['_id'])
+        else:
+            job_model.updateJob(
+                job, status=JobStatus.ERROR,
+                log='bsve search interrupted before it was submitted')
+
+
+def saveResults(job, searchResult):
+    """Upload the results of a search to the job's dataset."""
+    kwargs = job['kwargs']
+    datasetId = str(kwargs['dataset']['_id'])
+    # TODO better to create a job token rather than a user token?
+    token = kwargs['token']
+
+    # write the output to a json file
+    tmpdir = tempfile.mkdtemp()
+    outFilepath = tempfile.mkstemp(suffix='.json', dir=tmpdir)[1]
+    writer = open(outFilepath, 'w')
+    writer.write(json.dumps(searchResult))
+    writer.close()
+
+    # rename the file so it will have the right name when uploaded
+    # could probably be done post upload
+    outFilename = 'search.json'
+    humanFilepath = os.path.join(tmpdir, outFilename)
+    shutil.move(outFilepath, humanFilepath)
+
+    # connect to girder and upload the file
+    # TODO will probably have to change this from local to romanesco
+    # so that can work on worker machine
+    # at least need host connection info
+    girderPort = config.getConfig()['server.socket_port']
+    client = girder_client.GirderClient(port=girderPort)
+    client.token = token['_id']
+
+    client.uploadFileToItem(datasetId, humanFilepath)
+
+    # TODO some stuff here using models will only work on a local job
+    # will have to be rewritten using girder client to work in romanesco
+    # non-locally
+
+    user_model = ModelImporter.model('user')
+    user = user_model.load(job['userId'], force=True)
+    item_model = ModelImporter.model('item')
+    # TODO only works locally
+    dataset = item_model.load(datasetId, level=AccessType.WRITE, user=user)
+    metadata = dataset['meta']
+    minerva_metadata = metadata['minerva']
+
+    # TODO only works locally
+    file_model = ModelImporter.model('file')
+    existing = file_model.findOne({
+        'itemId': dataset['_id'],
+        'name': outFilename
+    })
+    if existing:
+        minerva_metadata['original_files'] = [{
+            '_id': existing['_id'],
+            'name': outFilename
+        }]
+    else:
+        raise (Exception('Cannot find file %s in dataset %s' %
+               (outFilename, datasetId)))
+
+    jsonRow = jsonArrayHead(humanFilepath, limit=1)[0]
+    minerva_metadata['json_row'] = jsonRow
+
+    shutil.rmtree(tmpdir)
+
+    metadata['minerva'] = minerva_metadata
+    # TODO only works locally
+    item_model.setMetadata(dataset, metadata)
@@ -22,9 +22,11 @@ import json
 import os
 
 from girder import constants, events
+from girder.models.model_base import ValidationException
 from girder.utility.model_importer import ModelImporter
 
 from girder.plugins.minerva.rest import analysis, dataset, s3_dataset, session, shapefile, geocode
+from girder.plugins.minerva.jobs import bsve_search_worker
 
 
 class CustomAppRoot(object):
@@ -144,6 +146,16 @@ def validate_settings(event):
     if key == 'minerva.geonames_folder':
         ModelImporter.model('folder').load(val, exc=True, force=True)
         event.preventDefault().stopPropagation()
+    elif key == 'minerva.geonames_storage':
+        if val not in ('item', 'collection'):
+            raise ValidationException(
+                'Geonames storage must be "item" or "collection".', 'value')
+        event.preventDefault().stopPropagation()
+    elif key == 'minerva.geonames_index':
+        if not isinstance(val, bool):
+            raise ValidationException(
+                'Geonames index must be a boolean.', 'value')
+        event.preventDefault().stopPropagation()
 
 
 def load(info):
@@ -162,11 +174,26 @@ def load(info):
     info['apiRoot'].geonames = geocodeREST = geocode.Geonames()
     info['apiRoot'].geonames.route('POST', ('setup',),
                                    geocodeREST.setup)
+    info['apiRoot'].geonames.route('POST', ('update',),
+                                   geocodeREST.update)
+    info['apiRoot'].geonames.route('POST', ('index',),
+                                   geocodeREST.index)
+    info['apiRoot'].geonames.route('POST', ('migrate',),
+                                   geocodeREST.migrate)
     info['apiRoot'].geonames.route('GET', ('geocode',),
                                    geocodeREST.geocode)
+    info['apiRoot'].geonames.route('POST', ('geocode',),
+                                   geocodeREST.batchGeocode)
+    info['apiRoot'].geonames.route('GET', ('reverse',),
+                                   geocodeREST.reverse)
+    info['apiRoot'].geonames.route('POST', ('reverse',),
+                                   geocodeREST.reverse)
     events.bind('model.setting.validate', 'minerva', validate_settings)
 
     info['apiRoot'].minerva_dataset = dataset.Dataset()
     info['apiRoot'].minerva_analysis = analysis.Analysis()
     info['apiRoot'].minerva_session = session.Session()
     info['apiRoot'].minerva_dataset_s3 = s3_dataset.S3Dataset()
+
+    # the checks of running bsve searches were lost with the last process
+    bsve_search_worker.resumeSearches()
@@ -0,0 +1,143 @@
+"""Indexes and retention of the twitter query collections.
+
+Each query is ingested into its own collection of the minerva database.
+Dataset queries filter tweets by ``created_at`` and by location, so both
+are indexed, the compact GeoJSON ``location`` with a 2dsphere index, along
+with a unique index on the tweet ``id`` that ingestion upserts on.
+
+Collections are kept small either with a TTL index, on the
+``created_date`` datetime stored alongside the epoch ``created_at`` since
+mongo only expires documents by date fields, or by capping the collection
+to a size in bytes.  Capped collections drop their oldest tweets first
+but can't grow documents in place, so they suit the stream ingester
+better than repeated searches.
+"""
+from datetime import datetime
+
+import pymongo
+from pymongo import ASCENDING, GEOSPHERE, UpdateOne
+from pymongo.errors import OperationFailure
+
+from misc.twitter.locations import compact_location_dict
+
+#: Name of the TTL index
+TTL_INDEX = 'created_date_ttl'
+
+
+def add_derived_fields(rec):
+    """Add the TTL date of a tweet record"""
+    rec['created_date'] = datetime.utcfromtimestamp(rec['created_at'])
+    return rec
+
+
+def compact_stored_locations(collection, batch_size=1000):
+    """Convert the locations of older tweets to compact GeoJSON points.
+
+    Tweets used to store every attribute of their carmen location and a
+    separate ``geo`` point, which can't be indexed along with compact
+    locations.  Returns the number of tweets converted.
+    """
+    if 'geo_2dsphere' in collection.index_information():
+        collection.drop_index('geo_2dsphere')
+
+    converted = 0
+    requests = []
+    for doc in collection.find({
+        'location': {'$exists': True},
+        'location.type': {'$exists': False}
+    }, {'location': True}):
+        location = compact_location_dict(doc['location'])
+        if location is None:
+            update = {'$unset': {'location': '', 'geo': ''}}
+        else:
+            update = {'$set': {'location': location}, '$unset': {'geo': ''}}
+        requests.append(UpdateOne({'_id': doc['_id']}, update))
+        if len(requests) >= batch_size:
+            converted += collection.bulk_write(
+                requests, ordered=False).modified_count
+            requests = []
+    if requests:
+        converted += collection.bulk_write(
+            requests, ordered=False).modified_count
+    return converted
+
+
+def remove_duplicates(collection):
+    """Remove all but one document of each tweet id, returning the count"""
+    groups = collection.aggregate([
+        {'$group': {
+            '_id': '$id',
+            'ids': {'$push': '$_id'},
+            'count': {'$sum': 1}
+        }},
+        {'$match': {'count': {'$gt': 1}}}
+    ], allowDiskUse=True)
+
+    removed = 0
+    for group in groups:
+        removed += collection.delete_many({
+            '_id': {'$in': group['ids'][1:]}
+        }).deleted_count
+    return removed
+
+
+def set_ttl(collection, ttl):
+    """Expire tweets ttl seconds after they were created"""
+    existing = collection.index_information().get(TTL_INDEX)
+    if existing is None:
+        collection.create_index([('created_date', ASCENDING)],
+                                name=TTL_INDEX, expireAfterSeconds=ttl)
+    elif existing.get('expireAfterSeconds') != ttl:
+        collection.database.command('collMod', collection.name, index={
+            'keyPattern': {'created_date': ASCENDING},
+            'expireAfterSeconds': ttl
+        })
+
+
+def ensure_indexes(collection, ttl=None):
+    """Create the indexes of a tweet collection.
+
+    Duplicate tweets inserted before the unique id index existed are
+    removed first, and older locations converted to compact points.  With
+    ``ttl`` tweets expire that many seconds after they were created.
+    """
+    try:
+        collection.create_index('id', unique=True)
+    except OperationFailure as e:
+        if e.code != 11000:
+            raise
+        remove_duplicates(collection)
+        collection.create_index('id', unique=True)
+
+    collection.create_index([('created_at', ASCENDING)])
+    if 'location_2dsphere' not in collection.index_information():
+        # the index rejects locations that aren't GeoJSON
+        compact_stored_locations(collection)
+        collection.create_index([('location', GEOSPHERE)])
+    if ttl:
+        set_ttl(collection, ttl)
+
+
+def query_collection(query, client=None, ttl=None, max_bytes=None):
+    """Return the indexed collection of a query.
+
+    With ``max_bytes`` the collection is created capped to that size, or
+    converted if it already exists uncapped.  With ``ttl`` tweets expire
+    that many seconds after they were created.
+    """
+    if ttl and max_bytes:
+        raise ValueError('Use either a TTL or a capped size')
+
+    if client is None:
+        client = pymongo.MongoClient()
+    db = client.minerva
+
+    if max_bytes:
+        if query not in db.collection_names():
+            db.create_collection(query, capped=True, size=max_bytes)
+        elif not db[query].options().get('capped'):
+            db.command('convertToCapped', query, size=max_bytes)
+
+    collection = db[query]
+    ensure_indexes(collection, ttl)
+    return collection
@@ -0,0 +1,85 @@
+"""Compact serialization of resolved tweet locations.
+
+Geocoded tweets store their carmen location as a GeoJSON point, so mongo
+can index and query it with ``$geoWithin`` and ``$near``, along with the
+location's database id and its country, state, county and city names::
+
+    {
+        "type": "Point",
+        "coordinates": [2.35, 48.85],
+        "id": 1045,
+        "admin": ["France", "Ile-de-France", "", "Paris"]
+    }
+
+Aliases, resolution details and the other fields of the location
+database are looked up by id with :func:`location_details` when needed.
+"""
+import json
+import os
+
+#: Administrative names stored with each location, largest first
+ADMIN_FIELDS = ('country', 'state', 'county', 'city')
+
+_locations_file = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__)))),
+    'libs', 'carmen', 'data', 'locations.json')
+
+# Location database records by id, loaded on the first lookup
+_details = None
+
+
+def _compact(latitude, longitude, location_id, admin):
+    if latitude is None or longitude is None:
+        return None
+    return {
+        'type': 'Point',
+        'coordinates': [float(longitude), float(latitude)],
+        'id': int(location_id),
+        'admin': [name or u'' for name in admin]
+    }
+
+
+def compact_location(location):
+    """Return the compact form of a carmen Location, or None"""
+    if location is None:
+        return None
+    return _compact(
+        getattr(location, 'latitude', None),
+        getattr(location, 'longitude', None),
+        getattr(location, 'id', -1),
+        [getattr(location, field, None) for field in ADMIN_FIELDS])
+
+
+def compact_location_dict(location):
+    """Return the compact form of a location stored as a dict, or None.
+
+    Converts locations stored as the attributes of a carmen Location,
+    and returns compact locations unchanged.
+    """
+    if not location:
+        return None
+    if location.get('type') == 'Point':
+        return location
+    return _compact(
+        location.get('latitude'), location.get('longitude'),
+        location.get('id', -1),
+        [location.get(field) for field in ADMIN_FIELDS])
+
+
+def location_details(location_id):
+    """Return the location database record of an id, or None.
+
+    The database is read on the first call.  Locations carmen resolved
+    but doesn't know, such as new twitter places, have no record.
+    """
+    global _details
+    if _details is None:
+        details = {}
+        with open(_locations_file) as f:
+            for line in f:
+                if line.strip():
+                    record = json.loads(line)
+                    details[int(record['id'])] = record
+        _details = details
+    return _details.get(int(location_id))
@@ -0,0 +1,252 @@
+"""A pool of processes geocoding streamed tweets.
+
+The stream listener only enqueues the raw JSON of each tweet.  A
+dispatcher thread hands batches of them to a pool of worker processes,
+each loading its own filters such as the carmen resolver once, which parse,
+filter and convert the tweets to records.  A collector thread passes the
+records to a writer, such as a ``BulkWriter``, in the order received.
+"""
+import Queue
+import collections
+import json
+import sys
+import threading
+import time
+
+# Filters and record function of a pool worker process
+_filters = None
+_record = None
+
+# Queue marker for the pipeline threads
+_close = object()
+
+
+def _init_worker(filter_factories, record):
+    """Load the filters of a worker process."""
+    global _filters, _record
+    _filters = [factory() for factory in filter_factories]
+    _record = record
+
+
+def process_batch(batch):
+    """Parse, filter and convert a batch of raw tweets in a worker.
+
+    Returns the records, the number of tweets that failed and the seconds
+    spent.
+    """
+    tick = time.time()
+    records = []
+    errors = 0
+    for data in batch:
+        try:
+            json_data = json.loads(data)
+            for filter in _filters:
+                json_data = filter(json_data)
+            rec = _record(json_data)
+        except Exception:
+            errors += 1
+            continue
+        if rec is not None:
+            records.append(rec)
+    return records, errors, time.time() - tick
+
+
+class _Latency(object):
+
+    """The mean and maximum latency of a stage since the last report."""
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds, count=1):
+        self.count += count
+        self.total += seconds * count
+        self.max = max(self.max, seconds)
+
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class GeocodingPipeline(object):
+
+    """Geocode raw tweets in a process pool and pass them to a writer.
+
+    At most ``depth`` raw tweets wait for a worker and ``workers`` * 2
+    batches are in flight, so when the workers or the writer fall behind
+    ``put`` blocks rather than buffering without bound.
+
+    Queue depths and the mean and maximum latency of each stage are
+    reported to ``stream`` every ``report_interval`` seconds: ``queued`` is
+    the time until a tweet's batch is handed to the pool, ``geocode`` the
+    worker time per tweet, and ``write`` the time from receiving a tweet to
+    handing its record to the writer.
+    """
+
+    def __init__(self, writer, filter_factories, record, workers=2,
+                 batch_size=100, interval=0.5, depth=10000,
+                 report_interval=60.0, stream=sys.stderr):
+        import multiprocessing
+
+        self.writer = writer
+        self.batch_size = batch_size
+        self.interval = interval
+        self.report_interval = report_interval
+        self.stream = stream
+
+        self.received = 0
+        self.processed = 0
+        self.records = 0
+        self.errors = 0
+        self.latency = collections.OrderedDict(
+            (stage, _Latency()) for stage in ('queued', 'geocode', 'write'))
+
+        # the workers may be forked after a writer thread and its mongo
+        # client were started, they only parse and geocode tweets and never
+        # use the client or a lock they inherited
+        self._pool = multiprocessing.Pool(
+            workers, _init_worker, (filter_factories, record))
+        self._raw = Queue.Queue(maxsize=depth)
+        self._batches = Queue.Queue(maxsize=max(workers * 2, 2))
+        self._reported = time.time()
+        self._closed = False
+
+        self._threads = []
+        for target, name in ((self._dispatch, 'geocode-dispatcher'),
+                             (self._collect, 'geocode-collector')):
+            thread = threading.Thread(target=target, name=name)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def put(self, data):
+        """Enqueue a raw tweet, blocking while the queue is full."""
+        if self._closed:
+            raise ValueError('Put to a closed pipeline')
+        self.received += 1
+        self._raw.put((time.time(), data))
+
+    def close(self):
+        """Process the queued tweets and stop the pipeline."""
+        if self._closed:
+            return
+        self._closed = True
+        self._raw.put(_close)
+        for thread in self._threads:
+            thread.join()
+        self._pool.close()
+        self._pool.join()
+        self.report()
+
+    def depths(self):
+        """Return the number of items waiting at each stage."""
+        return {
+            'raw': self._raw.qsize(),
+            'batches': self._batches.qsize(),
+            'writer': getattr(self.writer, 'pending', lambda: 0)()
+        }
+
+    def stats(self):
+        """Return the pipeline's counters, queue depths and latencies."""
+        return {
+            'received': self.received,
+            'processed': self.processed,
+            'records': self.records,
+            'errors': self.errors,
+            'depths': self.depths(),
+            'latency': {
+                stage: {'mean': latency.mean(), 'max': latency.max}
+                for stage, latency in self.latency.iteritems()
+            }
+        }
+
+    def report(self):
+        """Write the queue depths and stage latencies to the stream."""
+        self._reported = time.time()
+        depths = self.depths()
+        self.stream.write(
+            'geocoding: %d received, %d processed, %d records, %d errors; '
+            'queued %d raw, %d batches, %d to write; %s\n' % (
+                self.received, self.processed, self.records, self.errors,
+                depths['raw'], depths['batches'], depths['writer'],
+                ', '.join(
+                    '%s %.1f/%.1f ms' % (
+                        stage, latency.mean() * 1000, latency.max * 1000)
+                    for stage, latency in self.latency.iteritems()
+                )
+            )
+        )
+        self.stream.flush()
+        for latency in self.latency.itervalues():
+            latency.reset()
+
+    def _submit(self, batch):
+        if not batch:
+            return
+        now = time.time()
+        for received, _ in batch:
+            self.latency['queued'].add(now - received)
+        result = self._pool.apply_async(
+            process_batch, ([data for _, data in batch],))
+        self._batches.put((result, [received for received, _ in batch]))
+
+    def _dispatch(self):
+        batch = []
+        deadline = time.time() + self.interval
+        while True:
+            item = None
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = self._raw.get(timeout=timeout)
+                else:
+                    item = self._raw.get_nowait()
+            except Queue.Empty:
+                pass
+
+            if item is _close:
+                self._submit(batch)
+                self._batches.put(_close)
+                return
+            if item is not None:
+                batch.append(item)
+
+            if len(batch) >= self.batch_size or (
+                    batch and time.time() >= deadline):
+                self._submit(batch)
+                batch = []
+            if not batch:
+                deadline = time.time() + self.interval
+
+    def _collect(self):
+        while True:
+            item = self._batches.get()
+            if item is _close:
+                return
+
+            result, received = item
+            try:
+                records, errors, seconds = result.get()
+            except Exception:
+                records, errors, seconds = [], len(received), 0.0
+            if received:
+                self.latency['geocode'].add(
+                    seconds / len(received), len(received))
+
+            for rec in records:
+                self.writer.write(rec)
+            now = time.time()
+            for tick in received:
+                self.latency['write'].add(now - tick)
+
+            self.processed += len(received)
+            self.records += len(records)
+            self.errors += errors
+
+            if (self.report_interval and
+                    now - self._reported >= self.report_interval):
+                self.report()
@@ -0,0 +1,305 @@
+"""Replay recorded tweets through the stream ingestion to measure it.
+
+Recorded tweets, one JSON object per line or a JSON array such as the
+``plugin_tests/data/tweets100.json.zip`` fixture, are fed to the same
+``TwitterStreamListener``, geocoding pipeline and ``BulkWriter`` as a live
+stream, at a fixed rate or as fast as the ingestion accepts them.  No
+twitter credentials are needed, and the tweets are written to an
+in-memory stand-in for mongo unless a mongo URI is given.
+
+The report gives the sustained rate tweets were received and written at,
+how far the feed fell behind the requested rate when the ingestion pushed
+back, and percentiles of the latency from receiving a tweet to its
+insert, and of the insert of each batch::
+
+    cd server
+    python -m misc.twitter.replay ../plugin_tests/data/tweets100.json.zip \\
+        --count 100000 --rate 2000 --workers 2
+"""
+from datetime import datetime
+import argparse
+import gzip
+import itertools
+import json
+import sys
+import threading
+import time
+import zipfile
+
+from misc.twitter.pipeline import GeocodingPipeline
+from misc.twitter.twitter_stream import (
+    TwitterStreamListener, createTweetGeocoder, tweet_record
+)
+from misc.twitter.writer import BulkWriter
+
+# Date format of the streaming api
+stream_dateformat = '%a %b %d %H:%M:%S +0000 %Y'
+
+# Date format of the search api and the recorded fixtures
+search_dateformat = '%Y-%m-%dT%H:%M:%S'
+
+
+def _parse(lines):
+    """Yield the tweets of a JSON array or of JSON lines."""
+    lines = iter(lines)
+    for line in lines:
+        if not line.strip():
+            continue
+        if line.lstrip().startswith('['):
+            for tweet in json.loads(line + ''.join(lines)):
+                yield tweet
+            return
+        yield json.loads(line)
+
+
+def read_recorded(path):
+    """Yield the recorded tweets of a file.
+
+    Files ending in ``.zip`` are read member by member and files ending in
+    ``.gz`` are decompressed.
+    """
+    if path.endswith('.zip'):
+        with zipfile.ZipFile(path) as z:
+            for name in z.namelist():
+                with z.open(name) as f:
+                    for tweet in _parse(f):
+                        yield tweet
+    else:
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path) as f:
+            for tweet in _parse(f):
+                yield tweet
+
+
+def as_streamed(tweet, id):
+    """Return a recorded tweet as the streaming api sends it, with an id.
+
+    Tweets recorded from the search api or exported from mongo have
+    another date format, no ``timestamp_ms`` and an ``_id``.
+    """
+    tweet = dict(tweet)
+    tweet.pop('_id', None)
+    created = tweet.get('created_at')
+    try:
+        created = datetime.strptime(created, search_dateformat)
+    except (TypeError, ValueError):
+        pass
+    else:
+        tweet['created_at'] = created.strftime(stream_dateformat)
+        tweet.setdefault('timestamp_ms', str(int(
+            (created - datetime(1970, 1, 1)).total_seconds() * 1000)))
+    tweet.setdefault('retweeted', False)
+    tweet['id'] = id
+    tweet['id_str'] = str(id)
+    return tweet
+
+
+def expand(tweets, count, first_id=1):
+    """Return count raw tweets repeating tweets, each with a new id."""
+    tweets = list(tweets)
+    if not tweets:
+        raise ValueError('No recorded tweets')
+    return [
+        json.dumps(as_streamed(tweet, first_id + i))
+        for i, tweet in enumerate(
+            itertools.islice(itertools.cycle(tweets), count))
+    ]
+
+
+def percentiles(values, points=(50, 90, 99)):
+    """Return the nearest-rank percentiles of values, and the maximum."""
+    values = sorted(values)
+    result = {}
+    for point in points:
+        if values:
+            rank = max(int(round(point / 100.0 * len(values))) - 1, 0)
+            result['p%d' % point] = values[rank]
+        else:
+            result['p%d' % point] = 0.0
+    result['max'] = values[-1] if values else 0.0
+    return result
+
+
+class MemoryCollection(object):
+
+    """An in-memory stand-in for the mongo collection of a query.
+
+    Documents are counted, not kept.  Each insert sleeps ``latency``
+    seconds to stand in for the round trip to a server.
+    """
+
+    def __init__(self, name='replay', latency=0.0):
+        self.name = name
+        self.latency = latency
+        self.inserted = 0
+
+    def insert_many(self, documents, ordered=True):
+        if self.latency:
+            time.sleep(self.latency)
+        self.inserted += len(documents)
+
+
+class TimedCollection(object):
+
+    """Time the inserts of a collection and the latency of each tweet.
+
+    ``received`` maps the tweet ids to the time they were received.
+    """
+
+    def __init__(self, collection, received):
+        self.collection = collection
+        self.name = collection.name
+        self.received = received
+        self.insert_seconds = []
+        self.latencies = []
+        self.last_insert = None
+        self._lock = threading.Lock()
+
+    def insert_many(self, documents, ordered=True):
+        tick = time.time()
+        try:
+            return self.collection.insert_many(documents, ordered=ordered)
+        finally:
+            now = time.time()
+            with self._lock:
+                self.insert_seconds.append(now - tick)
+                self.last_insert = now
+                for doc in documents:
+                    received = self.received.pop(doc['id'], None)
+                    if received is not None:
+                        self.latencies.append(now - received)
+
+
+def replay(raw_tweets, collection=None, rate=None, workers=2,
+           batch_size=1000, interval=1.0, filter_factories=None,
+           stream=sys.stderr):
+    """Feed raw tweets to a stream listener and measure the ingestion.
+
+    Tweets are sent ``rate`` per second, or as fast as the listener takes
+    them.  With no workers they're geocoded on the feeding thread as a
+    live stream without a pipeline does.  Returns the report.
+    """
+    if collection is None:
+        collection = MemoryCollection()
+    if filter_factories is None:
+        filter_factories = [createTweetGeocoder]
+
+    ids = [json.loads(data)['id_str'] for data in raw_tweets]
+    filters = []
+    if not workers:
+        filters = [factory() for factory in filter_factories]
+
+    received = {}
+    timed = TimedCollection(collection, received)
+    writer = BulkWriter(timed, batch_size=batch_size, interval=interval,
+                        report_interval=0, stream=stream)
+    pipeline = None
+    if workers:
+        pipeline = GeocodingPipeline(
+            writer, filter_factories, tweet_record, workers=workers,
+            report_interval=0, stream=stream)
+    listener = TwitterStreamListener(None, writer, pipeline)
+    for filter in filters:
+        listener.add_filter(filter)
+
+    lags = []
+    start = time.time()
+    for i, (tweet_id, data) in enumerate(itertools.izip(ids, raw_tweets)):
+        if rate:
+            scheduled = start + i / float(rate)
+            delay = scheduled - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            lags.append(max(time.time() - scheduled, 0.0))
+        received[tweet_id] = time.time()
+        listener.on_data(data)
+    fed = time.time()
+
+    if pipeline is not None:
+        pipeline.close()
+    writer.close()
+
+    elapsed = max((timed.last_insert or fed) - start, 1e-9)
+    count = len(raw_tweets)
+    return {
+        'tweets': count,
+        'written': writer.written,
+        'failed': writer.failed,
+        'seconds': elapsed,
+        'received_rate': count / max(fed - start, 1e-9),
+        'written_rate': writer.written / elapsed,
+        'lag': percentiles(lags),
+        'latency': percentiles(timed.latencies),
+        'insert': percentiles(timed.insert_seconds),
+        'batches': len(timed.insert_seconds)
+    }
+
+
+def format_report(report):
+    """Return a report as lines of text."""
+    def ms(values):
+        return ', '.join(
+            '%s %.1f ms' % (key, values[key] * 1000)
+            for key in ('p50', 'p90', 'p99', 'max'))
+
+    return '\n'.join([
+        '%d tweets, %d written, %d failed in %.2f s' % (
+            report['tweets'], report['written'], report['failed'],
+            report['seconds']),
+        'received %.1f tweets/s, written %.1f tweets/s' % (
+            report['received_rate'], report['written_rate']),
+        'feed lag: %s' % ms(report['lag']),
+        'write latency: %s' % ms(report['latency']),
+        'insert of %d batches: %s' % (report['batches'],
+                                      ms(report['insert']))
+    ]) + '\n'
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(
+        description='Replay recorded tweets through the stream ingestion.',
+        epilog='Paths ending in ".zip" or ".gz" are decompressed.')
+    parser.add_argument('path', help='recorded tweets, JSON lines or array')
+    parser.add_argument('--count', type=int,
+                        help='tweets to replay, repeating the recording '
+                             '(default: each tweet once)')
+    parser.add_argument('--rate', type=float,
+                        help='tweets per second (default: unthrottled)')
+    parser.add_argument('--workers', type=int, default=2,
+                        help='geocoding processes, 0 to geocode inline')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='documents per bulk insert')
+    parser.add_argument('--insert-latency', type=float, default=0.0,
+                        help='seconds each insert of the in-memory '
+                             'collection takes')
+    parser.add_argument('--mongo', metavar='URI',
+                        help='write to the database of this mongo URI '
+                             'instead of memory')
+    parser.add_argument('--collection', default='replay',
+                        help='mongo collection, dropped first')
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+    tweets = list(read_recorded(args.path))
+    raw_tweets = expand(tweets, args.count or len(tweets))
+
+    if args.mongo:
+        import pymongo
+        from misc.twitter.indexes import ensure_indexes
+
+        collection = pymongo.MongoClient(args.mongo).get_default_database(
+        )[args.collection]
+        collection.drop()
+        ensure_indexes(collection)
+    else:
+        collection = MemoryCollection(args.collection, args.insert_latency)
+
+    report = replay(raw_tweets, collection, rate=args.rate,
+                    workers=args.workers, batch_size=args.batch_size)
+    sys.stdout.write(format_report(report))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,15 +1,27 @@
 from datetime import datetime
+import collections
 import json
 import os
+import Queue
+import sys
+import threading
 
-import pymongo
-import tweepy
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
 
 from libs.carmen import get_resolver
+from misc.twitter.indexes import (
+    add_derived_fields, ensure_indexes, query_collection
+)
+from misc.twitter.locations import compact_location
 
 
 dateformat = '%Y-%m-%dT%H:%M:%S'
 
+# Tweets requested per page, the most the search API returns
+page_size = 100
+
+
 def datestring_to_epoch(datestring):
     d = datestring
     if not isinstance(d, datetime):
@@ -17,34 +29,171 @@ def datestring_to_epoch(datestring):
     epoch = int((d - datetime(1970, 1, 1)).total_seconds())
     return epoch
 
-def search(query, pages):
-    _mongo = pymongo.MongoClient().minerva[query]
+
+def create_api():
+    """Return a tweepy API client authenticated from twitter.json"""
+    import tweepy
 
     minerva_twitter_config = json.load(open(
         os.path.join(os.path.dirname(__file__), "twitter.json")
     ))
-    auth = tweepy.OAuthHandler(minerva_twitter_config["twitter"]["CONSUMER_KEY"],
-                        minerva_twitter_config["twitter"]["CONSUMER_SECRET"])
-    auth.set_access_token(minerva_twitter_config["twitter"]["ACCESS_KEY"],
-                          minerva_twitter_config["twitter"]["ACCESS_SECRET"])
-    api = tweepy.API(auth)
-
-    resolver = get_resolver()
-    resolver.load_locations()
-
-    for pageInd, page in enumerate(tweepy.Cursor(api.search, q=query, count=100).pages(pages)):
-        for resultInd, result in enumerate(page):
-            location = resolver.resolve_tweet(result._json)
-            # only store those with geolocation
-            if location:
-                rec = {
-                    "id": result.id_str,
-                    "location": location[1].__dict__,
-                    "text": result.text,
-                    "created_at": datestring_to_epoch(result.created_at)
-                }
-                _mongo.insert(rec)
+    twitter = minerva_twitter_config["twitter"]
+    auth = tweepy.OAuthHandler(twitter["CONSUMER_KEY"],
+                               twitter["CONSUMER_SECRET"])
+    auth.set_access_token(twitter["ACCESS_KEY"], twitter["ACCESS_SECRET"])
+    return tweepy.API(auth)
+
+
+def search_pages(api, query, pages, count=page_size):
+    """Yield up to pages pages of search results, newest first.
+
+    Pages are requested with ``max_id`` below the oldest tweet of the
+    previous page, as ``tweepy.Cursor`` does.
+    """
+    max_id = None
+    for _ in xrange(pages):
+        params = {'q': query, 'count': count}
+        if max_id is not None:
+            params['max_id'] = max_id
+        page = api.search(**params)
+        if not page:
+            return
+        yield page
+        max_id = min(result.id for result in page) - 1
+
+
+def prefetch(iterable, depth=1):
+    """Yield the items of iterable, read up to depth items ahead in a thread.
+
+    Errors raised by the iterable are raised by the generator.
+    """
+    queue = Queue.Queue(maxsize=depth)
+    stop = threading.Event()
+    done = object()
+
+    def produce():
+        try:
+            for item in iterable:
+                queue.put((None, item))
+                if stop.is_set():
+                    return
+        except Exception:
+            queue.put((sys.exc_info(), None))
+            return
+        queue.put((None, done))
+
+    thread = threading.Thread(target=produce, name='tweets-prefetch')
+    thread.daemon = True
+    thread.start()
+
+    try:
+        while True:
+            error, item = queue.get()
+            if error is not None:
+                raise error[0], error[1], error[2]
+            if item is done:
+                return
+            yield item
+    finally:
+        # unblock the producer if the consumer stops early
+        stop.set()
+        while thread.is_alive():
+            try:
+                queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+
+def resolution_key(tweet):
+    """Return the fields of a tweet its resolved location depends on"""
+    return json.dumps([
+        tweet.get('place'),
+        tweet.get('coordinates'),
+        (tweet.get('user') or {}).get('location')
+    ], sort_keys=True)
+
+
+def resolve_page(resolver, page):
+    """Return the records of the geolocated tweets of a page.
+
+    Tweets sharing a place, coordinates and profile location are resolved
+    once, and tweets repeated in the page are only returned once.
+    """
+    locations = {}
+    records = collections.OrderedDict()
+    for result in page:
+        tweet = result._json
+        key = resolution_key(tweet)
+        if key not in locations:
+            location = resolver.resolve_tweet(tweet)
+            if location is not None:
+                location = compact_location(location[1])
+            locations[key] = location
+
+        # only store those with geolocation
+        if locations[key] is not None and result.id_str not in records:
+            records[result.id_str] = add_derived_fields({
+                "id": result.id_str,
+                "location": dict(locations[key]),
+                "text": result.text,
+                "created_at": datestring_to_epoch(result.created_at)
+            })
+    return records.values()
+
+
+def save_records(collection, records):
+    """Upsert records by tweet id, returning the number inserted"""
+    if not records:
+        return 0
+
+    requests = [
+        UpdateOne({'id': rec['id']}, {'$set': rec}, upsert=True)
+        for rec in records
+    ]
+    try:
+        result = collection.bulk_write(requests, ordered=False)
+    except BulkWriteError as e:
+        # a concurrent upsert of the same id loses on the unique index
+        errors = e.details.get('writeErrors', [])
+        if any(error.get('code') != 11000 for error in errors):
+            raise
+        return e.details.get('nUpserted', 0)
+    return result.upserted_count
+
+
+def search(query, pages, api=None, collection=None, resolver=None,
+           prefetch_pages=True, ttl=None, max_bytes=None):
+    """Search tweets matching query and save the geolocated ones.
+
+    The next page is requested while the current one is resolved and
+    saved.  Tweets are upserted by id, so searching again doesn't
+    duplicate them.  ``ttl`` and ``max_bytes`` set the retention of the
+    query's collection, see :func:`misc.twitter.indexes.query_collection`.
+    Returns the number of tweets read and saved and the number of new
+    tweets.
+    """
+    if api is None:
+        api = create_api()
+    if collection is None:
+        collection = query_collection(query, ttl=ttl, max_bytes=max_bytes)
+    else:
+        ensure_indexes(collection, ttl)
+    if resolver is None:
+        resolver = get_resolver()
+        resolver.load_locations()
+
+    stats = {'tweets': 0, 'saved': 0, 'inserted': 0}
+    results = search_pages(api, query, pages)
+    if prefetch_pages:
+        results = prefetch(results)
+
+    for page in results:
+        records = resolve_page(resolver, page)
+        stats['inserted'] += save_records(collection, records)
+        stats['tweets'] += len(page)
+        stats['saved'] += len(records)
+    return stats
+
 
 if __name__ == '__main__':
-    import sys
     search(sys.argv[1], 20)
@@ -1,7 +1,9 @@
-# Requires tweepy (pip install tweepy)
-from tweepy import StreamListener
-from tweepy import OAuthHandler
-from tweepy import Stream
+# Streaming requires tweepy (pip install tweepy)
+try:
+    from tweepy import StreamListener
+except ImportError:
+    # replaying recorded tweets doesn't need tweepy
+    StreamListener = object
 
 from datetime import datetime
 import os
@@ -9,15 +11,24 @@ import sys
 import time
 import json
 import atexit
-import pymongo
 
 from libs.carmen import get_resolver
+from misc.twitter.indexes import add_derived_fields, query_collection
+from misc.twitter.locations import compact_location
+from misc.twitter.pipeline import GeocodingPipeline
+from misc.twitter.writer import BulkWriter
+
+
+def load_config():
+    """Load the twitter.json configuration.
+
+    A configuration is required for authentication purposes or else
+    streaming service won't work.
+    """
+    return json.load(open(
+        os.path.join(os.path.dirname(__file__), "twitter.json")
+    ))
 
-# A configuration is required for authentication purposes or else
-# streaming service won't work.
-minerva_twitter_config = json.load(open(
-    os.path.join(os.path.dirname(__file__), "twitter.json")
-))
 
 # TODO why a different format between streaming and search apis?
 dateformat = '%a %b %d %H:%M:%S %Y'
@@ -36,16 +47,40 @@ def datestring_to_epoch(datestring):
     return epoch
 
 
+def tweet_record(json_data):
+    """Return the record saved for a geocoded tweet, or None"""
+    if 'location' not in json_data:
+        return None
+
+    retweet_cont = 0
+    if 'retweet_cont' in json_data.keys():
+        retweet_cont = json_data['retweet_cont']
+
+    return add_derived_fields({
+        "id": json_data['id_str'],
+        "location": json_data['location'],
+        "text": json_data['text'],
+        "timestamp_ms": json_data['timestamp_ms'],
+        "created_at": datestring_to_epoch(json_data['created_at']),
+        "retweeted": json_data['retweeted'],
+        "retweet_cont": retweet_cont
+    })
+
+
 class TwitterStreamListener(StreamListener):
     """ A listener handles tweets are the received from the stream.
-    This is a basic listener that just prints received tweets to stdout.
+    Geocoded tweets are buffered and written to mongo in bulk.
 
     """
-    def __init__(self, query):
+    def __init__(self, query, writer=None, pipeline=None):
         """Initialize twitter stream"""
         StreamListener.__init__(self)
-        self._mongo = pymongo.MongoClient().minerva[query]
         self._filters = []
+        if writer is None:
+            writer = BulkWriter(query_collection(query))
+            _writers.append(writer)
+        self._writer = writer
+        self._pipeline = pipeline
 
     def add_filter(self, filter):
         """A filter takes JSON  as input and outputs a JSON as well"""
@@ -54,30 +89,20 @@ class TwitterStreamListener(StreamListener):
 
     def on_data(self, data):
         """Receive tweet and save it to the database"""
+        if self._pipeline is not None:
+            # Geocode and save in the pipeline, off the network thread
+            self._pipeline.put(data)
+            return True
+
         json_data = json.loads(data)
 
         for filter in self._filters:
             json_data = filter(json_data)
 
-        retweet_cont = 0
-        if 'retweet_cont' in json_data.keys():
-            retweet_cont = json_data['retweet_cont']
-
-        if 'location' in json_data:
-            rec = {
-                "id": json_data['id_str'],
-                "location": json_data['location'],
-                "text": json_data['text'],
-                "timestamp_ms": json_data['timestamp_ms'],
-                "created_at": datestring_to_epoch(json_data['created_at']),
-                "retweeted": json_data['retweeted'],
-                "retweet_cont": retweet_cont
-            }
-
-            print(rec)
-
-            # Insert data in mongodb
-            self._mongo.insert(rec)
+        rec = tweet_record(json_data)
+        if rec is not None:
+            # Buffer for a bulk insert in mongodb
+            self._writer.write(rec)
 
         return True
 
@@ -92,10 +117,18 @@ class TwitterStreamListener(StreamListener):
 
 _exit = False
 
+# Pipelines and writers flushed on exit, in order
+_pipelines = []
+_writers = []
+
 
 def exitHandler():
     global _exit
     _exit = True
+    for pipeline in _pipelines:
+        pipeline.close()
+    for writer in _writers:
+        writer.close()
 
 atexit.register(exitHandler)
 
@@ -107,15 +140,35 @@ def createTweetGeocoder():
     def tweetGeocoder(tweet):
         location = resolver.resolve_tweet(tweet)
         if location is not None:
-            tweet["location"] = location[1].__dict__
+            location = compact_location(location[1])
+        if location is not None:
+            tweet["location"] = location
         return tweet
 
     return tweetGeocoder
 
 
-def stream(query):
-    listn = TwitterStreamListener(query)
-    listn.add_filter(createTweetGeocoder())
+def stream(query, workers=2, ttl=None, max_bytes=None):
+    """Stream tweets matching query, geocoding them in worker processes.
+
+    With no workers the tweets are geocoded on the network thread.
+    ``ttl`` and ``max_bytes`` set the retention of the query's collection,
+    see :func:`misc.twitter.indexes.query_collection`.
+    """
+    from tweepy import OAuthHandler
+    from tweepy import Stream
+
+    minerva_twitter_config = load_config()
+    writer = BulkWriter(query_collection(query, ttl=ttl, max_bytes=max_bytes))
+    _writers.append(writer)
+    if workers:
+        pipeline = GeocodingPipeline(
+            writer, [createTweetGeocoder], tweet_record, workers=workers)
+        _pipelines.append(pipeline)
+        listn = TwitterStreamListener(query, writer, pipeline)
+    else:
+        listn = TwitterStreamListener(query, writer)
+        listn.add_filter(createTweetGeocoder())
 
     auth = OAuthHandler(minerva_twitter_config["twitter"]["CONSUMER_KEY"],
                         minerva_twitter_config["twitter"]["CONSUMER_SECRET"])
@@ -125,5 +178,11 @@ def stream(query):
     stream.filter(track=[query], async=False)
 
 if __name__ == '__main__':
-    stream(sys.argv[1])
+    workers = 2
+    ttl = None
+    if len(sys.argv) > 2:
+        workers = int(sys.argv[2])
+    if len(sys.argv) > 3:
+        ttl = int(sys.argv[3])
+    stream(sys.argv[1], workers, ttl)
 
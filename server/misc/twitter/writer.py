@@ -0,0 +1,177 @@
+"""Buffered bulk writes of tweets to mongo."""
+import Queue
+import sys
+import threading
+import time
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+# Queue markers for the writer thread
+_close = object()
+_flush = object()
+
+
+class BulkWriter(object):
+    """Accumulate documents and insert them with unordered bulk writes.
+
+    Documents are inserted by a background thread once ``batch_size`` of
+    them are buffered or ``interval`` seconds after the last insert.  At
+    most ``max_pending`` documents wait to be written, and ``write`` blocks
+    when that many are buffered, so a slow database holds back the stream
+    instead of growing the buffer without bound.
+
+    Throughput is reported to ``stream`` every ``report_interval`` seconds.
+    """
+
+    def __init__(self, collection, batch_size=1000, interval=1.0,
+                 max_pending=50000, report_interval=60.0, retries=5,
+                 stream=sys.stderr):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.report_interval = report_interval
+        self.retries = retries
+        self.stream = stream
+
+        self.received = 0
+        self.written = 0
+        self.failed = 0
+        self.batches = 0
+        self.write_seconds = 0.0
+
+        self._queue = Queue.Queue(maxsize=max_pending)
+        self._started = time.time()
+        self._reported = (self._started, 0)
+        self._closed = False
+        self._thread = threading.Thread(target=self._run, name='bulk-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def write(self, doc):
+        """Buffer a document, blocking while the buffer is full."""
+        if self._closed:
+            raise ValueError('Write to a closed writer')
+        self.received += 1
+        self._queue.put(doc)
+
+    def flush(self):
+        """Wait until the documents buffered so far are written.
+
+        A closed writer has written everything, so this returns at once.
+        """
+        if self._closed:
+            return
+        done = threading.Event()
+        self._queue.put((_flush, done))
+        # a flush queued behind a concurrent close is never answered, the
+        # close writes the documents instead
+        while not done.wait(0.1):
+            if not self._thread.is_alive():
+                return
+
+    def close(self):
+        """Write the buffered documents and stop the writer thread."""
+        if self._closed:
+            return
+        self._closed = True
+        self._queue.put(_close)
+        self._thread.join()
+        self.report()
+
+    def pending(self):
+        """Return the number of documents waiting to be written."""
+        return self._queue.qsize()
+
+    def stats(self):
+        """Return the writer's counters and throughput."""
+        elapsed = max(time.time() - self._started, 1e-9)
+        return {
+            'received': self.received,
+            'written': self.written,
+            'failed': self.failed,
+            'pending': self.pending(),
+            'batches': self.batches,
+            'write_seconds': self.write_seconds,
+            'rate': self.written / elapsed
+        }
+
+    def report(self):
+        """Write the throughput since the last report to the stream."""
+        now = time.time()
+        then, written = self._reported
+        self._reported = (now, self.written)
+        rate = (self.written - written) / max(now - then, 1e-9)
+        self.stream.write(
+            '%s: %d received, %d written, %d failed, %d pending, '
+            '%.1f/s\n' % (
+                self.collection.name, self.received, self.written,
+                self.failed, self.pending(), rate
+            )
+        )
+        self.stream.flush()
+
+    def _insert(self, batch):
+        """Insert a batch, retrying while the server is unreachable."""
+        if not batch:
+            return
+
+        tick = time.time()
+        for attempt in xrange(self.retries + 1):
+            try:
+                self.collection.insert_many(batch, ordered=False)
+                self.written += len(batch)
+                break
+            except BulkWriteError as e:
+                # unordered inserts write every document that didn't fail
+                errors = len(e.details.get('writeErrors', []))
+                self.written += e.details.get('nInserted', 0)
+                self.failed += errors
+                break
+            except AutoReconnect:
+                if attempt == self.retries:
+                    self.failed += len(batch)
+                else:
+                    time.sleep(min(2 ** attempt, 30))
+            except Exception as e:
+                # keep the thread alive so writes don't block forever
+                self.failed += len(batch)
+                self.stream.write('Bulk insert failed: %s\n' % e)
+                break
+        self.batches += 1
+        self.write_seconds += time.time() - tick
+
+    def _run(self):
+        batch = []
+        deadline = time.time() + self.interval
+        closing = False
+        while not closing:
+            item = None
+            timeout = deadline - time.time()
+            try:
+                if timeout > 0:
+                    item = self._queue.get(timeout=timeout)
+                else:
+                    item = self._queue.get_nowait()
+            except Queue.Empty:
+                pass
+
+            flushed = None
+            if item is _close:
+                closing = True
+            elif isinstance(item, tuple) and item[0] is _flush:
+                flushed = item[1]
+            elif item is not None:
+                batch.append(item)
+
+            now = time.time()
+            if (closing or flushed is not None or
+                    len(batch) >= self.batch_size or now >= deadline):
+                self._insert(batch)
+                batch = []
+                deadline = time.time() + self.interval
+                if flushed is not None:
+                    flushed.set()
+
+            if (self.report_interval and
+                    now - self._reported[0] >= self.report_interval):
+                self.report()
@@ -0,0 +1,104 @@
+###############################################################################
+#  Copyright 2015 Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+"""Datasets registered as the results of analysis runs.
+
+Analyses reuse the dataset of an earlier run with the same inputs instead of
+computing it again.  The key of a run is computed here from the analysis,
+its version, the content of its input file and its parameters, so clients
+can't register a dataset under the key of other inputs.
+"""
+
+import datetime
+import hashlib
+import json
+
+from pymongo import DESCENDING, ReturnDocument
+
+from girder.constants import AccessType
+from girder.models.model_base import Model
+
+
+def _file_digest(file):
+    """Return the content hash of a girder file, or its size if unknown."""
+    return file.get('sha512') or 'size%d' % file['size']
+
+
+class AnalysisResult(Model):
+
+    """Registrations of datasets as the results of analysis runs."""
+
+    def initialize(self):
+        self.name = 'analysis_result'
+        self.ensureIndices([
+            ([('key', 1), ('created', DESCENDING)], {})
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def resultKey(self, analysis, version, file, params):
+        """Return the key identifying a run of an analysis on a file."""
+        key = {
+            'analysis': analysis,
+            'version': str(version),
+            'fileId': str(file['_id']),
+            'digest': _file_digest(file),
+            'parameters': params
+        }
+        return hashlib.sha256(json.dumps(key, sort_keys=True)).hexdigest()
+
+    def register(self, item, user, analysis, version, file, params):
+        """Register an item as the result of a run by the user."""
+        key = self.resultKey(analysis, version, file, params)
+        return self.collection.find_one_and_update({
+            'key': key,
+            'itemId': item['_id'],
+            'registeredBy': user['_id']
+        }, {'$set': {
+            'fileId': file['_id'],
+            'analysis': analysis,
+            'version': str(version),
+            'params': params,
+            'created': datetime.datetime.utcnow()
+        }}, upsert=True, return_document=ReturnDocument.AFTER)
+
+    def findResult(self, user, analysis, version, file, params):
+        """Return the most recent result of a run readable by the user.
+
+        Only results registered by the user or by an administrator are
+        trusted, others could have registered any dataset of theirs.
+        """
+        userModel = self.model('user')
+        itemModel = self.model('item')
+        folderModel = self.model('folder')
+        cursor = self.find({
+            'key': self.resultKey(analysis, version, file, params)
+        }, sort=[('created', DESCENDING)])
+        for result in cursor:
+            if result['registeredBy'] != user['_id']:
+                registrant = userModel.load(result['registeredBy'],
+                                            force=True)
+                if registrant is None or not registrant.get('admin'):
+                    continue
+            item = itemModel.load(result['itemId'], force=True)
+            if item is None:
+                continue
+            folder = folderModel.load(item['folderId'], force=True)
+            if folder is not None and folderModel.hasAccess(
+                    folder, user, AccessType.READ):
+                return item
+        return None
@@ -0,0 +1,204 @@
+"""A compact collection of geonames places.
+
+Each place is a single small document keyed by its geonameid instead of a
+girder item, so the gazetteer doesn't grow the item collection and its
+indexes, and carries none of the per item folder, creator and timestamp
+fields.
+"""
+
+import math
+import re
+import unicodedata
+
+from pymongo import ReplaceOne, DESCENDING, GEOSPHERE
+from pymongo.errors import BulkWriteError
+
+from girder.models.model_base import Model
+
+#: Feature properties stored in the compact documents
+_fields = {
+    'name': 'name',
+    'asciiname': 'asciiname',
+    'feature class': 'feature_class',
+    'feature code': 'feature_code',
+    'country code': 'country_code',
+    'admin1 code': 'admin1',
+    'admin2 code': 'admin2',
+    'population': 'population',
+    'timezone': 'timezone'
+}
+
+_whitespace = re.compile(r'\s+')
+
+#: Ranking bonus by feature code, added to log10 of the population
+_feature_rank = {
+    'PCLI': 4.0,
+    'PPLC': 3.0,
+    'ADM1': 2.0,
+    'PPLA': 2.0,
+    'PPLA2': 1.0,
+    'ADM2': 1.0,
+    'PPL': 0.5
+}
+
+#: Ranking bonus by feature class, populated places and areas first
+_class_rank = {
+    'P': 1.0,
+    'A': 1.0
+}
+
+
+def normalize(name):
+    """Return the lowercase name without accents or extra whitespace."""
+    if not isinstance(name, unicode):
+        name = name.decode('utf-8')
+    name = unicodedata.normalize('NFKD', name)
+    name = u''.join(c for c in name if not unicodedata.combining(c))
+    return _whitespace.sub(u' ', name).strip().lower()
+
+
+def normalized_names(properties):
+    """Return the distinct normalized names of a geonames feature."""
+    names = [properties.get('name'), properties.get('asciiname')]
+    names.extend(properties.get('alternatenames') or ())
+
+    seen = set()
+    result = []
+    for name in names:
+        if not name:
+            continue
+        name = normalize(name)
+        if name and name not in seen:
+            seen.add(name)
+            result.append(name)
+    return result
+
+
+def rank(population, feature_class, feature_code):
+    """Return the static ranking score of a place."""
+    return (
+        math.log10((population or 0) + 1) +
+        _class_rank.get(feature_class, 0.0) +
+        _feature_rank.get(feature_code, 0.0)
+    )
+
+
+def place_feature(geonameid, coordinates, name, names, population,
+                  feature_class, feature_code, country_code):
+    """Return the geojson feature of a place as every geocoder returns it.
+
+    The geocoding endpoints answer from girder items, the geonames
+    collection or the in memory gazetteer, which all build their features
+    here so their properties have the same keys and types.
+    """
+    population = int(population or 0)
+    feature_class = feature_class or None
+    feature_code = feature_code or None
+    return {
+        'type': 'Feature',
+        'id': int(geonameid),
+        'geometry': {
+            'type': 'Point',
+            'coordinates': [float(c) for c in coordinates]
+        },
+        'properties': {
+            'name': name,
+            'names': list(names),
+            'population': population,
+            'feature class': feature_class,
+            'feature code': feature_code,
+            'country code': country_code or None,
+            'score': rank(population, feature_class, feature_code)
+        }
+    }
+
+
+def item_feature(doc):
+    """Return the geojson feature of a place stored as a girder item."""
+    meta = doc['meta']
+    names = meta.get('names')
+    if names is None:
+        names = normalized_names(meta)
+    return place_feature(
+        meta['geonameid'], doc['geo']['geometry']['coordinates'],
+        meta.get('name'), names, meta.get('population'),
+        meta.get('feature class'), meta.get('feature code'),
+        meta.get('country code'))
+
+
+class Geonames(Model):
+
+    """Geonames places stored outside of the girder item collection."""
+
+    def initialize(self):
+        self.name = 'geonames'
+        self.ensureIndices([
+            ([('names', 1), ('population', DESCENDING)], {}),
+            ([('geometry', GEOSPHERE)], {})
+        ])
+
+    def validate(self, doc):
+        return doc
+
+    def fromFeature(self, feature):
+        """Return the compact document of a geonames geojson feature."""
+        properties = feature['properties']
+        doc = {
+            '_id': int(properties['geonameid']),
+            'names': normalized_names(properties),
+            'geometry': feature['geometry']
+        }
+        for key, field in _fields.iteritems():
+            value = properties.get(key)
+            if value is not None and value != '':
+                if hasattr(value, 'item'):
+                    value = value.item()
+                doc[field] = value
+        return doc
+
+    def toFeature(self, doc):
+        """Return a geojson feature from a compact document."""
+        return place_feature(
+            doc['_id'], doc['geometry']['coordinates'], doc.get('name'),
+            doc.get('names', []), doc.get('population'),
+            doc.get('feature_class'), doc.get('feature_code'),
+            doc.get('country_code'))
+
+    def upsertFeatures(self, features):
+        """Insert or replace the given features keyed by geonameid.
+
+        Returns a list of ``(feature, error)`` tuples for the rows that
+        failed.
+        """
+        if not features:
+            return []
+
+        requests = []
+        for feature in features:
+            doc = self.fromFeature(feature)
+            requests.append(ReplaceOne({'_id': doc['_id']}, doc, upsert=True))
+
+        try:
+            self.collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            return [
+                (features[error['index']], error.get('errmsg'))
+                for error in e.details.get('writeErrors', [])
+            ]
+        return []
+
+    def removeIds(self, geonameids):
+        """Remove the given geonameids, returning the number removed."""
+        if not geonameids:
+            return 0
+        return self.collection.delete_many({
+            '_id': {'$in': list(geonameids)}
+        }).deleted_count
+
+    def search(self, name, limit=10):
+        """Return the places with the given name, most populous first."""
+        return self.find(
+            {'names': normalize(name)},
+            limit=limit,
+            sort=[('population', DESCENDING)]
+        )
@@ -21,7 +21,8 @@ import json
 
 from girder.api import access
 from girder.api.describe import Description
-from girder.api.rest import Resource, RestException
+from girder.api.rest import Resource, loadmodel, RestException
+from girder.constants import AccessType
 
 from girder.plugins.minerva.utility.minerva_utility import (findAnalysisFolder,
                                                             findAnalysisByName,
@@ -34,6 +35,8 @@ class Analysis(Resource):
         self.route('GET', ('folder',), self.getAnalysisFolder)
         self.route('POST', ('folder',), self.createAnalysisFolder)
         self.route('POST', ('bsve_search',), self.bsveSearchAnalysis)
+        self.route('GET', ('result',), self.findAnalysisResult)
+        self.route('POST', (':id', 'result'), self.registerAnalysisResult)
 
     @access.user
     def getAnalysisFolder(self, params):
@@ -120,3 +123,74 @@ class Analysis(Resource):
         Description('Create the minerva analysis folder, a global resource.')
         .param('datasetName', 'Name of the dataset created by this analysis.')
         .param('bsveSearchParams', 'JSON search parameters to send to bsve.'))
+
+    def _analysisRun(self, params):
+        """Return the analysis, version, file and parameters of a run."""
+        self.requireParams(('analysis', 'fileId'), params)
+        inputFile = self.model('file').load(params['fileId'], force=True)
+        if inputFile is None:
+            raise RestException('Invalid file id (%s).' % params['fileId'])
+        item = self.model('item').load(inputFile['itemId'],
+                                       level=AccessType.READ,
+                                       user=self.getCurrentUser())
+        if item is None:
+            raise RestException('Invalid file id (%s).' % params['fileId'])
+        try:
+            analysisParams = json.loads(params.get('params', '{}'))
+        except ValueError:
+            raise RestException('params is invalid JSON.')
+        return (params['analysis'], params.get('version'), inputFile,
+                analysisParams)
+
+    @access.user
+    def findAnalysisResult(self, params):
+        currentUser = self.getCurrentUser()
+        analysis, version, inputFile, analysisParams = \
+            self._analysisRun(params)
+        item = self.model('analysis_result', 'minerva').findResult(
+            currentUser, analysis, version, inputFile, analysisParams)
+        if item is not None:
+            item = self.model('item').filter(item, currentUser)
+        return {'item': item}
+    findAnalysisResult.description = (
+        Description('Find an existing dataset readable by the user created '
+                    'by an analysis run with the same inputs, registered by '
+                    'the user or an administrator.')
+        .param('analysis', 'The analysis name.')
+        .param('version', 'The analysis version.', required=False)
+        .param('fileId', 'The ID of the input file.')
+        .param('params', 'JSON object of the analysis parameters.',
+               required=False))
+
+    @access.user
+    @loadmodel(model='item', level=AccessType.WRITE)
+    def registerAnalysisResult(self, item, params):
+        metadata = item.get('meta', {})
+        minerva_metadata = metadata.get('minerva')
+        if minerva_metadata is None:
+            raise RestException('Item is not a minerva dataset.')
+        analysis, version, inputFile, analysisParams = \
+            self._analysisRun(params)
+        self.model('analysis_result', 'minerva').register(
+            item, self.getCurrentUser(), analysis, version, inputFile,
+            analysisParams)
+        minerva_metadata['analysis_result'] = {
+            'analysis': analysis,
+            'version': version,
+            'fileId': inputFile['_id'],
+            'params': analysisParams
+        }
+        metadata['minerva'] = minerva_metadata
+        self.model('item').setMetadata(item, metadata)
+        return minerva_metadata
+    registerAnalysisResult.description = (
+        Description('Register a dataset as the result of an analysis run so '
+                    'repeated runs with the same inputs can reuse it.')
+        .param('id', 'The dataset Item ID', paramType='path')
+        .param('analysis', 'The analysis name.')
+        .param('version', 'The analysis version.', required=False)
+        .param('fileId', 'The ID of the input file.')
+        .param('params', 'JSON object of the analysis parameters.',
+               required=False)
+        .errorResponse('ID was invalid.')
+        .errorResponse('Write permission denied on the Item.', 403))
@@ -30,6 +30,7 @@ from girder.utility import config
 
 from girder.plugins.minerva.constants import PluginSettings
 from girder.plugins.minerva.libs.carmen import get_resolver
+from girder.plugins.minerva.misc.twitter.locations import compact_location
 from girder.plugins.minerva.utility.minerva_utility import findDatasetFolder
 from girder.plugins.minerva.utility.dataset_utility import \
     jsonArrayHead, JsonMapper, GeoJsonMapper, jsonObjectReader
@@ -258,7 +259,9 @@ class Dataset(Resource):
                 resolver.load_locations()
                 location = resolver.resolve_tweet(tweet)
                 if location is not None:
-                    tweet["location"] = location[1].__dict__
+                    location = compact_location(location[1])
+                if location is not None:
+                    tweet["location"] = location
                 return tweet
 
             jsonMapper = JsonMapper(tweetGeocoder)
@@ -1,9 +1,14 @@
 """REST API for geocode services."""
+import json
+import os
 from datetime import datetime, timedelta
 
-from girder.plugins.minerva.geonames import import_data
+import cherrypy
+import numpy as np
+
+from girder.plugins.minerva.geonames import gazetteer, import_data, indexes
+from girder.plugins.minerva.models.geonames import item_feature, normalize
 
-from pymongo import GEOSPHERE
 from bson.objectid import ObjectId
 
 from girder.api.rest import Resource, loadmodel, RestException
@@ -19,6 +24,16 @@ class Geonames(Resource):
 
     _geonames_folder = None
 
+    #: The maximum number of points of a reverse geocoding request
+    _max_reverse_points = 100000
+
+    #: The maximum number of points reverse geocoded without the gazetteer,
+    #: each takes a $nearSphere query
+    _max_reverse_query_points = 100
+
+    #: The number of distinct names resolved per database query
+    _batch_chunk_size = 1000
+
     def __init__(self):
         """Set up the resource."""
         self.resourceName = 'geonames'
@@ -36,6 +51,30 @@ class Geonames(Resource):
 
         return self._geonames_folder
 
+    def geonames_storage(self):
+        """Return where the places are stored, 'item' or 'collection'."""
+        return self.model('setting').get('minerva.geonames_storage', 'item')
+
+    def _rebuild_gazetteer(self, background=True):
+        """Rebuild the in memory gazetteer when it is enabled."""
+        if not self.model('setting').get('minerva.geonames_index', False):
+            return None
+
+        if self.geonames_storage() == 'collection':
+            collection = self.model('geonames', 'minerva').collection
+
+            def places():
+                return gazetteer.places_from_collection(collection)
+        else:
+            collection = self.model('item').collection
+            folder = ObjectId(
+                self.model('setting').get('minerva.geonames_folder'))
+
+            def places():
+                return gazetteer.places_from_items(collection, folder)
+
+        return gazetteer.rebuild(places, background=background)
+
     def _progress_adapter(self, ctx, unknown=False):
         """Return an adapter method from geonames progress arguments."""
         def progress(count, total, message, units):
@@ -52,6 +91,96 @@ class Geonames(Resource):
 
         return progress
 
+    def _import_marker(self, folder, resume):
+        """Return the item recording the state of the geonames import.
+
+        When resuming, the most recent import marker is reused so that its
+        checkpoint can be picked up, otherwise a new one is created.
+        """
+        marker = None
+        if resume:
+            marker = next(iter(self.model('item').find({
+                'folderId': folder['_id'],
+                'name': 'geonames_import'
+            }, sort=[('created', -1)], limit=1)), None)
+
+        if marker is None:
+            marker = self.model('item').createItem(
+                'geonames_import', self.getCurrentUser(), folder,
+                description=datetime.utcnow().isoformat()
+            )
+        return marker
+
+    def _checkpoint_adapter(self, marker):
+        """Return a method recording import checkpoints on the marker."""
+        def checkpoint(offset, geonameid):
+            """Record the rows committed so far."""
+            self.model('item').update({'_id': marker['_id']}, {'$set': {
+                'meta.checkpoint': {
+                    'offset': offset,
+                    'geonameid': geonameid,
+                    'updated': datetime.utcnow()
+                }
+            }})
+
+        return checkpoint
+
+    def _quarantine_adapter(self, marker, limit=1000):
+        """Return a method recording rows that failed to import."""
+        def quarantine(failed):
+            """Keep the most recent failures on the marker item."""
+            rows = [{
+                'geonameid': feature['properties'].get('geonameid'),
+                'name': feature['properties'].get('name'),
+                'error': str(error)
+            } for feature, error in failed]
+            self.model('item').update({'_id': marker['_id']}, {
+                '$push': {
+                    'meta.quarantine': {'$each': rows, '$slice': -limit}
+                },
+                '$inc': {'meta.quarantined': len(rows)}
+            })
+
+        return quarantine
+
+    def _discard_import(self, folder, marker, started, storage, error):
+        """Flag an import of bad data and remove the items it created.
+
+        The checkpoint is dropped so that resuming starts over.  Places
+        upserted to the geonames collection or over existing items can't
+        be told apart from earlier ones and are left, the marker flags
+        them.
+        """
+        removed = 0
+        if storage == 'item':
+            removed = self.model('item').collection.delete_many({
+                'folderId': folder['_id'],
+                'meta.geonameid': {'$exists': True},
+                'created': {'$gte': started}
+            }).deleted_count
+        self.model('item').update({'_id': marker['_id']}, {
+            '$set': {
+                'meta.error': str(error),
+                'meta.removed': removed
+            },
+            '$unset': {'meta.checkpoint': ''}
+        })
+
+    def _build_indexes(self, folder, ctx=None, which=None, background=True):
+        """Build the geonames indexes of a folder and return the report."""
+        collection = self.model('item').collection
+        if which is None:
+            which = indexes.PRE_IMPORT + indexes.POST_IMPORT
+        progress = None
+        if ctx is not None:
+            progress = self._progress_adapter(ctx)
+
+        indexes.drop_legacy_indexes(collection)
+        return indexes.build_indexes(
+            collection, folder, which, background=background,
+            progress=progress
+        )
+
     @access.admin
     @loadmodel(
         model='folder',
@@ -61,63 +190,632 @@ class Geonames(Resource):
     def setup(self, folder, params):
         """Call the main geonames setup code in a new job."""
         progress = self.boolParam('progress', params, default=False)
+        resume = self.boolParam('resume', params, default=False)
+        bulk = self.boolParam('bulk', params, default=True)
+        stream = self.boolParam('stream', params, default=False)
+        workers = self._int_param(params, 'workers', 0, 0,
+                                  'a non-negative integer')
+        writers = self._int_param(params, 'writers', 2, 1,
+                                  'a positive integer')
+        storage = self.geonames_storage()
+        if storage == 'collection':
+            handler = import_data.export_to_collection
+        elif bulk:
+            handler = import_data.bulk_export_to_girder
+        else:
+            handler = import_data.export_to_girder
 
-        # insert an item indicating the geonames import
-        self.model('item').createItem(
-            'geonames_import', self.getCurrentUser(), folder,
-            description=datetime.utcnow().isoformat()
-        )
+        # places already in the folder, from an earlier import or written
+        # after the checkpoint of a resumed one, would be rejected as
+        # duplicates by the unique geonameid index, replace them instead
+        if storage == 'item' and self.model('item').findOne({
+                'folderId': folder['_id'],
+                'meta.geonameid': {'$exists': True}
+        }, fields=['_id']) is not None:
+            handler = import_data.bulk_upsert_to_girder
 
-        # download the data
-        with ProgressContext(progress, user=self.getCurrentUser(),
-                             title=u'Downloading geonames database') as ctx:
+        # insert or reuse an item indicating the geonames import
+        marker = self._import_marker(folder, resume)
+        offset = 0
+        last_geonameid = None
+        if resume:
+            checkpoint = marker.get('meta', {}).get('checkpoint', {})
+            offset = checkpoint.get('offset', 0)
+            last_geonameid = checkpoint.get('geonameid')
 
-            import_data.download_all_countries(
-                progress=self._progress_adapter(ctx),
-                url=params.get('url')
+        # download the data unless resuming with the data already present,
+        # when streaming the rows are imported as the file downloads
+        download = not (resume and os.path.exists(import_data._allZip))
+        source = import_data._allZip
+        if download and stream:
+            source = import_data.stream_all_countries(
+                url=params.get('url'),
+                checksum=params.get('checksum')
             )
-            ctx.update(message='Done', force=True)
+        elif download:
+            with ProgressContext(
+                    progress, user=self.getCurrentUser(),
+                    title=u'Downloading geonames database') as ctx:
+                import_data.download_all_countries(
+                    progress=self._progress_adapter(ctx),
+                    url=params.get('url'),
+                    checksum=params.get('checksum')
+                )
+                ctx.update(message='Done', force=True)
+
+        # resumed and bulk imports need the geonameid index while writing,
+        # the query indexes are cheaper to build once the data is loaded
+        if storage == 'item':
+            self._build_indexes(folder, which=indexes.PRE_IMPORT)
 
-        # import the data
+        # import the data, mongo keeps the creation times to the millisecond
+        started = datetime.utcnow()
+        started = started.replace(
+            microsecond=started.microsecond // 1000 * 1000)
         with ProgressContext(progress, user=self.getCurrentUser(),
                              title=u'Importing geonames database') as ctx:
 
-            import_data.read_geonames(
-                folder, self.getCurrentUser(),
-                progress=self._progress_adapter(ctx, unknown=True)
-            )
+            try:
+                rows, rate = import_data.read_geonames(
+                    folder, self.getCurrentUser(),
+                    file_name=source,
+                    progress=self._progress_adapter(ctx, unknown=True),
+                    handler=handler,
+                    offset=offset,
+                    last_geonameid=last_geonameid,
+                    checkpoint=self._checkpoint_adapter(marker),
+                    quarantine=self._quarantine_adapter(marker),
+                    workers=workers,
+                    writers=writers
+                )
+            finally:
+                try:
+                    if hasattr(source, 'close'):
+                        source.close()
+                except import_data.ChecksumError as e:
+                    # a streamed file is only verified once it was imported
+                    self._discard_import(folder, marker, started, storage, e)
+                    raise
             ctx.update(message='Done', force=True)
 
-        # set the geospatial index
-        with ProgressContext(progress, user=self.getCurrentUser(),
-                             title=u'Indexing the dataset') as ctx:
-            self.model('item').collection.ensure_index([(
-                'geo.geometry.coordinates',
-                GEOSPHERE
-            )])
-            self.model('item').collection.ensure_index('meta.asciiname')
-            self.model('item').collection.ensure_index('meta.alternatenames')
-            ctx.update(message='Done', force=True)
+        # update the folder once rather than per item
+        self.model('folder').updateFolder(folder)
+
+        # build the query indexes, the geonames model maintains its own
+        report = []
+        if storage == 'item':
+            with ProgressContext(progress, user=self.getCurrentUser(),
+                                 title=u'Indexing the dataset') as ctx:
+                report = self._build_indexes(folder, ctx)
+                ctx.update(message='Done', force=True)
 
         # insert an item indicating completion
-        self.model('item').createItem(
+        done = self.model('item').createItem(
             'geonames_done', self.getCurrentUser(), folder,
             description=datetime.utcnow().isoformat()
         )
+        self.model('item').setMetadata(done, {
+            'indexes': report,
+            'rows': rows,
+            'parse_rows_per_second': rate
+        })
+        self._rebuild_gazetteer()
 
     setup.description = (
         Description('Set up the geonames database for geocoding support.')
         .param('folder', 'The folder to import the items to.', required=True)
         .param('url', 'The URL of the data file to import.', required=False)
+        .param('checksum',
+               'The sha256 hex digest the downloaded file must match.',
+               required=False)
+        .param('stream',
+               'Import rows while the file downloads instead of after, '
+               'the import is discarded if the file fails its checksum '
+               '(default=false).',
+               required=False,
+               dataType='boolean')
         .param('progress',
                'Enable progress notifications.',
                required=False,
                dataType='boolean')
+        .param('bulk',
+               'Write items with bulk inserts, bypassing item model events '
+               '(default=true).',
+               required=False,
+               dataType='boolean')
+        .param('resume',
+               'Resume the last import from its checkpoint, skipping rows '
+               'that were already imported and upserting the others, fails '
+               'if the data file changed (default=false).',
+               required=False,
+               dataType='boolean')
+        .param('workers',
+               'The number of processes cleaning rows, 0 to clean them in '
+               'the server process (default=0).',
+               required=False,
+               dataType='integer')
+        .param('writers',
+               'The number of threads writing rows to the database while '
+               'the next rows are parsed, 0 to write them in turn '
+               '(default=2).',
+               required=False,
+               dataType='integer')
+    )
+
+    @access.admin
+    @loadmodel(
+        model='folder',
+        map={'folder': 'folder'},
+        level=AccessType.ADMIN
+    )
+    def update(self, folder, params):
+        """Apply geonames daily modification and delete files."""
+        progress = self.boolParam('progress', params, default=False)
+        modifications = [
+            f for f in params.get('modifications', '').split(',') if f
+        ]
+        deletes = [f for f in params.get('deletes', '').split(',') if f]
+        for file_name in modifications + deletes:
+            if not os.path.isfile(file_name):
+                raise RestException('File not found: %s' % file_name)
+
+        handler = import_data.bulk_upsert_to_girder
+        delete = import_data.delete_from_girder
+        if self.geonames_storage() == 'collection':
+            handler = import_data.export_to_collection
+            delete = import_data.delete_from_collection
+        else:
+            # upserts are keyed by geonameid, so make sure it is indexed
+            # first; mongo maintains the other indexes as rows are written
+            self._build_indexes(folder)
+
+        marker = self.model('item').createItem(
+            'geonames_update', self.getCurrentUser(), folder,
+            description=datetime.utcnow().isoformat()
+        )
+
+        with ProgressContext(progress, user=self.getCurrentUser(),
+                             title=u'Updating geonames database') as ctx:
+            deleted = import_data.update_geonames(
+                folder, self.getCurrentUser(),
+                modifications=modifications,
+                deletes=deletes,
+                progress=self._progress_adapter(ctx, unknown=True),
+                quarantine=self._quarantine_adapter(marker),
+                handler=handler,
+                delete=delete
+            )
+            ctx.update(message='Done', force=True)
+
+        self.model('folder').updateFolder(folder)
+        self._rebuild_gazetteer()
+
+        marker = self.model('item').setMetadata(marker, {
+            'modifications': [os.path.basename(f) for f in modifications],
+            'deletes': [os.path.basename(f) for f in deletes],
+            'deleted': deleted
+        })
+        return marker['meta']
+
+    update.description = (
+        Description('Apply geonames daily modification and delete files.')
+        .notes('The files are read from the server\'s file system.  Rows in '
+               'the modification files are upserted by geonameid and rows '
+               'listed in the delete files are removed.')
+        .param('folder', 'The folder containing the geonames items.',
+               required=True)
+        .param('modifications',
+               'Comma separated paths to modifications-*.txt files.',
+               required=False)
+        .param('deletes',
+               'Comma separated paths to deletes-*.txt files.',
+               required=False)
+        .param('progress',
+               'Enable progress notifications.',
+               required=False,
+               dataType='boolean')
+    )
+
+    @access.admin
+    @loadmodel(
+        model='folder',
+        map={'folder': 'folder'},
+        level=AccessType.ADMIN
+    )
+    def index(self, folder, params):
+        """Build the geonames indexes and report their build time and size."""
+        background = self.boolParam('background', params, default=True)
+        return self._build_indexes(folder, background=background)
+
+    index.description = (
+        Description('Build the indexes used to query a geonames folder.')
+        .notes('Returns the name, key, build time in seconds and size in '
+               'bytes of each index.  Existing indexes are not rebuilt.')
+        .param('folder', 'The folder containing the geonames items.',
+               required=True)
+        .param('background',
+               'Build the indexes without blocking other database '
+               'operations (default=true).',
+               required=False,
+               dataType='boolean')
+    )
+
+    @access.admin
+    @loadmodel(
+        model='folder',
+        map={'folder': 'folder'},
+        level=AccessType.ADMIN
+    )
+    def migrate(self, folder, params):
+        """Copy geonames items to the dedicated geonames collection."""
+        progress = self.boolParam('progress', params, default=False)
+        remove = self.boolParam('remove', params, default=False)
+
+        with ProgressContext(progress, user=self.getCurrentUser(),
+                             title=u'Migrating geonames items') as ctx:
+            migrated, failed = import_data.migrate_items(
+                folder, remove=remove,
+                progress=self._progress_adapter(ctx)
+            )
+            ctx.update(message='Done', force=True)
+
+        if remove:
+            self.model('folder').updateFolder(folder)
+        self._rebuild_gazetteer()
+
+        return {
+            'migrated': migrated,
+            'failed': [{
+                'geonameid': feature['properties'].get('geonameid'),
+                'error': str(error)
+            } for feature, error in failed]
+        }
+
+    migrate.description = (
+        Description('Copy geonames items to the geonames collection.')
+        .notes('Set minerva.geonames_storage to "collection" once migrated '
+               'to geocode from the new collection.')
+        .param('folder', 'The folder containing the geonames items.',
+               required=True)
+        .param('remove',
+               'Remove the items once copied (default=false).',
+               required=False,
+               dataType='boolean')
+        .param('progress',
+               'Enable progress notifications.',
+               required=False,
+               dataType='boolean')
+    )
+
+    def _int_param(self, params, name, default, minimum, description):
+        """Return an integer parameter of at least minimum."""
+        try:
+            value = int(params.get(name, default))
+        except (TypeError, ValueError):
+            value = minimum - 1
+        if value < minimum:
+            raise RestException('The %s must be %s.' % (name, description))
+        return value
+
+    def _limit(self, params, default):
+        """Return the limit parameter, which must be a positive integer."""
+        return self._int_param(params, 'limit', default, 1,
+                               'a positive integer')
+
+    def _batch_queries(self):
+        """Return the (name, country) pairs of a batch geocode request."""
+        try:
+            body = json.loads(cherrypy.request.body.read())
+        except ValueError:
+            raise RestException('Invalid JSON body.')
+
+        names = body.get('names') if isinstance(body, dict) else None
+        if not isinstance(names, list):
+            raise RestException('The body must contain a list of names.')
+        countries = body.get('countries')
+        if countries is None:
+            countries = [None] * len(names)
+        if not isinstance(countries, list) or len(countries) != len(names):
+            raise RestException(
+                'Countries must be a list of the same length as names.')
+
+        queries = []
+        for name, country in zip(names, countries):
+            if not isinstance(name, basestring):
+                raise RestException('Names must be strings.')
+            if country:
+                country = country.upper()
+            queries.append((name, country or None))
+        return queries
+
+    def _batch_index(self, index, keys, limit):
+        """Resolve normalized (name, country) keys from the gazetteer."""
+        return {
+            (name, country): index.geocode(
+                name, limit, exact=True, country=country)
+            for name, country in keys
+        }
+
+    def _batch_mongo(self, keys, limit):
+        """Resolve normalized (name, country) keys with $in queries."""
+        names = list({name for name, _ in keys})
+        matches = {}
+
+        if self.geonames_storage() == 'collection':
+            geonames = self.model('geonames', 'minerva')
+            cursor = geonames.find({'names': {'$in': names}})
+            for doc in cursor:
+                feature = geonames.toFeature(doc)
+                for name in doc.get('names', ()):
+                    matches.setdefault(name, []).append(
+                        (doc.get('population', 0), doc.get('country_code'),
+                         feature))
+        else:
+            # items store their normalized names since the import, or the
+            # migration of items imported earlier
+            cursor = self.model('item').find({
+                'folderId': self.geonames_folder(),
+                'meta.names': {'$in': names}
+            })
+            for doc in cursor:
+                feature = item_feature(doc)
+                for name in feature['properties']['names']:
+                    matches.setdefault(name, []).append(
+                        (feature['properties']['population'],
+                         feature['properties']['country code'], feature))
+
+        results = {}
+        for name, country in keys:
+            found = [
+                (population, match)
+                for population, code, match in matches.get(name, ())
+                if country is None or code == country
+            ]
+            found.sort(key=lambda match: -(match[0] or 0))
+            results[(name, country)] = [
+                match for _, match in found[:limit]
+            ]
+        return results
+
+    @access.public
+    def batchGeocode(self, params):
+        """Geocode a list of names, streaming the results in order."""
+        queries = self._batch_queries()
+        limit = self._limit(params, 10)
+
+        index = None
+        if self.model('setting').get('minerva.geonames_index', False):
+            index = gazetteer.current()
+            if index is None and not gazetteer.building():
+                self._rebuild_gazetteer()
+
+        def resolve(keys):
+            if index is not None:
+                return self._batch_index(index, keys, limit)
+            return self._batch_mongo(keys, limit)
+
+        def stream():
+            resolved = {}
+            yield '{"results": ['
+            for start in xrange(0, len(queries), self._batch_chunk_size):
+                chunk = queries[start:start + self._batch_chunk_size]
+                keys = [(normalize(name), country) for name, country in chunk]
+
+                # each distinct name and country is only resolved once
+                missing = {key for key in keys if key not in resolved}
+                resolved.update(resolve(missing))
+
+                for i, ((name, country), key) in enumerate(zip(chunk, keys)):
+                    if start or i:
+                        yield ','
+                    yield json.dumps({
+                        'name': name,
+                        'country': country,
+                        'features': resolved[key]
+                    }, default=str)
+            yield ']}'
+
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return stream
+
+    batchGeocode.description = (
+        Description('Geocode a list of place names.')
+        .notes('POST a JSON body of the form {"names": [...], "countries": '
+               '[...]} where the optional countries list holds an ISO '
+               'country code or null for each name.  Names are matched '
+               'exactly after normalization, so each distinct name and '
+               'country is resolved once.  Results are streamed in the '
+               'order of the names, each with up to limit features, most '
+               'populous first.')
+        .param(
+            'limit',
+            'The maximum number of results to return per name.',
+            required=False,
+            dataType='integer'
+        )
+    )
+
+    def _reverse_points(self, params):
+        """Return the longitude, latitude pairs of a reverse request."""
+        if cherrypy.request.method == 'POST':
+            try:
+                body = json.loads(cherrypy.request.body.read())
+            except ValueError:
+                raise RestException('Invalid JSON body.')
+            points = body.get('points') if isinstance(body, dict) else body
+        else:
+            self.requireParams(('lon', 'lat'), params)
+            points = [[params['lon'], params['lat']]]
+
+        try:
+            points = np.asarray(points, dtype=np.float64)
+        except (TypeError, ValueError):
+            raise RestException('Points must be longitude, latitude pairs.')
+        if points.ndim != 2 or points.shape[1] != 2:
+            raise RestException('Points must be longitude, latitude pairs.')
+        if len(points) > self._max_reverse_points:
+            raise RestException(
+                'At most %d points can be reverse geocoded at once.' %
+                self._max_reverse_points)
+        return points
+
+    def _reverse_index(self, index, points, limit, classes, min_population):
+        """Return the nearest places to each point from the gazetteer."""
+        indices, distances = index.nearest(
+            points, limit, feature_classes=classes,
+            min_population=min_population
+        )
+
+        places = {}
+        results = []
+        for row, row_distances in zip(indices.tolist(), distances.tolist()):
+            nearest = []
+            for i, distance in zip(row, row_distances):
+                if i < 0:
+                    break
+                if i not in places:
+                    places[i] = index.place(i)
+                place = dict(places[i])
+                place['distance'] = distance
+                nearest.append(place)
+            results.append(nearest)
+        return results
+
+    def _reverse_mongo(self, point, limit, classes, min_population):
+        """Return the nearest places to a point with a $nearSphere query."""
+        near = {'$nearSphere': {
+            '$geometry': {'type': 'Point', 'coordinates': point}
+        }}
+
+        places = []
+        if self.geonames_storage() == 'collection':
+            query = {'geometry': near}
+            if classes:
+                query['feature_class'] = {'$in': classes}
+            if min_population:
+                query['population'] = {'$gte': min_population}
+            for doc in self.model('geonames', 'minerva').find(
+                    query, limit=limit):
+                places.append({
+                    'id': doc['_id'],
+                    'name': doc.get('name'),
+                    'coordinates': doc['geometry']['coordinates'],
+                    'population': doc.get('population', 0),
+                    'feature class': doc.get('feature_class'),
+                    'feature code': doc.get('feature_code'),
+                    'country code': doc.get('country_code')
+                })
+        else:
+            query = {
+                'folderId': self.geonames_folder(),
+                'geo.geometry.coordinates': near
+            }
+            if classes:
+                query['meta.feature class'] = {'$in': classes}
+            if min_population:
+                query['meta.population'] = {'$gte': min_population}
+            for doc in self.model('item').find(query, limit=limit):
+                places.append({
+                    'id': doc['meta']['geonameid'],
+                    'name': doc['meta'].get('name'),
+                    'coordinates': doc['geo']['geometry']['coordinates'],
+                    'population': doc['meta'].get('population', 0),
+                    'feature class': doc['meta'].get('feature class'),
+                    'feature code': doc['meta'].get('feature code'),
+                    'country code': doc['meta'].get('country code')
+                })
+
+        if places:
+            for place, distance in zip(places, gazetteer.distances(
+                    point, [place['coordinates'] for place in places])):
+                place['distance'] = float(distance)
+        return places
+
+    @access.public
+    def reverse(self, params):
+        """Return the nearest places to one or more points."""
+        points = self._reverse_points(params)
+        limit = self._limit(params, 1)
+        classes = [c for c in params.get('featureClass', '').split(',') if c]
+        min_population = self._int_param(
+            params, 'minPopulation', 0, 0, 'a non-negative integer')
+
+        index = None
+        if self.model('setting').get('minerva.geonames_index', False):
+            index = gazetteer.current()
+            if index is None and not gazetteer.building():
+                self._rebuild_gazetteer()
+
+        if index is not None:
+            try:
+                return {'results': self._reverse_index(
+                    index, points, limit, classes, min_population)}
+            except ImportError:
+                pass  # scipy isn't available
+
+        if len(points) > self._max_reverse_query_points:
+            raise RestException(
+                'At most %d points can be reverse geocoded at once without '
+                'the gazetteer.' % self._max_reverse_query_points)
+        return {'results': [
+            self._reverse_mongo(point, limit, classes, min_population)
+            for point in points.tolist()
+        ]}
+
+    reverse.description = (
+        Description('Find the places nearest to one or more points.')
+        .notes('Send a single point as lon and lat parameters, or POST a '
+               'JSON body of the form {"points": [[lon, lat], ...]} with at '
+               'most 100000 points.  Results are returned in the order of '
+               'the points, nearest place first, with the distance in '
+               'meters.  When the minerva.geonames_index setting is enabled '
+               'and scipy is installed the places are found with an in '
+               'memory KD-tree, otherwise with a $nearSphere query per '
+               'point, for at most 100 points.')
+        .param('lon', 'The longitude of a single point.', required=False,
+               dataType='double')
+        .param('lat', 'The latitude of a single point.', required=False,
+               dataType='double')
+        .param('limit',
+               'The number of places to return per point (default=1).',
+               required=False,
+               dataType='integer')
+        .param('featureClass',
+               'Comma separated geonames feature classes to return, for '
+               'example P for populated places.',
+               required=False)
+        .param('minPopulation',
+               'The minimum population of the places to return.',
+               required=False,
+               dataType='integer')
     )
 
     @access.public
     def geocode(self, params):
         """Return a list of geojson points matching the given name."""
+        limit = self._limit(params, 10)
+        if self.model('setting').get('minerva.geonames_index', False):
+            index = gazetteer.current()
+            if index is not None:
+                return {
+                    'type': 'FeatureCollection',
+                    'features': index.geocode(
+                        params.get('name', '').strip('"'), limit=limit)
+                }
+
+            # answer from the database until the index is built
+            if not gazetteer.building():
+                self._rebuild_gazetteer()
+
+        if self.geonames_storage() == 'collection':
+            geonames = self.model('geonames', 'minerva')
+            results = geonames.search(
+                params.get('name', '').strip('"'), limit=limit)
+            return {
+                'type': 'FeatureCollection',
+                'features': [geonames.toFeature(doc) for doc in results]
+            }
+
         folder = self.geonames_folder()
         if folder is None:
             raise RestException('Geocoding not configured')
@@ -125,25 +823,23 @@ class Geonames(Resource):
         results = list(self.model('item').textSearch(
             params.get('name'),
             user=self.getCurrentUser(),
-            filters={'folderId': folder},
-            limit=params.get('limit', 10)
+            filters={
+                'folderId': folder,
+                'meta.geonameid': {'$exists': True}
+            },
+            limit=limit
         ))
 
-        geo = {
-            "type": "FeatureCollection",
-            "features": []
+        return {
+            'type': 'FeatureCollection',
+            'features': [item_feature(result) for result in results]
         }
 
-        # generate a geojson object
-        for result in results:
-            result['properties'] = result.pop('meta')
-            result['id'] = result['properties'].pop('geonameid')
-            geo['features'].append(result)
-
-        return geo
-
     geocode.description = (
         Description('Search for geonames items with the given name.')
+        .notes('When the minerva.geonames_index setting is enabled, names '
+               'are matched by prefix against an in memory index and ranked '
+               'by population and feature code.')
         .param('name', 'The location name', required=True)
         .param(
             'limit',
@@ -101,7 +101,12 @@ class BsveUtility():
             raise (Exception('Exception calling bsve search request %s %s' %
                    (response.status_code, response.reason)))
 
-    def searchResult(self, requestId):
+    def searchStatus(self, requestId):
+        """
+        Check a search request once, returning the BSVE response with its
+        status, 1 when the results are ready, -1 on error and otherwise
+        still in progress.
+        """
         host = 'http://search.bsvecosystem.net'
         host = 'http://beta-search.bsvecosystem.net'
         endpoint = '/api/search/v1/result'
@@ -115,18 +120,22 @@ class BsveUtility():
             raise (Exception('Exception calling bsve search result %s %s' %
                    (response.status_code, response.reason)))
 
-        search = json.loads(response.text)
-        if search['status'] == 1:
-            return search['results']
-        elif search['status'] == -1:
-            # error
-            return search
-        else:
-            # TODO could be problematic as it can hold onto the async thread
-            # wait and loop
-            import time
-            time.sleep(5)
-            return self.searchResult(requestId)
+        return json.loads(response.text)
+
+    def searchResult(self, requestId, delay=5):
+        """
+        Wait for the results of a search request, checking every delay
+        seconds.  This blocks the calling thread, jobs should rather check
+        with searchStatus and reschedule themselves.
+        """
+        while True:
+            search = self.searchStatus(requestId)
+            if search['status'] == 1:
+                return search['results']
+            elif search['status'] == -1:
+                # error
+                return search
+            time.sleep(delay)
 
     def searchUntilResult(self, data):
         requestId = self.searchRequest(data)
@@ -0,0 +1,80 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+###############################################################################
+#  Copyright Kitware Inc.
+#
+#  Licensed under the Apache License, Version 2.0 ( the "License" );
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+###############################################################################
+
+import heapq
+import itertools
+import threading
+import time
+
+from girder import logger
+
+
+class DelayedCalls():
+    """
+    Calls functions after a delay from a single timer thread, so any number
+    of pending calls wait without holding a thread each.  The calls should
+    be quick, e.g. scheduling a job, as they run one at a time on the timer
+    thread.
+    """
+
+    def __init__(self):
+        self._calls = []
+        self._order = itertools.count()
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def callLater(self, delay, func, *args):
+        with self._condition:
+            heapq.heappush(self._calls, (time.time() + delay,
+                                         next(self._order), func, args))
+            if self._thread is None or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._run,
+                                                name='minerva-delayed-calls')
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify()
+
+    def pending(self):
+        with self._condition:
+            return len(self._calls)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while True:
+                    if not self._calls:
+                        self._condition.wait()
+                        continue
+                    delay = self._calls[0][0] - time.time()
+                    if delay <= 0:
+                        break
+                    self._condition.wait(delay)
+                _, _, func, args = heapq.heappop(self._calls)
+            try:
+                func(*args)
+            except Exception:
+                logger.exception('Delayed call to %s failed' % func.__name__)
+
+
+delayedCalls = DelayedCalls()
+
+
+def callLater(delay, func, *args):
+    """Call func with args after delay seconds, without holding a thread."""
+    delayedCalls.callLater(delay, func, *args)
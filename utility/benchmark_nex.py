@@ -0,0 +1,310 @@
+"""Benchmark the NEX analysis kernels against synthetic NetCDF cubes.
+
+The kernels (netcdf_mean, convert and toNetCDFDataset) are loaded straight
+out of the romanesco analysis scripts, so the code that is timed is the code
+that runs in production.  Each stage is timed and its peak resident memory
+recorded, and the results are written as JSON so that runs can be compared
+against an earlier baseline with --compare.
+"""
+
+import argparse
+import ast
+import json
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+
+import numpy as np
+from bson import json_util
+from netCDF4 import Dataset
+
+_analyses = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                         '..', 'analyses', 'NEX'))
+_mean_contour = os.path.join(_analyses, 'mean_contour', 'mean_contour.py')
+
+#: Imports in the analysis scripts that are only needed to talk to girder
+_skip_modules = ('girder_client', 'romanesco.utils')
+
+
+class SerialRDD(object):
+    """The subset of the pyspark RDD interface used by the analyses."""
+
+    def __init__(self, items):
+        self._items = items
+
+    def map(self, func):
+        return SerialRDD([func(item) for item in self._items])
+
+    def collect(self):
+        return list(self._items)
+
+    def persist(self, storageLevel=None):
+        return self
+
+    def unpersist(self):
+        return self
+
+    def count(self):
+        return len(self._items)
+
+    def toLocalIterator(self):
+        return iter(self._items)
+
+
+class SerialContext(object):
+    """Run the analysis kernels in process when spark is not available."""
+
+    def parallelize(self, items, partitions=None):
+        return SerialRDD(list(items))
+
+
+def load_kernels(script, context):
+    """Return the functions defined by an analysis script.
+
+    Only the imports and function definitions are executed, the job itself
+    depends on inputs injected by romanesco and a running girder.  The
+    modules listed in the script_includes of the analysis are loaded first,
+    as import_analyses prepends them to the script.
+    """
+    with open(os.path.join(os.path.dirname(script), 'analysis.json')) as f:
+        includes = json.load(f).get('script_includes', [])
+
+    def keep(node):
+        if isinstance(node, ast.ImportFrom):
+            return node.module not in _skip_modules
+        return isinstance(node, (ast.Import, ast.FunctionDef))
+
+    namespace = {'sc': context}
+    for path in [os.path.join(os.path.dirname(script), include)
+                 for include in includes] + [script]:
+        with open(path) as f:
+            tree = ast.parse(f.read(), path)
+        tree.body = [node for node in tree.body if keep(node)]
+        exec(compile(tree, path, 'exec'), namespace)
+    return namespace
+
+
+def make_cube(path, timesteps, lats, lons, chunksizes=None, zlib=False,
+              variable='pr', seed=0):
+    """Write a synthetic NEX-like cube of the given size to path."""
+    data = Dataset(path, 'w')
+    data.createDimension('time', None)
+    data.createDimension('lat', lats)
+    data.createDimension('lon', lons)
+
+    time_var = data.createVariable('time', 'f8', ('time',))
+    time_var.units = 'days since 2006-01-01 00:00:00'
+    time_var[:] = np.arange(timesteps) * 30.0
+    data.createVariable('lat', 'f8', ('lat',))[:] = \
+        np.linspace(-90, 90, lats)
+    data.createVariable('lon', 'f8', ('lon',))[:] = \
+        np.linspace(0, 360, lons, endpoint=False)
+
+    values = data.createVariable(variable, 'f4', ('time', 'lat', 'lon'),
+                                 zlib=zlib, chunksizes=chunksizes,
+                                 fill_value=1e20)
+    random = np.random.RandomState(seed)
+    for t in xrange(timesteps):
+        values[t] = random.rand(lats, lons).astype('f4')
+
+    data.close()
+
+
+def _current_rss():
+    """Return the current resident set size in bytes."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * resource.getpagesize()
+    except IOError:
+        # ru_maxrss is in kilobytes on linux and bytes on OS X
+        scale = 1 if sys.platform == 'darwin' else 1024
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * scale
+
+
+class Stages(object):
+    """Time stages and sample their peak resident memory."""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.results = {}
+
+    @contextmanager
+    def stage(self, name):
+        peak = [_current_rss()]
+        done = threading.Event()
+
+        def sample():
+            while not done.is_set():
+                peak[0] = max(peak[0], _current_rss())
+                done.wait(self.interval)
+
+        sampler = threading.Thread(target=sample)
+        sampler.daemon = True
+        sampler.start()
+        t0 = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - t0
+            done.set()
+            sampler.join()
+            result = self.results.setdefault(name, {
+                'seconds': [],
+                'peak_rss': 0
+            })
+            result['seconds'].append(elapsed)
+            result['peak_rss'] = max(result['peak_rss'], peak[0])
+
+    def summary(self):
+        summary = {}
+        for name, result in self.results.iteritems():
+            seconds = sorted(result['seconds'])
+            summary[name] = {
+                'seconds': seconds[len(seconds) // 2],
+                'min_seconds': seconds[0],
+                'runs': len(seconds),
+                'peak_rss': result['peak_rss']
+            }
+        return summary
+
+
+def run_benchmark(config, context=None):
+    """Run every stage on a synthetic cube and return the results."""
+    if context is None:
+        context = SerialContext()
+    kernels = load_kernels(_mean_contour, context)
+    stages = Stages()
+
+    workdir = tempfile.mkdtemp()
+    try:
+        cube = os.path.join(workdir, 'cube.nc')
+        make_cube(cube, config['timesteps'], config['lats'], config['lons'],
+                  chunksizes=config['chunksizes'], zlib=config['zlib'])
+
+        for _ in xrange(config['repeat']):
+            with stages.stage('read'):
+                data = Dataset(cube)
+                variable = data.variables['pr']
+                for t in xrange(len(variable)):
+                    variable[t]
+                data.close()
+
+            output = os.path.join(workdir, 'mean.nc')
+            with stages.stage('reduce'):
+                mean = kernels['netcdf_mean'](cube, 'pr',
+                                              config['grid_chunk_size'],
+                                              config['partitions'], output)
+
+            with stages.stage('convert'):
+                contour = kernels['convert'](mean, 'pr', 0)
+
+            with stages.stage('serialize'):
+                serialized = json_util.dumps(contour)
+
+            with stages.stage('write'):
+                source = Dataset(cube)
+                written = kernels['toNetCDFDataset'](
+                    source, 'pr', [mean.variables['pr'][0]],
+                    os.path.join(workdir, 'written.nc'))
+                written.close()
+                source.close()
+                with open(os.path.join(workdir, 'contour.json'), 'w') as f:
+                    f.write(serialized)
+
+            mean.close()
+            os.remove(output)
+    finally:
+        shutil.rmtree(workdir)
+
+    return {
+        'config': config,
+        'host': platform.node(),
+        'python': platform.python_version(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'stages': stages.summary()
+    }
+
+
+def compare(results, baseline, threshold):
+    """Return the stages that are slower than baseline by threshold."""
+    regressions = []
+    for name, stage in sorted(results['stages'].iteritems()):
+        previous = baseline['stages'].get(name)
+        if previous is None or not previous['seconds']:
+            continue
+        ratio = stage['seconds'] / previous['seconds']
+        sys.stdout.write('%-10s %8.3fs  baseline %8.3fs  (%.2fx)\n' % (
+            name, stage['seconds'], previous['seconds'], ratio))
+        if ratio > 1 + threshold:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmark the NEX analysis kernels')
+    parser.add_argument('--timesteps', type=int, default=120)
+    parser.add_argument('--lats', type=int, default=180)
+    parser.add_argument('--lons', type=int, default=360)
+    parser.add_argument('--chunksizes', default=None,
+                        help='NetCDF chunk sizes of the cube as t,lat,lon')
+    parser.add_argument('--zlib', action='store_true',
+                        help='compress the synthetic cube')
+    parser.add_argument('--grid-chunk-size', type=int, default=20)
+    parser.add_argument('--partitions', type=int, default=8)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--spark-master', default=None,
+                        help='run netcdf_mean on spark instead of in process')
+    parser.add_argument('--output', default=None,
+                        help='path to write the JSON results to')
+    parser.add_argument('--compare', default=None,
+                        help='path to baseline JSON results')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='relative slowdown reported as a regression')
+
+    args = parser.parse_args()
+
+    config = {
+        'timesteps': args.timesteps,
+        'lats': args.lats,
+        'lons': args.lons,
+        'chunksizes': ([int(c) for c in args.chunksizes.split(',')]
+                       if args.chunksizes else None),
+        'zlib': args.zlib,
+        'grid_chunk_size': args.grid_chunk_size,
+        'partitions': args.partitions,
+        'repeat': args.repeat,
+        'spark_master': args.spark_master
+    }
+
+    context = None
+    if args.spark_master:
+        from pyspark import SparkContext
+        context = SparkContext(args.spark_master, 'benchmark_nex')
+
+    results = run_benchmark(config, context)
+
+    output = json.dumps(results, indent=4, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output)
+    else:
+        sys.stdout.write(output + '\n')
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        if regressions:
+            sys.stderr.write('Regressions in: %s\n' % ', '.join(regressions))
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
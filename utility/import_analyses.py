@@ -6,6 +6,22 @@ import romanesco
 
 from girder_client import GirderClient
 
+def load_analysis(analysis_json):
+    """Load a romanesco analysis, prepending the source of the modules listed
+    in its script_includes to its script.  Romanesco runs the script source
+    as is, so the script can't import modules next to it."""
+    analysis = romanesco.load(analysis_json)
+    includes = analysis.pop('script_includes', [])
+    if includes and 'script' in analysis:
+        sources = []
+        for include in includes:
+            include_path = os.path.join(os.path.dirname(analysis_json), include)
+            with open(include_path) as include_file:
+                sources.append(include_file.read())
+        sources.append(analysis['script'])
+        analysis['script'] = '\n'.join(sources)
+    return analysis
+
 def import_analyses(client, analyses_path):
     # First get the minerva analysis folder
     minerva_analyses_folder = client.get('/minerva_analysis/folder')
@@ -24,13 +40,16 @@ def import_analyses(client, analyses_path):
     # e.g. analyses/bsve
     for analysis_subfolder in os.listdir(analyses_path):
         analysis_path = os.path.join(analyses_path, analysis_subfolder)
+        # skip modules shared by the analyses
+        if not os.path.isdir(analysis_path):
+            continue
 
         # If there is an analysis.json, it is a Romanesco analysis
         romanesco_analysis = os.path.join(analysis_path, 'analysis.json')
         metadata = {}
         minerva_metadata = {}
         if os.path.exists(romanesco_analysis):
-            analysis = romanesco.load(romanesco_analysis)
+            analysis = load_analysis(romanesco_analysis)
             analysis_name = analysis['name']
             metadata['analysis'] = analysis
             # set the analysis_type based on folder name